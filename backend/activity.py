@@ -0,0 +1,194 @@
+# File: mini_insta/activity.py
+# record likes, follows and comments into per-Profile aggregated activity inboxes
+# Author: Nguyen Le
+
+
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count
+from django.utils import timezone
+
+from .models import Activity, ActivityActor, Profile
+
+# events of the same kind on the same target within one bucket are merged into one Activity
+BUCKET_SECONDS = getattr(settings, 'MINI_INSTA_ACTIVITY_BUCKET_SECONDS', 24 * 60 * 60)
+
+# how many actors are remembered (for "@a, @b and 10 others") per Activity
+MAX_RECENT_ACTORS = getattr(settings, 'MINI_INSTA_ACTIVITY_MAX_RECENT_ACTORS', 3)
+
+# how long a cached unread count may live, it is also cleared on every change
+UNREAD_COUNT_TIMEOUT = 60 * 60
+
+
+def unread_count_key(profile_id):
+    '''cache key of a Profile's unread Activity count'''
+    return f'mini_insta:activity_unread:{profile_id}'
+
+
+def group_key(verb, post_id, when):
+    '''Return the key shared by every event that is merged into the same Activity'''
+    bucket = int(when.timestamp()) // BUCKET_SECONDS
+    return f'{verb}:{post_id or ""}:{bucket}'
+
+
+def make_event(verb, actor_id, recipient_id, post_id=None, when=None):
+    '''Return an event for record_events, stamped with when it happened (now by default)
+
+    The time travels with the event, so one that waits in the task queue
+    (a backlog, or retries) still lands in the bucket it happened in.
+    '''
+    return {
+        'verb': verb, 'actor_id': actor_id, 'recipient_id': recipient_id, 'post_id': post_id,
+        'timestamp': (when or timezone.now()).timestamp(),
+    }
+
+
+def event_time(event, default):
+    '''the time an event happened, or default for events queued without one'''
+    if 'timestamp' not in event:
+        return default
+    return datetime.fromtimestamp(event['timestamp'], tz=dt_timezone.utc)
+
+
+def record_events(events):
+    '''Merge a batch of events into their recipients' Activities
+
+    Each event is a dict made by make_event: verb, recipient_id, actor_id,
+    (for likes and comments) post_id, and the timestamp it happened at, which
+    decides its bucket. Events sharing a recipient and group key are merged
+    first, so a burst of likes on one post costs a single Activity update.
+    Every actor of an Activity is recorded as an ActivityActor, so one who
+    acts again (e.g. likes, unlikes and likes again) is not counted twice.
+    '''
+    now = timezone.now()
+    usernames = dict(Profile.objects.filter(pk__in={e['actor_id'] for e in events}).values_list('pk', 'username'))
+
+    grouped = defaultdict(list) # (recipient_id, group_key) -> [event, ...] oldest first
+    for event in events:
+        if event['actor_id'] == event['recipient_id']:
+            continue # no notifications for your own actions
+        when = event_time(event, now)
+        key = group_key(event['verb'], event.get('post_id'), when)
+        grouped[(event['recipient_id'], key)].append((when, event))
+
+    for (recipient_id, key), timed_group in grouped.items():
+        timed_group.sort(key=lambda timed: timed[0])
+        group = [event for _, event in timed_group]
+        latest = timed_group[-1][0]
+        with transaction.atomic():
+            activity, created = Activity.objects.select_for_update().get_or_create(
+                recipient_id=recipient_id, group_key=key,
+                defaults={'verb': group[0]['verb'], 'post_id': group[0].get('post_id'), 'updated': latest},
+            )
+            actor_ids = list(dict.fromkeys(event['actor_id'] for event in group))
+            counted = set(ActivityActor.objects.filter(activity=activity, actor_id__in=actor_ids).values_list('actor_id', flat=True))
+            new = [actor_id for actor_id in actor_ids if actor_id not in counted]
+            ActivityActor.objects.bulk_create([ActivityActor(activity=activity, actor_id=actor_id) for actor_id in new])
+            activity.actor_count += len(new)
+
+            recent = activity.recent_actors
+            for event in group:
+                actor = {'id': event['actor_id'], 'username': usernames.get(event['actor_id'], '')}
+                recent = [actor] + [a for a in recent if a['id'] != event['actor_id']]
+            activity.recent_actors = recent[:MAX_RECENT_ACTORS]
+            activity.is_read = False
+            # a delayed event does not move the Activity back in time
+            activity.updated = latest if created else max(activity.updated, latest)
+            activity.save()
+        cache.delete(unread_count_key(recipient_id))
+
+
+def get_unread_count(profile_id):
+    '''Return the number of unread Activities of a Profile, cached until the inbox changes'''
+    key = unread_count_key(profile_id)
+    count = cache.get(key)
+    if count is None:
+        count = Activity.objects.filter(recipient_id=profile_id, is_read=False).count()
+        cache.set(key, count, UNREAD_COUNT_TIMEOUT)
+    return count
+
+
+def mark_all_read(profile_id):
+    '''Mark every Activity of a Profile as read'''
+    Activity.objects.filter(recipient_id=profile_id, is_read=False).update(is_read=True)
+    cache.set(unread_count_key(profile_id), 0, UNREAD_COUNT_TIMEOUT)
+
+
+def merge_group(group, cutoff):
+    '''fold every bucket of one (recipient, verb, post) group older than cutoff into the newest one'''
+    with transaction.atomic():
+        rows = list(
+            Activity.objects.select_for_update()
+            .filter(recipient_id=group['recipient_id'], verb=group['verb'], post_id=group['post_id'], updated__lt=cutoff)
+            .order_by('-updated')
+        )
+        if len(rows) < 2:
+            return 0 # merged or trimmed by a concurrent compaction since the groups were counted
+        keeper, rest = rows[0], rows[1:]
+
+        # the actors of the merged buckets join the keeper's; one already counted there is not counted again
+        # (buckets recorded before ActivityActor existed add their whole actor_count)
+        actor_ids = list(ActivityActor.objects.filter(activity__in=rest).values_list('actor_id', flat=True))
+        counted = set(ActivityActor.objects.filter(activity=keeper, actor_id__in=actor_ids).values_list('actor_id', flat=True))
+        new = set(actor_ids) - counted
+        ActivityActor.objects.bulk_create([ActivityActor(activity=keeper, actor_id=actor_id) for actor_id in new])
+        keeper.actor_count += sum(row.actor_count for row in rest) - (len(actor_ids) - len(new))
+
+        for row in rest:
+            seen = {actor['id'] for actor in keeper.recent_actors}
+            keeper.recent_actors += [actor for actor in row.recent_actors if actor['id'] not in seen]
+            keeper.is_read = keeper.is_read and row.is_read
+        keeper.recent_actors = keeper.recent_actors[:MAX_RECENT_ACTORS]
+        keeper.save()
+        Activity.objects.filter(pk__in=[row.pk for row in rest]).delete()
+    return len(rest)
+
+
+def compact(merge_after=timedelta(days=7), keep=500, batch_size=1000):
+    '''Shrink the inboxes: merge old buckets and drop the oldest Activities beyond keep per recipient
+
+    Buckets older than merge_after for the same recipient, verb and post are
+    folded into the newest of them, counting each actor once.
+    Returns (merged, trimmed) numbers of deleted rows.
+    '''
+    cutoff = timezone.now() - merge_after
+    merged = 0
+
+    # old (recipient, verb, post) groups that span more than one bucket
+    groups = (
+        Activity.objects.filter(updated__lt=cutoff)
+        .values('recipient_id', 'verb', 'post_id')
+        .annotate(n=Count('id'))
+        .filter(n__gt=1)
+    )
+    while True:
+        # merged groups drop out of the query, so keep taking the first batch until none are left
+        batch = list(groups[:batch_size])
+        if not batch:
+            break
+        for group in batch:
+            merged += merge_group(group, cutoff)
+            cache.delete(unread_count_key(group['recipient_id']))
+
+    # recipients with more than keep Activities lose the oldest ones
+    trimmed = 0
+    crowded = (
+        Activity.objects.values('recipient_id').annotate(n=Count('id')).filter(n__gt=keep).values_list('recipient_id', flat=True)
+    )
+    for recipient_id in list(crowded):
+        while True:
+            oldest = list(
+                Activity.objects.filter(recipient_id=recipient_id)
+                .order_by('-updated')
+                .values_list('pk', flat=True)[keep:keep + batch_size]
+            )
+            if not oldest:
+                break
+            trimmed += Activity.objects.filter(pk__in=oldest).delete()[0]
+        cache.delete(unread_count_key(recipient_id))
+
+    return merged, trimmed
@@ -1,16 +1,194 @@
 # File: mini_insta/admin.py
-# model registration
+# model registration, with admins that stay usable on tables of tens of millions of rows
 # Author: Nguyen Le
 
 
-from django.contrib import admin
+from django.conf import settings
+from django.contrib import admin, messages
+from django.contrib.admin.actions import delete_selected as django_delete_selected
+from django.contrib.admin.views.main import IS_POPUP_VAR, ORDER_VAR, PAGE_VAR, TO_FIELD_VAR
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils.functional import cached_property
 
 # Register your models here.
+from . import deletion, tasks
 from .models import Profile, Post, Photo, Follow, Comment, Like
+from .taskqueue import enqueue
 
-admin.site.register(Profile)
-admin.site.register(Post)
-admin.site.register(Photo)
-admin.site.register(Follow)
-admin.site.register(Comment)
-admin.site.register(Like)
\ No newline at end of file
+# unfiltered changelists of tables estimated above this many rows show the estimate instead of running COUNT(*)
+ESTIMATE_THRESHOLD = getattr(settings, 'MINI_INSTA_ADMIN_ESTIMATE_THRESHOLD', 100000)
+
+# objects listed on a delete confirmation page; the rest are only counted
+CONFIRMATION_LIMIT = 100
+
+# changelist parameters that neither filter nor search
+UNFILTERED_PARAMS = {ORDER_VAR, PAGE_VAR, IS_POPUP_VAR, TO_FIELD_VAR}
+
+
+def estimated_count(model, using):
+    '''Return the database's own estimate of the rows in model's table, or None where it has none (SQLite)'''
+    connection = connections[using]
+    table = model._meta.db_table
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute('SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass', [connection.ops.quote_name(table)])
+        elif connection.vendor == 'mysql':
+            cursor.execute('SELECT table_rows FROM information_schema.tables WHERE table_schema = DATABASE() AND table_name = %s', [table])
+        else:
+            return None
+        row = cursor.fetchone()
+    # PostgreSQL reports -1 for a table that was never analyzed
+    if row is None or row[0] is None or row[0] < 0:
+        return None
+    return row[0]
+
+
+class EstimatedCountPaginator(Paginator):
+    '''Paginator that takes the row count of a big unfiltered changelist from the planner's estimate'''
+
+    def __init__(self, *args, estimate=False, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.estimate = estimate
+
+    @cached_property
+    def count(self):
+        if self.estimate:
+            estimate = estimated_count(self.object_list.model, self.object_list.db)
+            if estimate is not None and estimate >= ESTIMATE_THRESHOLD:
+                return estimate
+        return self.object_list.count()
+
+
+class ScalableAdmin(admin.ModelAdmin):
+    '''ModelAdmin for big tables: estimated counts, no full-table counts or facets, and batched deletes
+
+    Subclasses set list_select_related for whatever list_display shows, and
+    raw_id_fields or autocomplete_fields for their foreign keys, so neither a
+    changelist row nor a change form loads a whole related table. Deleting
+    goes through mini_insta.deletion: the selected pks are read in batches and
+    each batch is purged by a background task, however many rows are selected.
+    '''
+
+    actions = ['delete_selected'] # replaces Django's, which loads every selected object
+    delete_note = 'They stay listed here until the purge has run.' # told to the user after deleting
+    ordering = ['-pk'] # newest first, read backwards along the primary key
+    list_per_page = 50
+    show_full_result_count = False # the "(N total)" next to a filtered count is another COUNT(*) of the table
+    show_facets = admin.ShowFacets.NEVER # one COUNT per filter choice
+
+    def get_paginator(self, request, queryset, per_page, orphans=0, allow_empty_first_page=True):
+        # only an unfiltered, unsearched list can use the table's estimate
+        unfiltered = set(request.GET) <= UNFILTERED_PARAMS
+        return EstimatedCountPaginator(queryset, per_page, orphans, allow_empty_first_page, estimate=unfiltered)
+
+    def get_deleted_objects(self, objs, request):
+        '''list the first selected objects on the confirmation page and count the rest, instead of collecting their whole graph'''
+        if isinstance(objs, list):
+            listed, total = objs[:CONFIRMATION_LIMIT], len(objs)
+        else:
+            if isinstance(self.list_select_related, (list, tuple)):
+                objs = objs.select_related(*self.list_select_related)
+            listed, total = list(objs[:CONFIRMATION_LIMIT]), objs.count()
+        deleted_objects = [str(obj) for obj in listed]
+        if total > len(listed):
+            deleted_objects.append(f'... and {total - len(listed)} more')
+        model_count = {self.model._meta.verbose_name_plural: total}
+        perms_needed = set() if self.has_delete_permission(request) else {self.model._meta.verbose_name}
+        return deleted_objects, model_count, perms_needed, []
+
+    @admin.action(permissions=['delete'], description='Delete selected %(verbose_name_plural)s')
+    def delete_selected(self, request, queryset):
+        '''Django's confirmation page, then log and delete the selection one batch of pks at a time'''
+        if not request.POST.get('post'):
+            return django_delete_selected(self, request, queryset)
+        deleted = 0
+        for pks in deletion.pk_batches(queryset):
+            self.log_deletions(request, self.model._base_manager.filter(pk__in=pks))
+            self.delete_batch(pks)
+            deleted += len(pks)
+        self.message_user(request, f'Deleting {deleted} {self.model._meta.verbose_name_plural} in the background. {self.delete_note}', messages.SUCCESS)
+        return None
+
+    def delete_model(self, request, obj):
+        self.delete_batch([obj.pk])
+
+    def response_delete(self, request, obj_display, obj_id):
+        # the object is only queued for deletion so far
+        response = super().response_delete(request, obj_display, obj_id)
+        self.message_user(request, f'It is deleted in the background. {self.delete_note}', messages.INFO)
+        return response
+
+    def delete_queryset(self, request, queryset):
+        for pks in deletion.pk_batches(queryset):
+            self.delete_batch(pks)
+
+    def delete_batch(self, pks):
+        '''delete the rows with pks (at most deletion.BATCH_SIZE) and everything that cascades from them'''
+        enqueue(tasks.purge_rows, model=self.model._meta.label_lower, pks=pks)
+
+
+class BackgroundDeleteAdmin(ScalableAdmin):
+    '''ModelAdmin that hides objects right away with a function of mini_insta.deletion and purges them in the background'''
+
+    # function in mini_insta.deletion that hides a list of pks and queues their purge
+    delete_function = None
+
+    def delete_batch(self, pks):
+        self.delete_function(pks)
+
+
+class ProfileAdmin(BackgroundDeleteAdmin):
+    delete_function = staticmethod(deletion.delete_profiles)
+    delete_note = 'Their posts are hidden already; the profiles stay listed here until the purge has run.'
+    list_display = ['id', 'username', 'display_name', 'user', 'join_date']
+    list_select_related = ['user']
+    search_fields = ['^username'] # prefix search, also used by the autocomplete widgets of other admins
+    raw_id_fields = ['user']
+    date_hierarchy = 'join_date'
+
+
+class PostAdmin(BackgroundDeleteAdmin):
+    delete_function = staticmethod(deletion.delete_posts)
+    delete_note = 'They are hidden already.' # the default manager leaves deleted Posts out
+    list_display = ['id', 'profile', 'caption', 'timestamp']
+    list_select_related = ['profile']
+    autocomplete_fields = ['profile']
+    date_hierarchy = 'timestamp'
+
+
+class PhotoAdmin(ScalableAdmin):
+    list_display = ['id', 'post', 'image_file', 'image_url', 'timestamp']
+    list_select_related = ['post']
+    raw_id_fields = ['post']
+
+
+class FollowAdmin(ScalableAdmin):
+    list_display = ['id', 'follower_profile', 'profile', 'timestamp']
+    list_select_related = ['follower_profile', 'profile']
+    autocomplete_fields = ['follower_profile', 'profile']
+    date_hierarchy = 'timestamp'
+
+
+class CommentAdmin(ScalableAdmin):
+    list_display = ['id', 'profile', 'post', 'text', 'timestamp']
+    list_select_related = ['profile', 'post']
+    autocomplete_fields = ['profile']
+    raw_id_fields = ['post']
+    date_hierarchy = 'timestamp'
+
+
+class LikeAdmin(ScalableAdmin):
+    list_display = ['id', 'profile', 'post', 'timestamp']
+    list_select_related = ['profile', 'post']
+    autocomplete_fields = ['profile']
+    raw_id_fields = ['post']
+    date_hierarchy = 'timestamp'
+
+
+admin.site.register(Profile, ProfileAdmin)
+admin.site.register(Post, PostAdmin)
+admin.site.register(Photo, PhotoAdmin)
+admin.site.register(Follow, FollowAdmin)
+admin.site.register(Comment, CommentAdmin)
+admin.site.register(Like, LikeAdmin)
@@ -0,0 +1,64 @@
+# File: mini_insta/api_urls.py
+# url patterns of the REST API, mounted under api/ by urls.py; the views are imported on first use
+# Author: Nguyen Le
+
+
+from importlib import import_module
+
+from django.urls import path
+from django.utils.functional import cached_property
+
+from .throttling import NORMAL
+
+app_name = 'api'
+
+
+class LazyAPIView:
+    '''View function of an API view class in api_views.py, which is imported on its first request
+
+    Routes and their names are known without the import, so resolving or
+    reversing HTML routes never loads Django REST Framework.
+    '''
+
+    # DRF views do their own CSRF checks, for session authenticated requests only
+    csrf_exempt = True
+
+    def __init__(self, name):
+        self.name = name
+        self.__name__ = self.__qualname__ = name
+        self.__module__ = f'{__package__}.api_views'
+
+    @cached_property
+    def view(self):
+        return getattr(import_module(self.__module__), self.name).as_view()
+
+    @property
+    def priority(self):
+        '''priority of the view class, read by throttling.LoadSheddingMiddleware'''
+        return getattr(self.view.view_class, 'priority', NORMAL)
+
+    def __call__(self, request, *args, **kwargs):
+        return self.view(request, *args, **kwargs)
+
+
+urlpatterns = [
+    path('profiles/', LazyAPIView('ProfileListAPIView'), name='profile_list'), # api endpoint for list of profiles
+    path('profiles/batch/', LazyAPIView('ProfileBatchAPIView'), name='profile_batch'), # api endpoint for many profiles by id, ?ids=3,1,2
+    path('profiles/<int:pk>/', LazyAPIView('ProfileDetailAPIView'), name='profile_detail'), # api endpoint for viewing specific profile
+    path('profiles/<int:profile_id>/posts/', LazyAPIView('ProfilePostsAPIView'), name='profile_posts'), # api endpoint for viewing specific profile's posts
+    path('profiles/<int:profile_id>/feed/', LazyAPIView('ProfileFeedAPIView'), name='profile_feed'), # api endpoint for viewing specific profile's feed
+    path('profiles/<int:profile_id>/activity/', LazyAPIView('ProfileActivityAPIView'), name='profile_activity'), # api endpoint for a profile's activity inbox
+    path('tags/<str:name>/posts/', LazyAPIView('TagPostsAPIView'), name='tag_posts'), # api endpoint for the posts with a hashtag
+    path('posts/batch/', LazyAPIView('PostBatchAPIView'), name='post_batch'), # api endpoint for many posts by id, ?ids=3,1,2
+    path('posts/<int:pk>/comments/archived/', LazyAPIView('ArchivedCommentsAPIView'), name='archived_comments'), # api endpoint for a post's archived comments
+    path('posts/create/', LazyAPIView('CreatePostAPIView'), name='create_post'), # api endpoint to create post
+    path('auth/login/', LazyAPIView('LoginAPIView'), name='login'), # api endpoint to log in an authenticated user
+    path('auth/user/', LazyAPIView('CurrentUserAPIView'), name='current_user'), # api end point to authenticate a user
+]
+
+# names the first API routes had before they moved into the "api" namespace, still reversible (mounted by urls.py)
+LEGACY_NAMES = ['profile_list', 'profile_detail', 'profile_posts', 'profile_feed', 'profile_activity', 'create_post', 'login', 'current_user']
+legacy_urlpatterns = [
+    path(str(pattern.pattern), pattern.callback, name=f'api_{pattern.name}')
+    for pattern in urlpatterns if pattern.name in LEGACY_NAMES
+]
@@ -0,0 +1,342 @@
+# File: mini_insta/api_views.py
+# REST API views for the React Native client, loaded on the first api/ request (see urls.py)
+# Author: Nguyen Le
+
+
+import json
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.contrib.auth import authenticate
+from django.http import StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+from rest_framework import generics, status
+from rest_framework.authtoken.models import Token
+from rest_framework.exceptions import PermissionDenied
+from rest_framework.pagination import CursorPagination
+from rest_framework.parsers import FormParser, MultiPartParser
+from rest_framework.permissions import AllowAny, IsAuthenticated
+from rest_framework.response import Response
+from rest_framework.utils.encoders import JSONEncoder
+from rest_framework.views import APIView
+
+from . import activity, archive, db_router, fragments, object_cache, tags
+from .bulk_data import chunked
+from .like_summary import get_like_summaries
+from .models import Activity, Photo, Post, Profile
+from .serializers import (
+    ActivitySerializer, ArchivedCommentSerializer, CachedPostSerializer, PostSerializer, ProfileSerializer, UserSerializer,
+    absolute_photo, get_follow_counts,
+)
+from .taskqueue import enqueue
+from .tasks import render_photo_renditions
+from .throttling import LOW, LoginThrottle, TokenBucketThrottle
+from .views import get_viewer_profile
+
+
+# posts serialized and sent at a time by the streaming list endpoints
+STREAM_CHUNK_SIZE = getattr(settings, "MINI_INSTA_STREAM_CHUNK_SIZE", 50)
+
+# most ids a batch request may ask for
+BATCH_MAX_IDS = getattr(settings, "MINI_INSTA_BATCH_MAX_IDS", 100)
+
+
+def post_list_context(request, posts, viewer):
+    """Serializer context for many posts, with all their like summaries (for viewer) and follow counts computed up front."""
+    return {
+        "request": request,
+        "like_summaries": get_like_summaries(posts, viewer),
+        "follow_counts": get_follow_counts(post.profile for post in posts),
+    }
+
+
+def stream_posts(request, posts):
+    """Yield the JSON array of serialized posts STREAM_CHUNK_SIZE posts at a time.
+
+    Each chunk is read, serialized (with its like summaries and follow counts)
+    and sent before the next one is queried, so a long list neither waits
+    for its last row nor sits in memory, and compression (see compression.py)
+    runs chunk by chunk as well. Wrap it in db_router.keep_routing, since
+    it runs after the routing middleware has returned.
+    """
+    viewer = get_viewer_profile(request)
+    yield b"["
+    for i, chunk in enumerate(chunked(posts.iterator(chunk_size=STREAM_CHUNK_SIZE), STREAM_CHUNK_SIZE)):
+        data = PostSerializer(chunk, many=True, context=post_list_context(request, chunk, viewer)).data
+        # the items of this chunk's array, encoded like the JSON renderer does
+        items = json.dumps(data, cls=JSONEncoder, ensure_ascii=False, separators=(",", ":"))[1:-1]
+        yield ("," if i else "").encode() + items.encode()
+    yield b"]"
+
+
+class ProfileListAPIView(generics.ListAPIView):
+    queryset = Profile.objects.select_related("user").order_by("username")
+    serializer_class = ProfileSerializer
+
+    def get_serializer(self, *args, **kwargs):
+        # the follow counts of every listed Profile, in two queries instead of two per Profile
+        if args:
+            kwargs["context"] = {**self.get_serializer_context(), "follow_counts": get_follow_counts(args[0])}
+        return super().get_serializer(*args, **kwargs)
+
+
+class ProfileDetailAPIView(generics.RetrieveAPIView):
+    queryset = Profile.objects.select_related("user")
+    serializer_class = ProfileSerializer
+
+
+class ProfilePostsAPIView(APIView):
+    permission_classes = [AllowAny]
+
+    def get(self, request, profile_id):
+        profile = get_object_or_404(Profile, pk=profile_id)
+        posts = (
+            Post.objects.filter(profile=profile).order_by("-timestamp")
+            .select_related("profile__user").prefetch_related("photo_set")
+        )
+        return StreamingHttpResponse(db_router.keep_routing(stream_posts(request, posts)), content_type="application/json")
+
+
+class ProfileFeedAPIView(APIView):
+    permission_classes = [AllowAny]
+
+    def get(self, request, profile_id):
+        profile = get_object_or_404(Profile, pk=profile_id)
+        posts = profile.get_post_feed().select_related("profile__user").prefetch_related("photo_set")
+        return StreamingHttpResponse(db_router.keep_routing(stream_posts(request, posts)), content_type="application/json")
+
+
+class TagPostsAPIView(APIView):
+    """Posts with a #hashtag, newest first. Pages follow the "next" URL, which carries a cursor into the tag's index."""
+
+    permission_classes = [AllowAny]
+
+    def get(self, request, name):
+        try:
+            posts, next_cursor = tags.tagged_posts(name, request.query_params.get("cursor"))
+        except ValueError:
+            return Response({"error": "invalid cursor"}, status=status.HTTP_400_BAD_REQUEST)
+        serializer = PostSerializer(posts, many=True, context=post_list_context(request, posts, get_viewer_profile(request)))
+        next_url = None
+        if next_cursor:
+            next_url = request.build_absolute_uri(f"{request.path}?{urlencode({'cursor': next_cursor})}")
+        return Response({"next": next_url, "results": serializer.data})
+
+
+class ArchivedCommentsAPIView(APIView):
+    """Archived comments of a post, newest first. Pages follow the "next" URL, which carries a cursor into the archive."""
+
+    permission_classes = [AllowAny]
+
+    def get(self, request, pk):
+        post = get_object_or_404(Post, pk=pk)
+        try:
+            comments, next_cursor = archive.archived_comments(post.pk, request.query_params.get("cursor"))
+        except ValueError:
+            return Response({"error": "invalid cursor"}, status=status.HTTP_400_BAD_REQUEST)
+        next_url = None
+        if next_cursor:
+            next_url = request.build_absolute_uri(f"{request.path}?{urlencode({'cursor': next_cursor})}")
+        return Response({"next": next_url, "count": post.archived_comment_count, "results": ArchivedCommentSerializer(comments, many=True).data})
+
+
+def parse_batch_ids(value):
+    """Return the ids of "?ids=3,1,2" in order; raises ValueError for a malformed or too long list."""
+    try:
+        ids = [int(part) for part in value.split(",") if part.strip()]
+    except ValueError:
+        raise ValueError("ids must be a comma separated list of integers") from None
+    if not ids:
+        raise ValueError("ids is required")
+    if len(ids) > BATCH_MAX_IDS:
+        raise ValueError(f"at most {BATCH_MAX_IDS} ids per request")
+    return ids
+
+
+def batch_profiles(profile_ids):
+    """Return {pk: serialized profile} for the profile_ids that exist, from the object cache where possible."""
+    found = object_cache.get_many(object_cache.PROFILE, profile_ids)
+    missing = {pk for pk in profile_ids if pk not in found}
+    if missing:
+        profiles = list(Profile.objects.select_related("user").in_bulk(missing).values())
+        serializer = ProfileSerializer(profiles, many=True, context={"follow_counts": get_follow_counts(profiles)})
+        fresh = {item["id"]: dict(item) for item in serializer.data}
+        object_cache.set_many(object_cache.PROFILE, fresh)
+        found.update(fresh)
+    return found
+
+
+def batch_posts(request, post_ids):
+    """Return {pk: serialized post} for the post_ids that exist, as PostSerializer would for this viewer.
+
+    The viewer independent part of each post and its profile come from the
+    object cache where possible; the misses take one query each for posts,
+    photos and profiles, and the likes lines come from the like summaries.
+    """
+    bodies = object_cache.get_many(object_cache.POST, post_ids)
+    missing = {pk for pk in post_ids if pk not in bodies}
+    if missing:
+        posts = list(Post.objects.prefetch_related("photo_set").in_bulk(missing).values())
+        fresh = {item["id"]: dict(item) for item in CachedPostSerializer(posts, many=True).data}
+        object_cache.set_many(object_cache.POST, fresh)
+        bodies.update(fresh)
+
+    profiles = batch_profiles({body["profile_id"] for body in bodies.values()})
+    summaries = get_like_summaries(list(bodies), get_viewer_profile(request))
+    return {
+        pk: {
+            "id": pk,
+            "profile": profiles.get(body["profile_id"]),
+            "timestamp": body["timestamp"],
+            "caption": body["caption"],
+            "photos": [absolute_photo(request, photo) for photo in body["photos"]],
+            "num_likes": summaries[pk].count,
+            "like_summary": summaries[pk].as_dict(),
+        }
+        for pk, body in bodies.items()
+    }
+
+
+class BatchAPIView(APIView):
+    """GET ?ids=3,1,2 returns {"results": [...], "not_found": [...]}.
+
+    Results are in request order, with null in place of each id that does not
+    exist, and not_found lists those ids. Subclasses define
+    get_objects(request, ids), returning {id: serialized object} for the ids found.
+    """
+
+    permission_classes = [AllowAny]
+
+    def get(self, request):
+        try:
+            ids = parse_batch_ids(request.query_params.get("ids", ""))
+        except ValueError as error:
+            return Response({"error": str(error)}, status=status.HTTP_400_BAD_REQUEST)
+        found = self.get_objects(request, list(dict.fromkeys(ids)))
+        return Response({
+            "results": [found.get(pk) for pk in ids],
+            "not_found": [pk for pk in dict.fromkeys(ids) if pk not in found],
+        })
+
+
+class PostBatchAPIView(BatchAPIView):
+    def get_objects(self, request, ids):
+        return batch_posts(request, ids)
+
+
+class ProfileBatchAPIView(BatchAPIView):
+    def get_objects(self, request, ids):
+        return batch_profiles(ids)
+
+
+class ActivityPagination(CursorPagination):
+    page_size = 20
+    ordering = "-updated"
+
+
+class ProfileActivityAPIView(APIView):
+    """The logged in Profile's activity inbox. GET lists it newest first, POST marks it all read."""
+
+    permission_classes = [IsAuthenticated]
+
+    def get_profile(self, request, profile_id):
+        profile = get_object_or_404(Profile, pk=profile_id)
+        if profile.user_id != request.user.pk:
+            raise PermissionDenied("you can only read your own activity")
+        return profile
+
+    def get(self, request, profile_id):
+        profile = self.get_profile(request, profile_id)
+        paginator = ActivityPagination()
+        page = paginator.paginate_queryset(
+            Activity.objects.filter(recipient=profile), request, view=self
+        )
+        serializer = ActivitySerializer(page, many=True)
+        response = paginator.get_paginated_response(serializer.data)
+        response.data["unread_count"] = activity.get_unread_count(profile.pk)
+        return response
+
+    def post(self, request, profile_id):
+        profile = self.get_profile(request, profile_id)
+        activity.mark_all_read(profile.pk)
+        return Response({"unread_count": 0})
+
+
+class CreatePostAPIView(APIView):
+    permission_classes = [IsAuthenticated]
+    parser_classes = [MultiPartParser, FormParser]
+    throttle_classes = [TokenBucketThrottle]
+    throttle_scope = "create_post"
+    priority = LOW
+
+    def post(self, request):
+        profile = get_object_or_404(Profile, user=request.user)
+        caption = request.data.get("caption", "").strip()
+
+        if not caption:
+            return Response(
+                {"error": "caption is required"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        post = Post.objects.create(profile=profile, caption=caption)
+
+        files = request.FILES.getlist("photos")
+        if files:
+            photos = [Photo.objects.create(post=post, image_file=image_file) for image_file in files]
+            enqueue(render_photo_renditions, photo_ids=[photo.pk for photo in photos])
+        else:
+            # Keep behavior consistent with the web view fallback.
+            Photo.objects.create(post=post, image_file="default.png")
+        fragments.bump_versions([post.pk])
+
+        serializer = PostSerializer(post, context={"request": request})
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+
+class LoginAPIView(APIView):
+    permission_classes = [AllowAny]
+    throttle_classes = [LoginThrottle]
+    throttle_scope = "login"
+    priority = LOW
+
+    def post(self, request):
+        username = request.data.get("username")
+        password = request.data.get("password")
+
+        if not username or not password:
+            return Response(
+                {"error": "username and password required"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        user = authenticate(username=username, password=password)
+        if not user:
+            return Response(
+                {"error": "invalid credentials"},
+                status=status.HTTP_401_UNAUTHORIZED,
+            )
+
+        token, _ = Token.objects.get_or_create(user=user)
+
+        profile = get_object_or_404(Profile, user=user)
+        return Response(
+            {
+                "token": token.key,
+                "user": UserSerializer(user).data,
+                "profile": ProfileSerializer(profile).data,
+            }
+        )
+
+
+class CurrentUserAPIView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        profile = get_object_or_404(Profile, user=request.user)
+        return Response(
+            {
+                "user": UserSerializer(request.user).data,
+                "profile": ProfileSerializer(profile).data,
+            }
+        )
\ No newline at end of file
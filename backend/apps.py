@@ -4,3 +4,13 @@ from django.apps import AppConfig
 class MiniInstaConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'mini_insta'
+
+    def ready(self):
+        # register background tasks with the task queue
+        from . import tasks  # noqa: F401
+
+        # keep the #hashtag and @mention index up to date as Posts and Comments are saved
+        from . import tags  # noqa: F401
+
+        # system checks (python manage.py check)
+        from . import checks  # noqa: F401
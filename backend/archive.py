@@ -0,0 +1,137 @@
+# File: mini_insta/archive.py
+# move the Likes and Comments of old Posts out of the hot tables into compact archive tables
+# Author: Nguyen Le
+
+
+from collections import Counter, defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from . import fragments, like_summary
+from .models import ArchivedComment, ArchivedLike, Comment, Like, Mention, Post
+from .tags import decode_cursor, encode_cursor
+
+# Likes and Comments of Posts older than this many days are archived
+ARCHIVE_AFTER_DAYS = getattr(settings, 'MINI_INSTA_ARCHIVE_AFTER_DAYS', 365)
+
+# rows moved per transaction, so no lock is held for long
+BATCH_SIZE = getattr(settings, 'MINI_INSTA_ARCHIVE_BATCH_SIZE', 1000)
+
+# archived Comments per page
+PAGE_SIZE = getattr(settings, 'MINI_INSTA_ARCHIVED_COMMENTS_PAGE_SIZE', 50)
+
+
+def add_counts(counts, field):
+    '''add {post pk: n} to a counter column of Post, with one UPDATE per distinct n'''
+    by_count = defaultdict(list)
+    for post_id, n in counts.items():
+        by_count[n].append(post_id)
+    for n, post_ids in by_count.items():
+        Post.all_objects.filter(pk__in=post_ids).update(**{field: F(field) + n})
+
+
+def move_likes(likes):
+    '''Copy a batch of Like rows (dicts) to ArchivedLike and delete them; return {post pk: Likes archived}
+
+    A Like that is in the archive already (e.g. imported twice), or that repeats
+    another Like of the batch, is only deleted.
+    '''
+    archived = set(ArchivedLike.objects.filter(
+        post_id__in={like['post_id'] for like in likes}, profile_id__in={like['profile_id'] for like in likes},
+    ).values_list('post_id', 'profile_id'))
+    new = []
+    for like in likes:
+        pair = (like['post_id'], like['profile_id'])
+        if pair not in archived:
+            archived.add(pair)
+            new.append(like)
+    ArchivedLike.objects.bulk_create([
+        ArchivedLike(post_id=like['post_id'], profile_id=like['profile_id'], timestamp=like['timestamp'])
+        for like in new
+    ])
+    Like.objects.filter(pk__in=[like['pk'] for like in likes]).delete()
+    return Counter(like['post_id'] for like in new)
+
+
+def move_comments(comments):
+    '''Copy a batch of Comment rows (dicts) to ArchivedComment and delete them; return {post pk: Comments archived}'''
+    ArchivedComment.objects.bulk_create([
+        ArchivedComment(post_id=comment['post_id'], profile_id=comment['profile_id'], timestamp=comment['timestamp'], text=comment['text'])
+        for comment in comments
+    ])
+    pks = [comment['pk'] for comment in comments]
+    # mentions in the comment stay in the index, pointing at the Post only (as a caption's do)
+    Mention.objects.filter(comment__in=pks).update(comment=None)
+    Comment.objects.filter(pk__in=pks).delete()
+    return Counter(comment['post_id'] for comment in comments)
+
+
+# what is archived: (name, hot model, columns read, counter column of Post, function moving a batch,
+# function invalidating what is cached about the Posts)
+KINDS = [
+    ('likes', Like, ['pk', 'post_id', 'profile_id', 'timestamp'], 'archived_like_count', move_likes, like_summary.invalidate),
+    ('comments', Comment, ['pk', 'post_id', 'profile_id', 'timestamp', 'text'], 'archived_comment_count', move_comments, fragments.bump_versions),
+]
+
+
+def archive_batch(kind, before, after=0, batch_size=BATCH_SIZE):
+    '''Move the next batch of rows of a kind (see KINDS) with pk > after on Posts older than before
+
+    The rows are locked while they are copied and deleted, in one short
+    transaction; rows another transaction holds are skipped until the next run.
+    The number archived per Post is added to the Post's counter in the same
+    transaction, so counts that include the archive never change.
+    Returns (rows moved, last pk), or (0, after) when there are none left.
+    '''
+    _, model, columns, counter, move, invalidate = kind
+    with transaction.atomic():
+        rows = list(
+            model.objects.select_for_update(skip_locked=True, of=('self',))
+            .filter(pk__gt=after, post__timestamp__lt=before, post__deleted_at__isnull=True)
+            .order_by('pk').values(*columns)[:batch_size]
+        )
+        if not rows:
+            return 0, after
+        counts = move(rows)
+        add_counts(counts, counter)
+        # the cached likes lines or comment lists of these Posts are out of date
+        post_ids = list({row['post_id'] for row in rows})
+        transaction.on_commit(lambda: invalidate(post_ids))
+    return len(rows), rows[-1]['pk']
+
+
+def archive(days=ARCHIVE_AFTER_DAYS, batch_size=BATCH_SIZE, after=None):
+    '''Archive the Likes and Comments of Posts older than days, batch by batch
+
+    Yields (kind, rows moved, last pk) after every batch. after={kind: pk}
+    resumes an interrupted run; a new run starts over and only finds the rows
+    added (or skipped) since the last one.
+    '''
+    before = timezone.now() - timedelta(days=days)
+    after = after or {}
+    for kind in KINDS:
+        name = kind[0]
+        last = after.get(name, 0)
+        while True:
+            moved, last = archive_batch(kind, before, last, batch_size)
+            if not moved:
+                break
+            yield name, moved, last
+
+
+def archived_comments(post_id, cursor=None, limit=PAGE_SIZE):
+    '''Return (archived Comments of a Post, cursor of the next page or None), newest first
+
+    The Comments have their profile selected. Raises ValueError for a malformed cursor.
+    '''
+    rows = ArchivedComment.objects.filter(post_id=post_id)
+    if cursor:
+        timestamp, pk = decode_cursor(cursor)
+        rows = rows.filter(Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, pk__lt=pk))
+    rows = list(rows.order_by('-timestamp', '-pk').select_related('profile')[:limit + 1])
+    next_cursor = encode_cursor(rows[limit - 1].timestamp, rows[limit - 1].pk) if len(rows) > limit else None
+    return rows[:limit], next_cursor
@@ -0,0 +1,240 @@
+# File: mini_insta/bulk_data.py
+# streaming export/import of profiles, posts and the social graph as NDJSON or CSV
+# Author: Nguyen Le
+
+
+import csv
+import json
+import os
+from contextlib import contextmanager
+from datetime import datetime
+from itertools import islice
+
+from django.contrib.auth.models import User
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection, transaction
+
+from . import like_summary, tags
+from .models import ArchivedComment, ArchivedLike, Comment, Follow, Like, Photo, Post, Profile
+
+FORMATS = ('ndjson', 'csv')
+
+
+class Table:
+    '''How one model is exported: its file name, the columns written, and which of them are foreign keys'''
+
+    def __init__(self, name, model, columns, foreign_keys=None):
+        self.name = name
+        self.model = model
+        self.columns = columns # {column in the file: ORM lookup}
+        self.foreign_keys = foreign_keys or {} # {column: name of the Table it points to}
+
+    def filename(self, fmt):
+        return f'{self.name}.{fmt}'
+
+
+# in dependency order: every table only points at tables above it
+TABLES = [
+    Table('profile', Profile, {
+        'id': 'id', 'user': 'user__username', 'username': 'username', 'display_name': 'display_name',
+        'profile_image_url': 'profile_image_url', 'bio_text': 'bio_text', 'join_date': 'join_date',
+    }),
+    Table('post', Post, {
+        'id': 'id', 'profile_id': 'profile_id', 'timestamp': 'timestamp', 'caption': 'caption',
+        'archived_like_count': 'archived_like_count', 'archived_comment_count': 'archived_comment_count',
+    }, {'profile_id': 'profile'}),
+    Table('photo', Photo, {
+        'id': 'id', 'post_id': 'post_id', 'image_url': 'image_url', 'image_file': 'image_file', 'timestamp': 'timestamp',
+    }, {'post_id': 'post'}),
+    Table('follow', Follow, {
+        'id': 'id', 'profile_id': 'profile_id', 'follower_profile_id': 'follower_profile_id', 'timestamp': 'timestamp',
+    }, {'profile_id': 'profile', 'follower_profile_id': 'profile'}),
+    Table('like', Like, {
+        'id': 'id', 'post_id': 'post_id', 'profile_id': 'profile_id', 'timestamp': 'timestamp',
+    }, {'post_id': 'post', 'profile_id': 'profile'}),
+    Table('comment', Comment, {
+        'id': 'id', 'post_id': 'post_id', 'profile_id': 'profile_id', 'timestamp': 'timestamp', 'text': 'text',
+    }, {'post_id': 'post', 'profile_id': 'profile'}),
+    Table('archived_like', ArchivedLike, {
+        'id': 'id', 'post_id': 'post_id', 'profile_id': 'profile_id', 'timestamp': 'timestamp',
+    }, {'post_id': 'post', 'profile_id': 'profile'}),
+    Table('archived_comment', ArchivedComment, {
+        'id': 'id', 'post_id': 'post_id', 'profile_id': 'profile_id', 'timestamp': 'timestamp', 'text': 'text',
+    }, {'post_id': 'post', 'profile_id': 'profile'}),
+]
+
+
+def tables_named(names=None):
+    '''Return the Tables whose names are in names (all of them for None), keeping dependency order'''
+    if not names:
+        return list(TABLES)
+    unknown = set(names) - {table.name for table in TABLES}
+    if unknown:
+        raise ValueError(f'unknown tables: {", ".join(sorted(unknown))}')
+    return [table for table in TABLES if table.name in names]
+
+
+def chunked(iterable, size):
+    '''yield lists of up to size items'''
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+'''
+export
+'''
+
+class ExportEncoder(DjangoJSONEncoder):
+    '''DjangoJSONEncoder, but datetimes keep their microseconds (it rounds them to milliseconds)'''
+
+    def default(self, o):
+        if isinstance(o, datetime):
+            return o.isoformat()
+        return super().default(o)
+
+
+def export_table(table, directory, fmt, chunk_size=2000):
+    '''Stream every row of table into directory/<table>.<fmt> and return the number of rows written
+
+    Rows are read with .iterator(chunk_size), which uses a server-side cursor
+    where the database supports one, so memory use does not grow with the table.
+    '''
+    columns = list(table.columns)
+    rows = table.model.objects.order_by('pk').values_list(*table.columns.values()).iterator(chunk_size=chunk_size)
+
+    count = 0
+    path = os.path.join(directory, table.filename(fmt))
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        if fmt == 'csv':
+            writer = csv.writer(f)
+            writer.writerow(columns)
+            for row in rows:
+                writer.writerow(['' if value is None else value for value in row])
+                count += 1
+        else:
+            encoder = ExportEncoder()
+            for row in rows:
+                f.write(encoder.encode(dict(zip(columns, row))))
+                f.write('\n')
+                count += 1
+    return count
+
+
+'''
+import
+'''
+
+def read_rows(path, fmt):
+    '''yield each row of an exported file as a dict'''
+    with open(path, newline='', encoding='utf-8') as f:
+        if fmt == 'csv':
+            yield from csv.DictReader(f)
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+@contextmanager
+def keep_timestamps(*models):
+    '''Turn off auto_now/auto_now_add on models while importing, so exported timestamps are kept'''
+    changed = []
+    for model in models:
+        for field in model._meta.concrete_fields:
+            if getattr(field, 'auto_now', False) or getattr(field, 'auto_now_add', False):
+                changed.append((field, field.auto_now, field.auto_now_add))
+                field.auto_now = field.auto_now_add = False
+    try:
+        yield
+    finally:
+        for field, auto_now, auto_now_add in changed:
+            field.auto_now, field.auto_now_add = auto_now, auto_now_add
+
+
+class Importer:
+    '''Load exported tables with bulk_create in batches, remapping ids as it goes
+
+    New rows get new primary keys; id_maps remembers {table: {exported id: new id}}
+    so later tables can resolve their foreign keys without querying. Rows whose
+    foreign keys cannot be resolved are skipped and counted. A User has one
+    Profile: a profile whose User has one already is skipped (and counted in
+    present), and so is everything that points at it, so importing the same
+    data twice does not duplicate it.
+    '''
+
+    def __init__(self, batch_size=1000):
+        self.batch_size = batch_size
+        self.id_maps = {table.name: {} for table in TABLES}
+        self.skipped = {table.name: 0 for table in TABLES}
+        self.present = 0 # profiles skipped because their User has a Profile
+
+    def import_table(self, table, path, fmt):
+        '''import one file and return the number of rows created'''
+        created = 0
+        with keep_timestamps(table.model):
+            for batch in chunked(read_rows(path, fmt), self.batch_size):
+                with transaction.atomic():
+                    created += self.import_batch(table, batch)
+        return created
+
+    def import_batch(self, table, batch):
+        old_ids, objects = [], []
+        users, taken = self.resolve_users(batch) if table.name == 'profile' else ({}, set())
+
+        for row in batch:
+            if table.name == 'profile':
+                if users[row['user']] in taken:
+                    self.present += 1
+                    continue
+                taken.add(users[row['user']])
+            fields = {}
+            for column, value in row.items():
+                if column == 'id' or column not in table.columns:
+                    continue
+                if column in table.foreign_keys:
+                    value = self.id_maps[table.foreign_keys[column]].get(int(value))
+                    if value is None:
+                        break # points at a row that was not imported
+                elif column == 'user':
+                    column, value = 'user_id', users[value]
+                fields[column] = value
+            else:
+                old_ids.append(int(row['id']))
+                objects.append(table.model(**fields))
+                continue
+            self.skipped[table.name] += 1
+
+        objects = table.model.objects.bulk_create(objects, batch_size=self.batch_size)
+        self.id_maps[table.name].update(zip(old_ids, (obj.pk for obj in objects)))
+
+        # imported Photos point at existing files without saving them, so count their references here
+        if table.model is Photo:
+            Photo._meta.get_field('image_file').storage.retain_many(obj.image_file.name for obj in objects if obj.image_file)
+        return len(objects)
+
+    def resolve_users(self, batch):
+        '''Return ({username: User pk}, pks of those Users that have a Profile) for a batch of profiles
+
+        Missing Users are created without a usable password.
+        '''
+        usernames = {row['user'] for row in batch}
+        users = dict(User.objects.filter(username__in=usernames).values_list('username', 'pk'))
+        taken = set(Profile.objects.filter(user__in=users.values()).values_list('user_id', flat=True))
+        missing = [User(username=username, password='!') for username in usernames - users.keys()]
+        for user in User.objects.bulk_create(missing):
+            users[user.username] = user.pk
+        return users, taken
+
+    def finish(self):
+        '''Derived data is not maintained row by row during the import; bring it up to date once at the end'''
+        # like counts and most recent likers are cached per post
+        like_summary.invalidate(self.id_maps['post'].values())
+
+        # hashtags and mentions of the imported captions and comments
+        tags.index_post_ids(self.id_maps['post'].values(), self.batch_size)
+
+        # refresh the query planner's statistics for the freshly loaded tables
+        if connection.vendor in ('sqlite', 'postgresql'):
+            with connection.cursor() as cursor:
+                cursor.execute('ANALYZE')
@@ -0,0 +1,57 @@
+# File: mini_insta/checks.py
+# system checks for settings the app relies on for speed
+# Author: Nguyen Le
+
+
+from django.conf import settings
+from django.core.checks import Warning, register
+
+CACHED_LOADER = 'django.template.loaders.cached.Loader'
+
+# cache backends whose entries are only seen by the process that wrote them
+PROCESS_LOCAL_CACHES = {'django.core.cache.backends.locmem.LocMemCache', 'django.core.cache.backends.dummy.DummyCache'}
+
+
+@register()
+def check_cached_template_loader(app_configs, **kwargs):
+    '''Warn when templates are configured with explicit loaders that bypass the cached loader
+
+    Without it every render re-reads and re-compiles the feed and card
+    templates from disk. Django adds the cached loader itself when no loaders
+    are given, so only an explicit 'loaders' option is checked.
+    '''
+    errors = []
+    for backend in settings.TEMPLATES:
+        if backend.get('BACKEND') != 'django.template.backends.django.DjangoTemplates':
+            continue
+        loaders = backend.get('OPTIONS', {}).get('loaders')
+        if loaders is None:
+            continue
+        names = [loader[0] if isinstance(loader, (list, tuple)) else loader for loader in loaders]
+        if CACHED_LOADER not in names:
+            errors.append(Warning(
+                'Templates are loaded without the cached template loader.',
+                hint=f"Wrap the loaders in ('{CACHED_LOADER}', [...]) or remove the 'loaders' option.",
+                id='mini_insta.W001',
+            ))
+    return errors
+
+
+@register(deploy=True)
+def check_shared_cache(app_configs, **kwargs):
+    '''Warn (with check --deploy) when likes and follows are buffered but the default cache is not shared between processes
+
+    The write buffer keeps toggles in the process that received them for
+    MINI_INSTA_WRITE_BUFFER_WINDOW seconds, and publishes them in the cache so
+    requests served by other processes see them too.
+    '''
+    window = getattr(settings, 'MINI_INSTA_WRITE_BUFFER_WINDOW', 0)
+    backend = settings.CACHES.get('default', {}).get('BACKEND')
+    if window > 0 and backend in PROCESS_LOCAL_CACHES:
+        return [Warning(
+            'Buffered likes and follows are published in a cache that other processes cannot read.',
+            hint='Use a shared cache (Redis, Memcached or the database cache) with several worker processes, '
+                 'or set MINI_INSTA_WRITE_BUFFER_WINDOW = 0 to write toggles immediately.',
+            id='mini_insta.W002',
+        )]
+    return []
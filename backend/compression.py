@@ -0,0 +1,195 @@
+# File: mini_insta/compression.py
+# negotiated gzip/brotli/zstd compression of API responses, chunk by chunk for streaming responses
+# Author: Nguyen Le
+#
+# Needs the middleware (see README), close to the top so it sees the final response:
+#
+#     MIDDLEWARE.insert(0, 'mini_insta.compression.CompressionMiddleware')
+#
+# brotli and zstd are offered only when the brotli and zstandard packages are installed.
+
+
+import time
+import zlib
+from itertools import chain
+
+from django.conf import settings
+from django.utils.cache import patch_vary_headers
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# responses smaller than this many bytes are sent as they are: compressing them saves less than it costs
+MIN_SIZE = getattr(settings, 'MINI_INSTA_COMPRESS_MIN_SIZE', 1024)
+
+# levels for compressing on the fly: past these, each step costs much more CPU for a few percent fewer bytes
+DEFAULT_LEVELS = {'zstd': 3, 'br': 4, 'gzip': 5}
+
+# only JSON and plain text by default; HTML pages carry CSRF tokens next to reflected input, which compression
+# can leak (BREACH), so add 'text/html' only knowingly
+CONTENT_TYPES = getattr(settings, 'MINI_INSTA_COMPRESS_CONTENT_TYPES', ('application/json', 'text/plain', 'text/csv'))
+
+
+class GzipStream:
+    '''gzip compressor: compress() returns what can be sent so far, finish() the rest'''
+
+    def __init__(self, level):
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS) # gzip header and trailer
+
+    def compress(self, data):
+        # the sync flush ends each chunk on a byte boundary, so the client can decode every chunk as it arrives
+        return self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self.compressor.flush()
+
+
+class BrotliStream:
+    '''brotli compressor, same interface as GzipStream'''
+
+    def __init__(self, level):
+        self.compressor = brotli.Compressor(quality=level)
+
+    def compress(self, data):
+        return self.compressor.process(data) + self.compressor.flush()
+
+    def finish(self):
+        return self.compressor.finish()
+
+
+class ZstdStream:
+    '''zstd compressor, same interface as GzipStream'''
+
+    def __init__(self, level):
+        self.compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data):
+        return self.compressor.compress(data) + self.compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self):
+        return self.compressor.flush()
+
+
+# Content-Encoding: compressor, most preferred first (zstd and brotli compress better than gzip at the same CPU cost)
+CODECS = {'gzip': GzipStream}
+if brotli is not None:
+    CODECS = {'br': BrotliStream, **CODECS}
+if zstandard is not None:
+    CODECS = {'zstd': ZstdStream, **CODECS}
+
+
+def get_level(encoding):
+    '''compression level of encoding; override with MINI_INSTA_COMPRESS_LEVELS = {'gzip': 6}'''
+    return getattr(settings, 'MINI_INSTA_COMPRESS_LEVELS', {}).get(encoding, DEFAULT_LEVELS[encoding])
+
+
+def parse_accept_encoding(header):
+    '''Return {coding: q} of an Accept-Encoding header, e.g. "gzip, br;q=0.8"'''
+    accepted = {}
+    for item in header.split(','):
+        coding, _, params = item.strip().partition(';')
+        q = 1.0
+        for param in params.split(';'):
+            name, _, value = param.strip().partition('=')
+            if name == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if coding:
+            accepted[coding.strip().lower()] = q
+    return accepted
+
+
+def negotiate(header):
+    '''Return the Content-Encoding to use for a request's Accept-Encoding header, or None to send it as it is'''
+    accepted = parse_accept_encoding(header or '')
+    for encoding in CODECS:
+        if accepted.get(encoding, accepted.get('*', 0)) > 0:
+            return encoding
+    return None
+
+
+def compress_chunks(chunks, encoding, level=None):
+    '''yield chunks compressed with encoding, each one flushed so it can be decoded as soon as it arrives'''
+    compressor = CODECS[encoding](get_level(encoding) if level is None else level)
+    for chunk in chunks:
+        if chunk:
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+    yield compressor.finish()
+
+
+def compressible(response):
+    '''whether response is of a type worth compressing, and not compressed already'''
+    if response.has_header('Content-Encoding') or not 200 <= response.status_code < 300:
+        return False
+    content_type = response.get('Content-Type', '').split(';')[0].strip()
+    return content_type in CONTENT_TYPES
+
+
+def peek(chunks, size):
+    '''Read chunks until size bytes are buffered; return (buffered chunks, whether there may be more)'''
+    buffered, total = [], 0
+    for chunk in chunks:
+        buffered.append(chunk)
+        total += len(chunk)
+        if total >= size:
+            return buffered, True
+    return buffered, False
+
+
+class CompressionMiddleware:
+    '''Compress responses with the best encoding the client accepts
+
+    Regular responses are compressed when at least MINI_INSTA_COMPRESS_MIN_SIZE
+    bytes long. Streaming responses (see api_views.stream_posts) are compressed
+    chunk by chunk as they are produced: the start of the stream is read first,
+    and one that ends before the minimum size is sent uncompressed.
+    '''
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        patch_vary_headers(response, ('Accept-Encoding',))
+        if not compressible(response):
+            return response
+        encoding = negotiate(request.META.get('HTTP_ACCEPT_ENCODING'))
+        if encoding is None:
+            return response
+
+        if response.streaming:
+            chunks = iter(response.streaming_content)
+            head, more = peek(chunks, MIN_SIZE)
+            if not more:
+                response.streaming_content = head
+                return response
+            response.streaming_content = compress_chunks(chain(head, chunks), encoding)
+        else:
+            if len(response.content) < MIN_SIZE:
+                return response
+            response.content = b''.join(compress_chunks([response.content], encoding))
+            response['Content-Length'] = str(len(response.content))
+
+        response['Content-Encoding'] = encoding
+        # the compressed body differs from the uncompressed one, so must its validator
+        if response.has_header('ETag'):
+            response['ETag'] = response['ETag'].rstrip('"') + f'-{encoding}"'
+        return response
+
+
+def measure(chunks, encoding, level=None):
+    '''Compress chunks as the middleware would; return (compressed bytes, CPU seconds)'''
+    start = time.process_time()
+    size = sum(len(data) for data in compress_chunks(chunks, encoding, level))
+    return size, time.process_time() - start
@@ -0,0 +1,171 @@
+# File: mini_insta/db_router.py
+# send read-only traffic to replica databases, keeping a user's reads on the primary right after they write
+# Author: Nguyen Le
+#
+# Local setup with two SQLite files (see README):
+#
+#     DATABASES = replica_databases(
+#         {'ENGINE': 'django.db.backends.sqlite3', 'NAME': BASE_DIR / 'db.sqlite3'},
+#         {'replica': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': BASE_DIR / 'db-replica.sqlite3'}},
+#     )
+#     DATABASE_ROUTERS = ['mini_insta.db_router.PrimaryReplicaRouter']
+#     MIDDLEWARE += ['mini_insta.db_router.ReplicaRoutingMiddleware']
+#
+# This module is imported from settings, so it must not touch django.conf.settings at import time.
+
+
+import contextvars
+import random
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+# per request (or per thread of a management command) routing state
+_replicas_allowed = contextvars.ContextVar('mini_insta_replicas_allowed', default=False)
+_wrote = contextvars.ContextVar('mini_insta_wrote', default=False)
+
+# cookie holding the time until which a client's reads stay on the primary
+PIN_COOKIE = 'mini_insta_primary_until'
+
+
+def replica_databases(primary, replicas, conn_max_age=600, pool=True):
+    '''Build a DATABASES dict with a primary ("default") and replica aliases, with connection reuse turned on
+
+    PostgreSQL aliases use Django's built-in psycopg connection pool when pool is
+    True; every other backend keeps persistent connections for conn_max_age
+    seconds. Replicas mirror the primary in tests, so test data is visible to them.
+    '''
+    def configure(db):
+        db = dict(db)
+        db.setdefault('CONN_HEALTH_CHECKS', True)
+        if pool and 'postgresql' in db['ENGINE']:
+            db['CONN_MAX_AGE'] = 0 # persistent connections and pooling are mutually exclusive
+            db.setdefault('OPTIONS', {}).setdefault('pool', True)
+        else:
+            db.setdefault('CONN_MAX_AGE', conn_max_age)
+        return db
+
+    databases = {DEFAULT_DB_ALIAS: configure(primary)}
+    for alias, replica in replicas.items():
+        replica = configure(replica)
+        replica.setdefault('TEST', {}).setdefault('MIRROR', DEFAULT_DB_ALIAS)
+        databases[alias] = replica
+    return databases
+
+
+def replica_aliases():
+    '''Return the configured replica aliases: MINI_INSTA_DATABASE_REPLICAS, or every alias but the primary'''
+    aliases = getattr(settings, 'MINI_INSTA_DATABASE_REPLICAS', None)
+    if aliases is None:
+        aliases = [alias for alias in settings.DATABASES if alias != DEFAULT_DB_ALIAS]
+    return aliases
+
+
+@contextmanager
+def replica_reads():
+    '''Allow reads inside this block to go to a replica (the middleware does this for safe requests)'''
+    allowed, wrote = _replicas_allowed.set(True), _wrote.set(False)
+    try:
+        yield
+    finally:
+        _replicas_allowed.reset(allowed)
+        _wrote.reset(wrote)
+
+
+@contextmanager
+def primary_reads():
+    '''Force reads inside this block to the primary, e.g. right before a write that depends on them'''
+    allowed = _replicas_allowed.set(False)
+    try:
+        yield
+    finally:
+        _replicas_allowed.reset(allowed)
+
+
+def keep_routing(iterable):
+    '''Iterate iterable with the routing state of the current request, e.g. a StreamingHttpResponse body
+
+    The server reads a streaming body after the middleware has returned and reset
+    the routing state, so without this its queries would always go to the primary.
+    The state is captured here, when the response is built, not on first iteration.
+    '''
+    allowed, wrote = _replicas_allowed.get(), _wrote.get()
+
+    def iterate():
+        nonlocal wrote
+        iterator = iter(iterable)
+        while True:
+            allowed_token, wrote_token = _replicas_allowed.set(allowed), _wrote.set(wrote)
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                wrote = _wrote.get()
+                _replicas_allowed.reset(allowed_token)
+                _wrote.reset(wrote_token)
+            yield item
+
+    return iterate()
+
+
+class PrimaryReplicaRouter:
+    '''Database router: writes go to the primary, reads go to a random replica when allowed
+
+    Reads stay on the primary when replicas are not allowed for the current
+    request, after anything has been written in it, and inside transactions.
+    '''
+
+    def db_for_read(self, model, **hints):
+        if not _replicas_allowed.get() or _wrote.get():
+            return DEFAULT_DB_ALIAS
+        if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        aliases = replica_aliases()
+        return random.choice(aliases) if aliases else DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        _wrote.set(True)
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # replicas hold the same data as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # replicas receive their schema through replication
+        return db == DEFAULT_DB_ALIAS
+
+
+class ReplicaRoutingMiddleware:
+    '''Allow replica reads for GET/HEAD requests, except for clients that wrote in the last few seconds
+
+    After a request writes (or any POST), the client gets a cookie pinning its
+    reads to the primary for MINI_INSTA_PRIMARY_PIN_SECONDS, so it reads its
+    own writes even while replicas lag behind.
+    '''
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.pin_seconds = getattr(settings, 'MINI_INSTA_PRIMARY_PIN_SECONDS', 5)
+
+    def __call__(self, request):
+        try:
+            pinned = float(request.COOKIES.get(PIN_COOKIE, 0)) > time.time()
+        except ValueError:
+            pinned = False
+
+        safe = request.method in ('GET', 'HEAD')
+        allowed = _replicas_allowed.set(safe and not pinned)
+        wrote = _wrote.set(False)
+        try:
+            response = self.get_response(request)
+            if _wrote.get() or not safe:
+                until = time.time() + self.pin_seconds
+                response.set_cookie(PIN_COOKIE, f'{until:.0f}', max_age=self.pin_seconds, httponly=True, samesite='Lax')
+        finally:
+            _replicas_allowed.reset(allowed)
+            _wrote.reset(wrote)
+        return response
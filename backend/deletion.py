@@ -0,0 +1,159 @@
+# File: mini_insta/deletion.py
+# delete Posts and Profiles with a large fan-out in bounded batches, off the request path
+# Author: Nguyen Le
+
+
+import logging
+from collections import Counter
+
+from django.conf import settings
+from django.db import models, router, transaction
+from django.utils import timezone
+
+from . import archive, fragments, like_summary, object_cache, tasks
+from .models import ArchivedComment, ArchivedLike, Comment, Like, Photo, Post
+from .taskqueue import enqueue
+
+logger = logging.getLogger(__name__)
+
+# rows deleted per statement
+BATCH_SIZE = getattr(settings, 'MINI_INSTA_DELETE_BATCH_SIZE', 1000)
+
+# shared placeholder image used by every Post without an upload, never deleted
+DEFAULT_IMAGE = 'default.png'
+
+
+def delete_post(post):
+    '''Hide a Post right away and purge it with all its dependents in the background
+
+    The request only pays for one UPDATE, however many photos, comments and
+    likes the Post has accumulated.
+    '''
+    Post.all_objects.filter(pk=post.pk).update(deleted_at=timezone.now())
+    object_cache.invalidate(object_cache.POST, [post.pk])
+    enqueue(tasks.purge_posts, post_ids=[post.pk], idempotency_key=f'purge_post:{post.pk}')
+
+
+def delete_profile(profile):
+    '''Hide a Profile's Posts right away and purge the Profile and its whole graph in the background'''
+    delete_profiles([profile.pk], idempotency_key=f'purge_profile:{profile.pk}')
+
+
+def delete_posts(post_ids):
+    '''Hide many Posts with one UPDATE and purge them in the background with one task (e.g. an admin action)'''
+    Post.all_objects.filter(pk__in=post_ids).update(deleted_at=timezone.now())
+    object_cache.invalidate(object_cache.POST, post_ids)
+    enqueue(tasks.purge_posts, post_ids=list(post_ids))
+
+
+def delete_profiles(profile_ids, idempotency_key=None):
+    '''Hide the Posts of many Profiles with one UPDATE and purge the Profiles in the background with one task'''
+    Post.objects.filter(profile__in=profile_ids).update(deleted_at=timezone.now())
+    object_cache.invalidate(object_cache.PROFILE, profile_ids)
+    # and the cached copies of their Posts, which embed the Profile
+    post_ids = Post.all_objects.filter(profile__in=profile_ids).values_list('pk', flat=True)
+    object_cache.invalidate(object_cache.POST, list(post_ids))
+    enqueue(tasks.purge_profiles, profile_ids=list(profile_ids), idempotency_key=idempotency_key)
+
+
+def pk_batches(queryset, batch_size=BATCH_SIZE):
+    '''Yield the pks of queryset in ascending lists of up to batch_size, one indexed range query per list'''
+    queryset = queryset.order_by('pk')
+    last = None
+    while True:
+        batch = queryset if last is None else queryset.filter(pk__gt=last)
+        pks = list(batch.values_list('pk', flat=True)[:batch_size])
+        if not pks:
+            return
+        yield pks
+        last = pks[-1]
+
+
+def forget_derived(model, batch, using):
+    '''Keep what is computed from the rows of batch correct once they are deleted, in the transaction deleting them'''
+    if model is Like:
+        # cached like counts and most recent likers of the Posts the Likes were on
+        post_ids = set(batch.values_list('post_id', flat=True))
+        transaction.on_commit(lambda: like_summary.invalidate(post_ids), using=using)
+    elif model is Comment:
+        # cached comment lists of the Posts the Comments were on
+        post_ids = set(batch.values_list('post_id', flat=True))
+        transaction.on_commit(lambda: fragments.bump_versions(post_ids), using=using)
+    elif model is ArchivedLike or model is ArchivedComment:
+        # archived rows are counted on their Post (see archive.py), and the counts are cached with the likes line or comments
+        counts = Counter(batch.values_list('post_id', flat=True))
+        counter = 'archived_like_count' if model is ArchivedLike else 'archived_comment_count'
+        archive.add_counts({post_id: -n for post_id, n in counts.items()}, counter)
+        invalidate = like_summary.invalidate if model is ArchivedLike else fragments.bump_versions
+        transaction.on_commit(lambda: invalidate(set(counts)), using=using)
+
+
+def delete_in_batches(queryset, batch_size=BATCH_SIZE, file_names=None):
+    '''Delete every row of queryset and, recursively, every row that cascades from it
+
+    Works like Django's CASCADE collector, but never holds more than
+    batch_size primary keys in memory and deletes with plain DELETE statements
+    (no per-object signals). Children are removed before their parents so
+    foreign keys hold at every step; the rows being deleted are expected to be
+    hidden already (see delete_post), so nothing new points at them meanwhile.
+    Caches and counters derived from the deleted rows are updated by forget_derived.
+    Image files of deleted Photos are counted in file_names (a Counter), once
+    per Photo. Returns the number of rows deleted.
+    '''
+    model = queryset.model
+    using = router.db_for_write(model)
+    deleted = 0
+
+    while True:
+        pks = list(queryset.using(using).order_by().values_list('pk', flat=True)[:batch_size])
+        if not pks:
+            return deleted
+
+        # dependents first, each in their own batches, so no transaction grows with the fan-out
+        for relation in model._meta.related_objects:
+            if relation.many_to_many:
+                continue
+            children = relation.related_model._base_manager.filter(**{f'{relation.field.name}__in': pks})
+            if relation.on_delete is models.CASCADE:
+                deleted += delete_in_batches(children, batch_size, file_names)
+            elif relation.on_delete is models.SET_NULL:
+                children.update(**{relation.field.name: None})
+
+        with transaction.atomic(using=using):
+            batch = model._base_manager.using(using).filter(pk__in=pks)
+            if model is Photo and file_names is not None:
+                file_names.update(name for name in batch.values_list('image_file', flat=True) if name)
+            forget_derived(model, batch, using)
+            deleted += batch._raw_delete(using)
+
+
+def purge(queryset):
+    '''Delete queryset and its dependents in batches, then queue release of the image files the deleted Photos used'''
+    file_names = Counter()
+    deleted = delete_in_batches(queryset, file_names=file_names)
+    del file_names[DEFAULT_IMAGE]
+    if file_names:
+        enqueue(tasks.delete_orphaned_files, names=sorted(file_names.elements()))
+    return deleted
+
+
+def delete_orphaned_files(names):
+    '''Give up the image files of deleted Photos, one entry in names per deleted Photo
+
+    Content-addressed blobs lose one reference per entry and are removed when
+    none are left (see storage.py). Files saved before that are removed unless
+    a remaining Photo still points at them.
+    '''
+    storage = Photo._meta.get_field('image_file').storage
+    counts = Counter(names)
+    del counts[DEFAULT_IMAGE]
+    legacy = [name for name in counts if not storage.is_blob(name)]
+    in_use = set(Photo.objects.filter(image_file__in=legacy).values_list('image_file', flat=True))
+    for name, count in counts.items():
+        try:
+            if storage.is_blob(name):
+                storage.release(name, count)
+            elif name not in in_use:
+                storage.delete(name)
+        except OSError:
+            logger.warning('could not delete orphaned image %s', name, exc_info=True)
@@ -0,0 +1,110 @@
+# File: mini_insta/fragments.py
+# cached HTML fragments for post cards, so unchanged posts are not re-rendered (or re-queried)
+# Author: Nguyen Le
+
+
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Prefetch, prefetch_related_objects
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
+
+from .models import Comment
+
+# how long a rendered fragment may be reused; keys change whenever the post changes, so this only bounds memory
+FRAGMENT_TIMEOUT = getattr(settings, 'MINI_INSTA_FRAGMENT_TIMEOUT', 60 * 60)
+
+# fragments of a post card, and the template each one is rendered from
+CARD = 'card' # header, photos, likes line and caption
+COMMENTS = 'comments'
+TEMPLATES = {
+    CARD: 'mini_insta/_post_card.html',
+    COMMENTS: 'mini_insta/_post_comments.html',
+}
+
+
+def version_key(post_id):
+    '''cache key of the version of a post's photos and comments'''
+    return f'mini_insta:post_version:{post_id}'
+
+
+def bump_versions(post_ids):
+    '''Invalidate the cached fragments of posts whose photos or comments changed'''
+    version = time.time_ns()
+    cache.set_many({version_key(post_id): version for post_id in post_ids}, None)
+
+
+def profile_version_key(profile_id):
+    '''cache key of the version of a profile's username and picture'''
+    return f'mini_insta:profile_version:{profile_id}'
+
+
+def bump_profile_version(profile_id):
+    '''Invalidate the cached fragments showing a profile that was edited
+
+    That is the cards of its posts, and the comment lists of the posts it commented on.
+    '''
+    cache.set(profile_version_key(profile_id), time.time_ns(), None)
+    bump_versions(set(Comment.objects.filter(profile_id=profile_id).values_list('post_id', flat=True)))
+
+
+def fragment_key(part, post, version, profile_version=0):
+    '''Return the cache key of one fragment of a post
+
+    The card depends on the caption (post.timestamp changes on every edit),
+    the photos, the likes line and the author's profile version; the comments
+    only on the version.
+    Nothing viewer specific is cached, so every viewer shares the fragments.
+    '''
+    parts = [part, post.pk, version]
+    if part == CARD:
+        summary = post.like_summary
+        parts += [post.timestamp.isoformat(), summary.count, summary.recent_username, post.profile_id, profile_version]
+    raw = ':'.join(str(p) for p in parts)
+    return f'mini_insta:fragment:{hashlib.md5(raw.encode()).hexdigest()}'
+
+
+def attach_fragments(posts, parts=(CARD, COMMENTS)):
+    '''Set post.<part>_html on each Post, from the cache where possible
+
+    Posts need like_summary attached already (see like_summary.attach_like_summaries)
+    and their profile selected. Only the posts whose fragments were missing have
+    their photos and comments loaded, in two queries, and are rendered.
+    Returns the list of posts.
+    '''
+    posts = list(posts)
+    versions = cache.get_many(
+        [version_key(post.pk) for post in posts] + [profile_version_key(post.profile_id) for post in posts]
+    )
+
+    keys = {
+        (post.pk, part): fragment_key(
+            part, post, versions.get(version_key(post.pk), 0), versions.get(profile_version_key(post.profile_id), 0),
+        )
+        for post in posts for part in parts
+    }
+    cached = cache.get_many(list(keys.values()))
+
+    misses = [post for post in posts if any(keys[(post.pk, part)] not in cached for part in parts)]
+    if misses:
+        prefetch_related_objects(
+            misses,
+            'photo_set',
+            Prefetch('comment_set', queryset=Comment.objects.select_related('profile').order_by('-timestamp')),
+        )
+        rendered = {}
+        for post in misses:
+            for part in parts:
+                key = keys[(post.pk, part)]
+                if key not in cached:
+                    rendered[key] = render_to_string(TEMPLATES[part], {'post': post})
+        cache.set_many(rendered, FRAGMENT_TIMEOUT)
+        cached.update(rendered)
+
+    for post in posts:
+        for part in parts:
+            setattr(post, f'{part}_html', mark_safe(cached[keys[(post.pk, part)]]))
+    return posts
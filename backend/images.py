@@ -0,0 +1,236 @@
+# File: mini_insta/images.py
+# on-the-fly image resizing with a size-bounded on-disk LRU cache
+# Author: Nguyen Le
+
+
+import hashlib
+import os
+import threading
+import urllib.request
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.utils.module_loading import import_string
+from PIL import Image, ImageOps
+
+
+# widths a client may ask for, requested widths are snapped up to one of these
+# so that arbitrary ?w= values cannot fill the cache with near-duplicates
+RENDITION_WIDTHS = getattr(settings, 'MINI_INSTA_RENDITION_WIDTHS', (160, 320, 640, 1080))
+
+# output formats we can encode, mapped to their content type
+RENDITION_FORMATS = {
+    'webp': 'image/webp',
+    'jpeg': 'image/jpeg',
+    'png': 'image/png',
+}
+
+# where renditions are written and how much disk they may use in total
+RENDITION_CACHE_DIR = getattr(
+    settings, 'MINI_INSTA_RENDITION_CACHE_DIR',
+    os.path.join(str(settings.MEDIA_ROOT or '.'), 'renditions'),
+)
+RENDITION_CACHE_MAX_BYTES = getattr(settings, 'MINI_INSTA_RENDITION_CACHE_MAX_BYTES', 512 * 1024 * 1024)
+
+# encoder quality for lossy formats
+RENDITION_QUALITY = getattr(settings, 'MINI_INSTA_RENDITION_QUALITY', 80)
+
+# legacy image_url photos are downloaded once into default_storage under this prefix
+LEGACY_IMAGE_PREFIX = 'legacy_images'
+LEGACY_IMAGE_MAX_BYTES = getattr(settings, 'MINI_INSTA_LEGACY_IMAGE_MAX_BYTES', 20 * 1024 * 1024)
+
+# dotted path of the callable used to download legacy images, tests point this at a local stand-in
+LEGACY_IMAGE_FETCHER = getattr(settings, 'MINI_INSTA_LEGACY_IMAGE_FETCHER', 'mini_insta.images.fetch_url')
+
+
+def fetch_url(url):
+    '''Download the bytes of a remote image, refusing anything larger than LEGACY_IMAGE_MAX_BYTES'''
+    with urllib.request.urlopen(url, timeout=10) as response:
+        data = response.read(LEGACY_IMAGE_MAX_BYTES + 1)
+    if len(data) > LEGACY_IMAGE_MAX_BYTES:
+        raise ValueError(f'remote image at {url} is larger than {LEGACY_IMAGE_MAX_BYTES} bytes')
+    return data
+
+
+def snap_width(width):
+    '''Return the smallest allowed rendition width that is >= width (or the largest one)'''
+    for allowed in sorted(RENDITION_WIDTHS):
+        if width <= allowed:
+            return allowed
+    return max(RENDITION_WIDTHS)
+
+
+class RenditionCache:
+    '''A directory of rendered images bounded by total size, evicting the least recently used files.
+
+    Recency is tracked with the file mtime, which is bumped on every hit, so the
+    cache survives restarts and is shared between worker processes on one host.
+    '''
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._approx_size = None # lazily computed, then kept up to date on writes
+
+    def path_for(self, key):
+        '''Return the on-disk path for a cache key, sharded by the first two hex digits'''
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key):
+        '''Return the path of a cached rendition and mark it as recently used, or None on a miss'''
+        path = self.path_for(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def put(self, key, data):
+        '''Atomically store data under key, evicting old entries when over budget, and return its path'''
+        path = self.path_for(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # write to a temporary file first so readers never see a partial image
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            if self._approx_size is None:
+                self._approx_size = self._scan_size()
+            else:
+                self._approx_size += len(data)
+            if self._approx_size > self.max_bytes:
+                self._evict()
+        return path
+
+    def _entries(self):
+        '''Yield (mtime, size, path) for every file in the cache'''
+        for root, _dirs, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue # evicted by another process
+                yield stat.st_mtime, stat.st_size, path
+
+    def _scan_size(self):
+        return sum(size for _mtime, size, _path in self._entries())
+
+    def _evict(self):
+        '''Remove least recently used files until the cache is back under 90% of its budget'''
+        entries = sorted(self._entries())
+        total = sum(size for _mtime, size, _path in entries)
+        target = int(self.max_bytes * 0.9)
+        for _mtime, size, path in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        self._approx_size = total
+
+
+rendition_cache = RenditionCache(RENDITION_CACHE_DIR, RENDITION_CACHE_MAX_BYTES)
+
+
+def legacy_image_name(photo):
+    '''Return the default_storage name that a legacy image_url photo is downloaded to'''
+    digest = hashlib.sha1(photo.image_url.encode()).hexdigest()
+    return f'{LEGACY_IMAGE_PREFIX}/{digest[:2]}/{digest}'
+
+
+def open_source_image(photo):
+    '''Return an open binary file with the original image of a Photo.
+
+    Legacy image_url photos are fetched once and kept in default_storage, so
+    later renditions of the same photo never go back to the remote host.
+    '''
+    if photo.image_url:
+        name = legacy_image_name(photo)
+        if not default_storage.exists(name):
+            fetch = import_string(LEGACY_IMAGE_FETCHER)
+            name = default_storage.save(name, ContentFile(fetch(photo.image_url)))
+        return default_storage.open(name, 'rb')
+
+    photo.image_file.open('rb')
+    return photo.image_file
+
+
+def rendition_key(photo, width, fmt):
+    '''Return the cache key of a rendition.
+
+    The key depends on the source image rather than the Photo row, so Photos
+    sharing one file (e.g. every post without an upload uses default.png) share
+    their renditions too. Storage never reuses a name for different content.
+    '''
+    source = photo.image_url or photo.image_file.name
+    raw = f'{source}:{width}:{fmt}'
+    return f'{hashlib.sha1(raw.encode()).hexdigest()}.{fmt}'
+
+
+def render_image(source, width, fmt):
+    '''Resize an open image file to at most width pixels wide and encode it as fmt'''
+    with Image.open(source) as image:
+        image = ImageOps.exif_transpose(image)
+
+        # never upscale, keep the aspect ratio
+        if image.width > width:
+            height = max(1, round(image.height * width / image.width))
+            image = image.resize((width, height), Image.LANCZOS)
+
+        # JPEG has no alpha channel or palette
+        if fmt == 'jpeg' and image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+
+        out = BytesIO()
+        options = {'quality': RENDITION_QUALITY} if fmt in ('webp', 'jpeg') else {'optimize': True}
+        image.save(out, format=fmt.upper(), **options)
+        return out.getvalue()
+
+
+# errors of a source image that cannot be loaded or rendered (missing, unreadable, or too many pixels to decode safely)
+RENDITION_ERRORS = (OSError, ValueError, Image.DecompressionBombError)
+
+
+def rendition_etag(photo, width, fmt):
+    '''Return the ETag of a rendition, without rendering it'''
+    return f'"{rendition_key(photo, snap_width(width), fmt).split(".")[0]}"'
+
+
+def get_rendition(photo, width, fmt):
+    '''Return (path, etag) of a rendition of photo, rendering and caching it on a miss'''
+    width = snap_width(width)
+    key = rendition_key(photo, width, fmt)
+    etag = rendition_etag(photo, width, fmt)
+
+    path = rendition_cache.get(key)
+    if path is None:
+        source = open_source_image(photo)
+        try:
+            data = render_image(source, width, fmt)
+        finally:
+            source.close()
+        path = rendition_cache.put(key, data)
+    return path, etag
+
+
+def open_rendition(photo, width, fmt):
+    '''Return (open binary file, etag) of a rendition of photo
+
+    A rendition evicted by another process between being found and being
+    opened is rendered again.
+    '''
+    try:
+        path, etag = get_rendition(photo, width, fmt)
+        return open(path, 'rb'), etag
+    except FileNotFoundError:
+        path, etag = get_rendition(photo, width, fmt)
+        return open(path, 'rb'), etag
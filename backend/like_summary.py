@@ -0,0 +1,100 @@
+# File: mini_insta/like_summary.py
+# "Liked by @x and N others" for a whole page of Posts in one or two queries
+# Author: Nguyen Le
+
+
+from dataclasses import dataclass
+
+from django.core.cache import cache
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from . import write_buffer
+from .models import ArchivedLike, Like, Post
+
+# cached (count, most recent liker) per Post, cleared whenever its likes change
+CACHE_TIMEOUT = 10 * 60
+
+
+@dataclass
+class LikeSummary:
+    '''The likes line of one Post, as seen by one viewer'''
+
+    count: int = 0
+    recent_username: str = '' # username of the most recent liker
+    liked: bool = False # whether the viewer likes this Post
+
+    @property
+    def others(self):
+        '''number of likers besides the most recent one'''
+        return max(0, self.count - 1)
+
+    def as_dict(self):
+        return {'count': self.count, 'recent_username': self.recent_username, 'liked': self.liked, 'others': self.others}
+
+
+def cache_key(post_id):
+    '''cache key of the viewer-independent part of a Post's LikeSummary'''
+    return f'mini_insta:like_summary:{post_id}'
+
+
+def invalidate(post_ids):
+    '''Forget the cached summaries of Posts whose likes changed'''
+    cache.delete_many([cache_key(post_id) for post_id in post_ids])
+
+
+def get_like_summaries(posts, viewer=None):
+    '''Return {post pk: LikeSummary} for an iterable of Posts (or Post pks)
+
+    Counts and most recent likers come from the cache, and the misses are
+    computed in a single annotated query. Whether viewer (a Profile) likes each
+    Post takes one more query, plus any likes still in the write buffer.
+    '''
+    post_ids = [getattr(post, 'pk', post) for post in posts]
+    if not post_ids:
+        return {}
+
+    cached = cache.get_many([cache_key(post_id) for post_id in post_ids])
+    totals = {post_id: cached[cache_key(post_id)] for post_id in post_ids if cache_key(post_id) in cached}
+
+    missing = [post_id for post_id in post_ids if post_id not in totals]
+    if missing:
+        most_recent = Like.objects.filter(post=OuterRef('pk')).order_by('-timestamp').values('profile__username')[:1]
+        most_recent_archived = ArchivedLike.objects.filter(post=OuterRef('pk')).order_by('-timestamp').values('profile__username')[:1]
+        rows = Post.objects.filter(pk__in=missing).annotate(
+            num_likes=Count('like__profile', distinct=True),
+            recent_username=Coalesce(Subquery(most_recent), Subquery(most_recent_archived)),
+        ).values_list('pk', 'num_likes', 'archived_like_count', 'recent_username')
+        computed = {pk: (num_likes + archived, recent_username or '') for pk, num_likes, archived, recent_username in rows}
+        cache.set_many({cache_key(pk): value for pk, value in computed.items()}, CACHE_TIMEOUT)
+        totals.update(computed)
+
+    summaries = {post_id: LikeSummary(*totals.get(post_id, (0, ''))) for post_id in post_ids}
+
+    if viewer is not None:
+        liked = Like.objects.filter(post_id__in=post_ids, profile=viewer).values_list('post_id', flat=True)
+        archived = ArchivedLike.objects.filter(post_id__in=post_ids, profile=viewer).values_list('post_id', flat=True)
+        stored = set(liked.union(archived))
+        for post_id in stored:
+            summaries[post_id].liked = True
+
+        # the viewer's own likes/unlikes that are still in the write buffer (read-your-writes)
+        for post_id, state in write_buffer.pending_likes(viewer.pk, post_ids).items():
+            summary = summaries[post_id]
+            if state and post_id not in stored:
+                summary.count += 1
+                summary.recent_username = viewer.username
+            elif not state and post_id in stored:
+                summary.count -= 1
+            summary.liked = state
+
+    return summaries
+
+
+def attach_like_summaries(posts, viewer=None):
+    '''Set post.like_summary on every Post of a list (for templates) and return the list'''
+    posts = list(posts)
+    summaries = get_like_summaries(posts, viewer)
+    for post in posts:
+        post.like_summary = summaries[post.pk]
+    return posts
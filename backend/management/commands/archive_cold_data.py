@@ -0,0 +1,35 @@
+# File: mini_insta/management/commands/archive_cold_data.py
+# periodic archival of the likes and comments of old posts, run from cron
+# Author: Nguyen Le
+
+
+import time
+
+from django.core.management.base import BaseCommand
+
+from ...archive import ARCHIVE_AFTER_DAYS, BATCH_SIZE, archive
+
+
+class Command(BaseCommand):
+    '''Move the Likes and Comments of old Posts to ArchivedLike and ArchivedComment, one short transaction per batch'''
+
+    help = 'Archive likes and comments of old posts, e.g. archive_cold_data --days 365 --batch-size 1000 --pause 0.1'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=ARCHIVE_AFTER_DAYS, help='archive posts older than this many days')
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help='rows moved per transaction')
+        parser.add_argument('--pause', type=float, default=0, help='seconds to sleep between batches, to leave room for other writes')
+        parser.add_argument('--after-like', type=int, default=0, help='only archive likes with a larger pk (to resume)')
+        parser.add_argument('--after-comment', type=int, default=0, help='only archive comments with a larger pk (to resume)')
+
+    def handle(self, *args, **options):
+        start = time.monotonic()
+        totals = {'likes': 0, 'comments': 0}
+        after = {'likes': options['after_like'], 'comments': options['after_comment']}
+        for kind, moved, last_pk in archive(options['days'], options['batch_size'], after):
+            totals[kind] += moved
+            # the last pk is where an interrupted run resumes from (--after-like / --after-comment)
+            self.stdout.write(f'  {totals[kind]} {kind} archived, up to pk {last_pk}')
+            if options['pause']:
+                time.sleep(options['pause'])
+        self.stdout.write(f'archived {totals["likes"]} likes and {totals["comments"]} comments in {time.monotonic() - start:.1f}s')
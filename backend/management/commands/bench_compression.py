@@ -0,0 +1,73 @@
+# File: mini_insta/management/commands/bench_compression.py
+# measure how many bytes each response encoding saves on the streaming API lists, and what it costs in CPU
+# Author: Nguyen Le
+
+
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Count
+from django.test import RequestFactory
+
+from ...api_views import ProfileFeedAPIView, ProfilePostsAPIView
+from ...compression import CODECS, get_level, measure
+from ...models import Follow, Post
+
+
+def parse_levels(value):
+    '''"gzip:1,5,9 zstd:3" -> {'gzip': [1, 5, 9], 'zstd': [3]}'''
+    levels = {}
+    for part in value.split():
+        encoding, _, numbers = part.partition(':')
+        if encoding not in CODECS:
+            raise CommandError(f'{encoding} is not available (have {", ".join(CODECS)})')
+        levels[encoding] = [int(number) for number in numbers.split(',')]
+    return levels
+
+
+class Command(BaseCommand):
+    '''Compress real feed and profile-post responses, chunk by chunk as the middleware does, with each encoding'''
+
+    help = 'Report bytes saved and CPU cost per endpoint and encoding, e.g. bench_compression --levels "gzip:1,5,9"'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--profile', type=int, help='profile whose feed and posts are fetched (default: the largest ones)')
+        parser.add_argument('--repeat', type=int, default=5, help='compressions timed per encoding and level (the fastest is reported)')
+        parser.add_argument('--levels', default='', help='levels to compare, e.g. "gzip:1,5,9 br:4,11" (default: the configured ones)')
+
+    def handle(self, *args, **options):
+        levels = parse_levels(options['levels']) or {encoding: [get_level(encoding)] for encoding in CODECS}
+        feed_profile = options['profile'] or self.largest(Follow.objects.values_list('follower_profile'))
+        posts_profile = options['profile'] or self.largest(Post.objects.values_list('profile'))
+
+        for name, view, profile_id in [('feed', ProfileFeedAPIView, feed_profile), ('posts', ProfilePostsAPIView, posts_profile)]:
+            start = time.process_time()
+            chunks = self.fetch(view, profile_id)
+            serialize = time.process_time() - start
+            raw = sum(len(chunk) for chunk in chunks)
+            self.stdout.write(f'\n{name} of profile {profile_id}: {raw} bytes in {len(chunks)} chunks, {serialize * 1000:.1f} ms CPU to query and serialize')
+
+            for encoding, encoding_levels in levels.items():
+                for level in encoding_levels:
+                    size, cpu = min(measure(chunks, encoding, level) for _ in range(options['repeat']))
+                    saved = 1 - size / raw if raw else 0
+                    rate = raw / cpu / 1e6 if cpu else float('inf')
+                    self.stdout.write(
+                        f'  {encoding:>4} {level:>2}: {size:>9} bytes, {saved:6.1%} saved, '
+                        f'{cpu * 1000:7.2f} ms CPU ({rate:.0f} MB/s)'
+                    )
+
+    def largest(self, rows):
+        '''pk of the profile with the most rows, e.g. the one following the most profiles'''
+        row = rows.annotate(rows=Count('pk')).order_by('-rows').first()
+        if row is None:
+            raise CommandError('no data to fetch; pass --profile or import some with import_data')
+        return row[0]
+
+    def fetch(self, view, profile_id):
+        '''the uncompressed chunks of one response, as the view streams them'''
+        host = next((host.lstrip('.') for host in settings.ALLOWED_HOSTS if host != '*'), 'localhost')
+        request = RequestFactory().get('/', HTTP_HOST=host)
+        response = view.as_view()(request, profile_id=profile_id)
+        return [bytes(chunk) for chunk in response.streaming_content]
@@ -0,0 +1,85 @@
+# File: mini_insta/management/commands/bench_db_routing.py
+# measure read throughput with and without replicas, while a writer is busy
+# Author: Nguyen Le
+
+
+import sqlite3
+import threading
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connection, connections, transaction
+from django.db.models import F
+
+from ...db_router import primary_reads, replica_aliases, replica_reads
+from ...models import Post, Profile
+
+
+class Command(BaseCommand):
+    '''Benchmark the PrimaryReplicaRouter on the local two-SQLite-file setup described in db_router.py'''
+
+    help = 'Copy the primary SQLite file to the replicas and compare read throughput (routing itself is covered by the tests)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seconds', type=float, default=3.0, help='duration of each run')
+        parser.add_argument('--readers', type=int, default=4, help='concurrent reader threads')
+
+    def handle(self, *args, **options):
+        replicas = replica_aliases()
+        if not replicas:
+            raise CommandError('no replica databases configured, see mini_insta/db_router.py')
+        self.replicate(replicas)
+
+        for label, reads in [('primary only', primary_reads), ('with replicas', replica_reads)]:
+            count = self.run(reads, options['readers'], options['seconds'])
+            self.stdout.write(f'{label:>14}: {count / options["seconds"]:8.0f} reads/s while a writer is busy')
+
+    def replicate(self, replicas):
+        '''stand-in for replication: copy the primary SQLite database into every replica file'''
+        for alias in [DEFAULT_DB_ALIAS] + replicas:
+            if connections[alias].vendor != 'sqlite':
+                raise CommandError('bench_db_routing copies SQLite files and only runs on the local SQLite setup')
+        source = sqlite3.connect(connections[DEFAULT_DB_ALIAS].settings_dict['NAME'])
+        for alias in replicas:
+            connections[alias].close()
+            target = sqlite3.connect(connections[alias].settings_dict['NAME'])
+            source.backup(target)
+            target.close()
+        source.close()
+
+    def run(self, reads, readers, seconds):
+        '''count feed-style reads done by reader threads while one thread keeps committing writes'''
+        stop = threading.Event()
+        counts = []
+        profile_id = Profile.objects.values_list('pk', flat=True).first()
+
+        def writer():
+            try:
+                while not stop.is_set():
+                    with transaction.atomic():
+                        Profile.objects.filter(pk=profile_id).update(bio_text=F('bio_text'))
+                        time.sleep(0.002) # hold the write lock like a real multi-row write would
+            finally:
+                connection.close()
+
+        def reader():
+            done = 0
+            try:
+                with reads():
+                    while not stop.is_set():
+                        list(Post.objects.select_related('profile').order_by('-timestamp')[:20])
+                        done += 1
+            except Exception:
+                pass # SQLite "database is locked" under contention counts as no progress
+            finally:
+                counts.append(done)
+                connection.close()
+
+        threads = [threading.Thread(target=writer)] + [threading.Thread(target=reader) for _ in range(readers)]
+        for thread in threads:
+            thread.start()
+        time.sleep(seconds)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        return sum(counts)
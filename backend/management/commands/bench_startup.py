@@ -0,0 +1,81 @@
+# File: mini_insta/management/commands/bench_startup.py
+# measure how long a fresh process takes to start, and which modules it spends that time importing
+# Author: Nguyen Le
+
+
+import os
+import statistics
+import subprocess
+import sys
+
+from django.core.management.base import BaseCommand
+
+# what a fresh process does in each scenario, each one a superset of the previous
+SCENARIOS = [
+    ('setup', 'django.setup() (worker and management command boot)', ''),
+    ('html', '+ load the URLconf and reverse an HTML route (first page request)',
+     "from django.urls import get_resolver, reverse\n"
+     "get_resolver().url_patterns\n"
+     "reverse('show_all_profiles')\n"),
+    ('api', '+ resolve an API route and load its view (first api/ request)',
+     "from django.urls import get_resolver, reverse\n"
+     "get_resolver().url_patterns\n"
+     "get_resolver().resolve(reverse('api:profile_list')).func.view\n"),
+]
+
+SCRIPT = '''
+import time
+start = time.perf_counter()
+import django
+django.setup()
+{code}
+print(time.perf_counter() - start)
+'''
+
+
+def run(code, importtime=False):
+    '''run a scenario in a new interpreter; return (seconds it took, its stderr)'''
+    command = [sys.executable]
+    if importtime:
+        command += ['-X', 'importtime']
+    command += ['-c', SCRIPT.format(code=code)]
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(path for path in sys.path if path))
+    result = subprocess.run(command, capture_output=True, text=True, env=env, check=True)
+    return float(result.stdout.strip().splitlines()[-1]), result.stderr
+
+
+def parse_importtime(stderr):
+    '''return {module: (self us, cumulative us)} from the output of python -X importtime'''
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        own, cumulative, name = line[len('import time:'):].split('|')
+        modules[name.strip()] = (int(own), int(cumulative))
+    return modules
+
+
+class Command(BaseCommand):
+    '''Time cold starts of a few typical processes and report the slowest imports of each'''
+
+    help = 'Measure process startup and import time per module, e.g. bench_startup --repeat 5 --top 15'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=5, help='fresh processes timed per scenario (the median is reported)')
+        parser.add_argument('--top', type=int, default=15, help='modules listed per scenario, slowest cumulative import first')
+
+    def handle(self, *args, **options):
+        previous = set()
+        for name, description, code in SCENARIOS:
+            times = [run(code)[0] for _ in range(options['repeat'])]
+            modules = parse_importtime(run(code, importtime=True)[1])
+            added = {module: timing for module, timing in modules.items() if module not in previous}
+            previous |= modules.keys()
+
+            self.stdout.write(f'\n{name}: {description}')
+            self.stdout.write(f'  median {statistics.median(times) * 1000:.1f} ms over {len(times)} runs, {len(modules)} modules imported')
+            self.stdout.write(f'  {len(added)} modules not imported by the previous scenario, {sum(own for own, _ in added.values()) / 1000:.1f} ms:')
+
+            slowest = sorted(added.items(), key=lambda item: item[1][1], reverse=True)[:options['top']]
+            for module, (own, cumulative) in slowest:
+                self.stdout.write(f'    {cumulative / 1000:8.1f} ms  {module}')
@@ -0,0 +1,88 @@
+# File: mini_insta/management/commands/bench_write_buffer.py
+# load test: many concurrent likers tapping like/unlike on one viral post
+# Author: Nguyen Le
+
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from ...models import Like, Post, Profile
+from ...write_buffer import LIKE, WriteBuffer
+
+
+class Command(BaseCommand):
+    '''Compare per-tap writes with the coalescing write buffer for a burst of likes on one Post'''
+
+    help = 'Benchmark like/unlike throughput with and without the write buffer'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--likers', type=int, default=200, help='number of distinct liking profiles')
+        parser.add_argument('--taps', type=int, default=5, help='like/unlike taps per liker (odd = ends liked)')
+        parser.add_argument('--threads', type=int, default=8, help='concurrent request threads')
+        parser.add_argument('--window', type=float, default=0.2, help='write buffer window in seconds')
+
+    def handle(self, *args, **options):
+        post, likers = self.setup_fixtures(options['likers'])
+        try:
+            # each job is one liker's burst of alternating like/unlike taps
+            jobs = [(liker.pk, options['taps']) for liker in likers]
+
+            direct = self.run(jobs, options['threads'], lambda liker, state: self.direct_toggle(post, liker, state))
+            Like.objects.filter(post=post).delete()
+
+            buffer = WriteBuffer(window=options['window'])
+            buffered = self.run(jobs, options['threads'], lambda liker, state: self.buffered_toggle(buffer, post, liker, state))
+            buffer.flush()
+
+            taps = len(jobs) * options['taps']
+            expected = len(jobs) if options['taps'] % 2 else 0
+            self.stdout.write(f'{taps} taps by {len(jobs)} likers on one post, {options["threads"]} threads')
+            self.stdout.write(f'  per-tap writes: {taps / direct:10.0f} taps/s')
+            self.stdout.write(f'  write buffer:   {taps / buffered:10.0f} taps/s ({direct / buffered:.1f}x)')
+            self.stdout.write(f'  likes stored: {Like.objects.filter(post=post).count()} (expected {expected})')
+        finally:
+            self.teardown_fixtures(post, likers)
+
+    def setup_fixtures(self, n):
+        '''create an author with one Post, and n liker Profiles'''
+        author = User.objects.create_user(username='bench-author')
+        post = Post.objects.create(profile=Profile.objects.create(user=author, username='bench-author'), caption='viral')
+        users = User.objects.bulk_create([User(username=f'bench-liker-{i}') for i in range(n)])
+        likers = Profile.objects.bulk_create([Profile(user=user, username=user.username) for user in users])
+        return post, likers
+
+    def teardown_fixtures(self, post, likers):
+        User.objects.filter(username__startswith='bench-').delete()
+
+    def direct_toggle(self, post, liker_id, state):
+        '''the per-tap path the views used before the write buffer'''
+        post = Post.objects.get(pk=post.pk)
+        liker = Profile.objects.get(pk=liker_id)
+        if state:
+            Like.objects.get_or_create(post=post, profile=liker)
+        else:
+            Like.objects.filter(post=post, profile=liker).delete()
+
+    def buffered_toggle(self, buffer, post, liker_id, state):
+        '''the path LikeView/UnlikeView take now: look up the liker, then buffer the toggle'''
+        liker = Profile.objects.get(pk=liker_id)
+        buffer.set(LIKE, liker.pk, post.pk, state)
+
+    def run(self, jobs, threads, toggle):
+        '''run every liker's taps across a thread pool and return the elapsed seconds'''
+        def burst(job):
+            liker, taps = job
+            try:
+                for tap in range(taps):
+                    toggle(liker, tap % 2 == 0)
+            finally:
+                connection.close()
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            list(pool.map(burst, jobs))
+        return time.perf_counter() - start
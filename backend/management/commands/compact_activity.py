@@ -0,0 +1,29 @@
+# File: mini_insta/management/commands/compact_activity.py
+# periodic compaction of the activity inboxes, run from cron
+# Author: Nguyen Le
+
+
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from ...activity import compact
+
+
+class Command(BaseCommand):
+    '''Merge old Activity buckets and trim every inbox to a bounded size'''
+
+    help = 'Compact activity inboxes, e.g. compact_activity --merge-after-days 7 --keep 500'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--merge-after-days', type=int, default=7, help='merge buckets older than this many days')
+        parser.add_argument('--keep', type=int, default=500, help='maximum Activities kept per profile')
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        merged, trimmed = compact(
+            merge_after=timedelta(days=options['merge_after_days']),
+            keep=options['keep'],
+            batch_size=options['batch_size'],
+        )
+        self.stdout.write(f'merged {merged} and trimmed {trimmed} activities')
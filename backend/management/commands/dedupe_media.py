@@ -0,0 +1,47 @@
+# File: mini_insta/management/commands/dedupe_media.py
+# move photos uploaded before content-addressed storage into it, merging identical files
+# Author: Nguyen Le
+
+
+from django.core.management.base import BaseCommand
+from django.db.models import Count
+
+from ...deletion import DEFAULT_IMAGE
+from ...models import Blob, Photo
+from ...storage import BLOB_DIR
+
+
+class Command(BaseCommand):
+    '''Store every legacy uploaded photo as a content-addressed blob and point its Photos at it'''
+
+    help = 'Move existing uploads into content-addressed storage, e.g. dedupe_media'
+
+    def handle(self, *args, **options):
+        storage = Photo._meta.get_field('image_file').storage
+        rows = (
+            Photo.objects.exclude(image_file='').exclude(image_file=DEFAULT_IMAGE)
+            .exclude(image_file__startswith=BLOB_DIR + '/')
+            .values('image_file').annotate(photos=Count('pk')).order_by()
+        )
+
+        moved = missing = freed = 0
+        for row in rows.iterator():
+            name, photos = row['image_file'], row['photos']
+            if not storage.exists(name):
+                missing += 1
+                continue
+
+            size = storage.size(name)
+            with storage.open(name) as f:
+                new_name = storage.save(name, f) # one reference
+            if photos > 1:
+                storage.retain(new_name, photos - 1)
+            Photo.objects.filter(image_file=name).update(image_file=new_name)
+            storage.delete(name) # not a blob, so the file itself goes
+
+            # the copy only takes space if it is the first blob with this content
+            if Blob.objects.get(name=new_name).refcount > photos:
+                freed += size
+            moved += 1
+
+        self.stdout.write(f'moved {moved} files into blobs, freed {freed} bytes, {missing} files missing')
@@ -0,0 +1,35 @@
+# File: mini_insta/management/commands/export_data.py
+# stream profiles, posts, photos and the social graph to NDJSON or CSV files
+# Author: Nguyen Le
+
+
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...bulk_data import FORMATS, export_table, tables_named
+
+
+class Command(BaseCommand):
+    '''Export tables to <directory>/<table>.<format>, one file per table'''
+
+    help = 'Export data, e.g. export_data dump/ --format ndjson --tables profile post'
+
+    def add_arguments(self, parser):
+        parser.add_argument('directory', help='directory to write the files into (created if missing)')
+        parser.add_argument('--format', choices=FORMATS, default='ndjson')
+        parser.add_argument('--tables', nargs='*', help='tables to export (default: all)')
+        parser.add_argument('--chunk-size', type=int, default=2000, help='rows fetched per database round trip')
+
+    def handle(self, *args, **options):
+        try:
+            tables = tables_named(options['tables'])
+        except ValueError as e:
+            raise CommandError(e)
+
+        os.makedirs(options['directory'], exist_ok=True)
+        for table in tables:
+            start = time.perf_counter()
+            count = export_table(table, options['directory'], options['format'], options['chunk_size'])
+            self.stdout.write(f'{table.name}: {count} rows in {time.perf_counter() - start:.1f}s')
@@ -0,0 +1,49 @@
+# File: mini_insta/management/commands/import_data.py
+# bulk load files written by export_data
+# Author: Nguyen Le
+
+
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...bulk_data import FORMATS, Importer, tables_named
+
+
+class Command(BaseCommand):
+    '''Import <directory>/<table>.<format> files with bulk_create, remapping ids to the new rows'''
+
+    help = 'Import data written by export_data, e.g. import_data dump/ --format ndjson'
+
+    def add_arguments(self, parser):
+        parser.add_argument('directory', help='directory holding the exported files')
+        parser.add_argument('--format', choices=FORMATS, default='ndjson')
+        parser.add_argument('--tables', nargs='*', help='tables to import (default: every file present)')
+        parser.add_argument('--batch-size', type=int, default=1000, help='rows per bulk_create and transaction')
+
+    def handle(self, *args, **options):
+        try:
+            tables = tables_named(options['tables'])
+        except ValueError as e:
+            raise CommandError(e)
+
+        importer = Importer(batch_size=options['batch_size'])
+        for table in tables:
+            path = os.path.join(options['directory'], table.filename(options['format']))
+            if not os.path.exists(path):
+                if options['tables']:
+                    raise CommandError(f'{path} does not exist')
+                continue
+
+            start = time.perf_counter()
+            created = importer.import_table(table, path, options['format'])
+            skipped = importer.skipped[table.name]
+            self.stdout.write(
+                f'{table.name}: {created} rows in {time.perf_counter() - start:.1f}s'
+                + (f', {skipped} skipped (unresolved references)' if skipped else '')
+            )
+            if table.name == 'profile' and importer.present:
+                self.stdout.write(f'profile: {importer.present} skipped (their User has a Profile already)')
+
+        importer.finish()
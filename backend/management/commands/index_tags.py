@@ -0,0 +1,29 @@
+# File: mini_insta/management/commands/index_tags.py
+# build the hashtag and mention index of existing posts and comments
+# Author: Nguyen Le
+
+
+import time
+
+from django.core.management.base import BaseCommand
+
+from ...tags import backfill
+
+
+class Command(BaseCommand):
+    '''Parse the captions and comments of existing Posts into the Hashtag, PostHashtag and Mention tables'''
+
+    help = 'Backfill the hashtag and mention index in batches, e.g. index_tags --batch-size 1000 --after 0'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='posts indexed per batch')
+        parser.add_argument('--after', type=int, default=0, help='only index posts with a larger pk (to resume)')
+
+    def handle(self, *args, **options):
+        start = time.monotonic()
+        total = 0
+        for posts, last_pk in backfill(options['batch_size'], options['after']):
+            total += posts
+            # the last pk is where an interrupted run resumes from (--after)
+            self.stdout.write(f'  {total} posts indexed, up to pk {last_pk}')
+        self.stdout.write(f'indexed {total} posts in {time.monotonic() - start:.1f}s')
@@ -0,0 +1,21 @@
+# File: mini_insta/management/commands/purge_rate_limits.py
+# periodic cleanup of idle rate limit buckets, run from cron
+# Author: Nguyen Le
+
+
+from django.core.management.base import BaseCommand
+
+from ...throttling import purge_idle_buckets
+
+
+class Command(BaseCommand):
+    '''Delete rate limit buckets that have not been used for a while'''
+
+    help = 'Delete idle rate limit buckets, e.g. purge_rate_limits --idle-hours 24'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--idle-hours', type=float, default=24, help='delete buckets unused for this many hours')
+
+    def handle(self, *args, **options):
+        deleted = purge_idle_buckets(idle_seconds=options['idle_hours'] * 60 * 60)
+        self.stdout.write(f'deleted {deleted} idle buckets')
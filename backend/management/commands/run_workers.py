@@ -0,0 +1,61 @@
+# File: mini_insta/management/commands/run_workers.py
+# worker process for the database-backed task queue
+# Author: Nguyen Le
+
+
+import signal
+import threading
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, connection
+
+from ... import taskqueue
+
+
+class Command(BaseCommand):
+    '''Run queued Tasks with N worker threads until interrupted'''
+
+    help = 'Run background tasks from the database queue, e.g. run_workers --concurrency 4'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=1, help='number of worker threads')
+        parser.add_argument('--poll-interval', type=float, default=1.0, help='seconds to sleep when the queue is empty')
+        parser.add_argument('--batch-size', type=int, default=10, help='tasks claimed per database round trip')
+        parser.add_argument('--burst', action='store_true', help='exit once the queue is empty instead of waiting for more work')
+
+    def handle(self, *args, **options):
+        self.stopping = threading.Event()
+        signal.signal(signal.SIGTERM, lambda *_: self.stopping.set())
+        signal.signal(signal.SIGINT, lambda *_: self.stopping.set())
+
+        workers = [
+            threading.Thread(target=self.work, args=(options,), name=f'mini-insta-worker-{i}', daemon=True)
+            for i in range(options['concurrency'])
+        ]
+        for worker in workers:
+            worker.start()
+        self.stdout.write(f'started {len(workers)} worker(s)')
+
+        # wait in short slices so signals are handled promptly
+        while any(worker.is_alive() for worker in workers):
+            for worker in workers:
+                worker.join(timeout=0.5)
+
+        self.stdout.write('workers stopped')
+
+    def work(self, options):
+        '''Loop claiming and running batches of tasks until stopped'''
+        try:
+            while not self.stopping.is_set():
+                close_old_connections()
+                batch = taskqueue.claim(options['batch_size'])
+                for task_row in batch:
+                    status = taskqueue.execute(task_row)
+                    self.stdout.write(f'{task_row.name} #{task_row.pk}: {status}')
+
+                if not batch:
+                    if options['burst']:
+                        break
+                    self.stopping.wait(options['poll_interval'])
+        finally:
+            connection.close()
@@ -0,0 +1,71 @@
+# File: mini_insta/management/commands/warm_caches.py
+# warm the feed caches of the most active profiles with a pool of processes
+# Author: Nguyen Le
+
+
+import multiprocessing
+import os
+import time
+from datetime import timedelta
+from functools import partial
+
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.utils import timezone
+
+from ...warmup import active_profiles, id_range_shards, init_worker, warm_shard
+
+
+class Command(BaseCommand):
+    '''Precompute like summaries, post cards and unread counts for the feeds of the N most active profiles'''
+
+    help = 'Warm feed caches after a deploy or cache flush, e.g. warm_caches --profiles 5000 --processes 8 --target 200'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--profiles', type=int, default=1000, help='number of most active profiles to warm')
+        parser.add_argument('--days', type=int, default=7, help='activity window used to rank profiles')
+        parser.add_argument('--processes', type=int, default=os.cpu_count(), help='worker processes (0 warms in this process)')
+        parser.add_argument('--shard-size', type=int, default=50, help='profiles per id-range shard')
+        parser.add_argument('--feed-size', type=int, default=50, help='newest feed posts warmed per profile')
+        parser.add_argument('--target', type=float, default=0, help='maximum profiles per second over all processes (0 for no limit)')
+
+    def handle(self, *args, **options):
+        backend = caches['default']
+        if isinstance(backend, (LocMemCache, DummyCache)):
+            self.stderr.write(f'warning: the {type(backend).__name__} cache is not shared between processes, so the web servers will not see what is warmed here')
+
+        since = timezone.now() - timedelta(days=options['days'])
+        shards = id_range_shards(active_profiles(options['profiles'], since), options['shard_size'])
+        total = sum(len(shard) for shard in shards)
+        processes = options['processes']
+        per_second = options['target'] / max(processes, 1) if options['target'] else None
+        work = partial(warm_shard, feed_size=options['feed_size'], per_second=per_second)
+        self.stdout.write(f'warming {total} profiles in {len(shards)} shards with {processes or "no"} worker processes')
+
+        start = time.monotonic()
+        done = posts = 0
+        if processes:
+            # pool processes must open their own database connections, not share the ones inherited from this process
+            connections.close_all()
+            with multiprocessing.Pool(processes, initializer=init_worker) as pool:
+                for profiles, shard_posts in pool.imap_unordered(work, shards):
+                    done, posts = done + profiles, posts + shard_posts
+                    self.report(done, total, posts, start)
+        else:
+            for shard in shards:
+                profiles, shard_posts = work(shard)
+                done, posts = done + profiles, posts + shard_posts
+                self.report(done, total, posts, start)
+
+        elapsed = time.monotonic() - start
+        self.stdout.write(f'warmed {done} profiles and {posts} posts in {elapsed:.1f}s ({done / max(elapsed, 1e-9):.1f} profiles/s)')
+
+    def report(self, done, total, posts, start):
+        '''one progress line per finished shard'''
+        elapsed = time.monotonic() - start
+        rate = done / max(elapsed, 1e-9)
+        eta = (total - done) / rate if rate else 0
+        self.stdout.write(f'  {done}/{total} profiles, {posts} posts, {rate:.1f} profiles/s, eta {eta:.0f}s')
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-19 07:08
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mini_insta', '0008_task'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Activity',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('verb', models.CharField(choices=[('like', 'Like'), ('follow', 'Follow'), ('comment', 'Comment')], max_length=10)),
+                ('group_key', models.CharField(max_length=100)),
+                ('actor_count', models.PositiveIntegerField(default=0)),
+                ('recent_actors', models.JSONField(blank=True, default=list)),
+                ('is_read', models.BooleanField(default=False)),
+                ('updated', models.DateTimeField(default=django.utils.timezone.now)),
+                ('post', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='mini_insta.post')),
+                ('recipient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='activities', to='mini_insta.profile')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['recipient', '-updated'], name='mini_insta__recipie_3c5526_idx')],
+                'constraints': [models.UniqueConstraint(fields=('recipient', 'group_key'), name='unique_activity_group')],
+            },
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-19 07:19
+
+import mini_insta.storage
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mini_insta', '0011_ratelimitbucket'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Blob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True)),
+                ('size', models.BigIntegerField(default=0)),
+                ('refcount', models.IntegerField(default=0)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='photo',
+            name='image_file',
+            field=models.ImageField(blank=True, storage=mini_insta.storage.photo_storage, upload_to=''),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.2.18 on 2026-10-19 07:39
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mini_insta', '0013_hashtags_mentions'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['timestamp'], name='mini_insta__timesta_a57c78_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='follow',
+            index=models.Index(fields=['timestamp'], name='mini_insta__timesta_7a309e_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='like',
+            index=models.Index(fields=['timestamp'], name='mini_insta__timesta_1176f3_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(fields=['timestamp'], name='mini_insta__timesta_d00386_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='profile',
+            index=models.Index(fields=['join_date'], name='mini_insta__join_da_e2dfb4_idx'),
+        ),
+    ]
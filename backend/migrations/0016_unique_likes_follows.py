@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-19 07:54
+
+from django.db import migrations, models
+from django.db.models import Count, Min
+
+
+def delete_duplicates(apps, schema_editor):
+    '''keep the oldest Like of each (post, profile) and the oldest Follow of each pair, so the constraints can be added'''
+    for model_name, fields in [('Like', ['post', 'profile']), ('Follow', ['profile', 'follower_profile'])]:
+        model = apps.get_model('mini_insta', model_name)
+        duplicated = model.objects.values(*fields).annotate(first=Min('pk'), n=Count('pk')).filter(n__gt=1).order_by()
+        for group in duplicated.iterator():
+            model.objects.filter(**{field: group[field] for field in fields}).exclude(pk=group['first']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mini_insta', '0015_archive'),
+    ]
+
+    operations = [
+        migrations.RunPython(delete_duplicates, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='follow',
+            constraint=models.UniqueConstraint(fields=('profile', 'follower_profile'), name='unique_follow'),
+        ),
+        migrations.AddConstraint(
+            model_name='like',
+            constraint=models.UniqueConstraint(fields=('post', 'profile'), name='unique_like'),
+        ),
+    ]
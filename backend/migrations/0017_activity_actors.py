@@ -0,0 +1,43 @@
+# Generated by Django 5.2.18 on 2026-10-19 07:56
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def record_recent_actors(apps, schema_editor):
+    '''the recent actors of existing Activities are the only actors known, record them so they are not counted again'''
+    Activity = apps.get_model('mini_insta', 'Activity')
+    ActivityActor = apps.get_model('mini_insta', 'ActivityActor')
+    Profile = apps.get_model('mini_insta', 'Profile')
+    activities = Activity.objects.order_by('pk').values_list('pk', 'recent_actors')
+    last = 0
+    while batch := list(activities.filter(pk__gt=last)[:1000]):
+        last = batch[-1][0]
+        rows = [(pk, actor['id']) for pk, recent_actors in batch for actor in recent_actors]
+        existing = set(Profile.objects.filter(pk__in={actor_id for _, actor_id in rows}).values_list('pk', flat=True))
+        ActivityActor.objects.bulk_create(
+            [ActivityActor(activity_id=pk, actor_id=actor_id) for pk, actor_id in rows if actor_id in existing],
+            ignore_conflicts=True,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mini_insta', '0016_unique_likes_follows'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ActivityActor',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('activity', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='actors', to='mini_insta.activity')),
+                ('actor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='mini_insta.profile')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('activity', 'actor'), name='unique_activity_actor')],
+            },
+        ),
+        migrations.RunPython(record_recent_actors, migrations.RunPython.noop),
+    ]
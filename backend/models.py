@@ -4,10 +4,13 @@
 
 
 
-from django.db import models
+from django.db import models, router, transaction
 from django.urls import reverse
+from django.utils import timezone
 from django.contrib.auth.models import User
 
+from .storage import photo_storage
+
 # Create your models here.
 class Profile(models.Model):
     '''Encapsulate the data of a profile on instagram'''
@@ -20,6 +23,9 @@ class Profile(models.Model):
     join_date = models.DateTimeField(auto_now=True)
     user = models.ForeignKey(User, on_delete=models.CASCADE)
 
+    class Meta:
+        indexes = [models.Index(fields=['join_date'])] # admin date navigation
+
     # method for string representation of this model
     def __str__(self):
         '''return a string representation of this model instance'''
@@ -39,7 +45,7 @@ class Profile(models.Model):
     # getter method: followers of this Profile
     def get_followers(self):
         '''Return a list of Profiles who are followers of this Profile'''
-        follows = Follow.objects.filter(profile=self) # QuerySet of Follow relationships, where self is the profile being followed
+        follows = Follow.objects.filter(profile=self).select_related('follower_profile') # QuerySet of Follow relationships, where self is the profile being followed
         followers = [follow.follower_profile for follow in follows] # list of followers, follower_profile is the follower
         return followers
     
@@ -50,7 +56,7 @@ class Profile(models.Model):
     # getter method: Profiles followed by this Profile
     def get_following(self):
         '''Return a list of Profiles followed by this profile'''
-        follows = Follow.objects.filter(follower_profile=self) # QuerySet of Follow relationships, where self is the follower
+        follows = Follow.objects.filter(follower_profile=self).select_related('profile') # QuerySet of Follow relationships, where self is the follower
         following = [follow.profile for follow in follows] # list of profiles self is following
         return following
     
@@ -61,12 +67,20 @@ class Profile(models.Model):
     # a Profile's post feed
     def get_post_feed(self):
         '''Return a list (or QuerySet) of Posts, for the profiles being followed by the profiles on which the method was called'''
-        following_profiles = self.get_following() # get Profiles this user is following
+        following_profiles = Follow.objects.filter(follower_profile=self).values('profile') # subquery of Profiles this user is following
         return Post.objects.filter(profile__in=following_profiles).order_by('-timestamp') # recent posts first
     
     
     
 
+# manager hiding Posts that are waiting to be purged in the background
+class PostManager(models.Manager):
+    '''Default manager of Post, which leaves out deleted Posts'''
+
+    def get_queryset(self):
+        '''only Posts that have not been deleted'''
+        return super().get_queryset().filter(deleted_at__isnull=True)
+
 # Post, something you write on a Profile, there can be many posts in a profile
 class Post(models.Model):
     '''Encapsulate the idea of a Post on a Profile'''
@@ -75,6 +89,15 @@ class Post(models.Model):
     profile = models.ForeignKey(Profile, on_delete=models.CASCADE) # unique identifier to Profile model
     timestamp = models.DateTimeField(auto_now=True)
     caption = models.TextField(blank=False)
+    deleted_at = models.DateTimeField(null=True, blank=True) # set on delete, the row is purged by a background task
+    archived_like_count = models.PositiveIntegerField(default=0) # Likes moved to ArchivedLike (see archive.py)
+    archived_comment_count = models.PositiveIntegerField(default=0) # Comments moved to ArchivedComment
+
+    objects = PostManager() # Posts that are not deleted
+    all_objects = models.Manager() # every Post, including deleted ones
+
+    class Meta:
+        indexes = [models.Index(fields=['timestamp'])] # admin date navigation
 
     # string representation of this model
     def __str__(self):
@@ -104,8 +127,13 @@ class Post(models.Model):
     
     # method to get number of likes
     def get_num_likes(self):
-        '''Return the number of Likes of a Post'''
-        return self.get_likes().count()
+        '''Return the number of Likes of a Post, including the archived ones'''
+        return self.get_likes().count() + self.archived_like_count
+
+    # method to get number of comments
+    def get_num_comments(self):
+        '''Return the number of Comments of a Post, including the archived ones'''
+        return Comment.objects.filter(post=self).count() + self.archived_comment_count
 
     # Liked by XYZ and 5 others, this method will return 'XYZ'
     def get_most_recent_like(self):
@@ -126,7 +154,12 @@ class Photo(models.Model):
     post = models.ForeignKey(Post, on_delete=models.CASCADE) # unique identifier to a Post
     image_url = models.URLField(blank=True) # legacy way of getting images
     timestamp = models.DateTimeField(auto_now=True)
-    image_file = models.ImageField(blank=True) # new way of getting images
+    image_file = models.ImageField(blank=True, storage=photo_storage) # new way of getting images, stored by content (see storage.py)
+
+    def save(self, *args, **kwargs):
+        '''save the Photo in one transaction with its upload's blob reference, so a failed insert also undoes the count'''
+        with transaction.atomic(using=kwargs.get('using') or router.db_for_write(Photo, instance=self)):
+            super().save(*args, **kwargs)
 
     # string representation of this model
     def __str__(self):
@@ -150,6 +183,18 @@ class Photo(models.Model):
         else:
             return self.image_file.url
 
+    # accessor method for resized copies served by PhotoRenditionView
+    def get_rendition_url(self, width, fmt=None):
+        '''Return the URL of this Photo resized to width pixels (and re-encoded as fmt, if given)'''
+        url = reverse('photo_rendition', kwargs={'pk': self.pk}) + f'?w={width}'
+        if fmt:
+            url += f'&fmt={fmt}'
+        return url
+
+    def get_thumbnail_url(self):
+        '''Return the URL of a small rendition of this Photo, for grids of many photos'''
+        return self.get_rendition_url(320)
+
 # Follow, connection between two nodes 
 class Follow(models.Model):
     '''Encapsulate connection when one Profile follows another Profile'''
@@ -159,6 +204,10 @@ class Follow(models.Model):
     follower_profile = models.ForeignKey(Profile, on_delete=models.CASCADE, related_name="follower_profile")
     timestamp = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['profile', 'follower_profile'], name='unique_follow')]
+        indexes = [models.Index(fields=['timestamp'])] # admin date navigation
+
     # string representation of this model
     def __str__(self):
         '''return a string representation of this model instance'''
@@ -174,6 +223,9 @@ class Comment(models.Model):
     timestamp = models.DateTimeField(auto_now=True)
     text = models.TextField(blank=False)
 
+    class Meta:
+        indexes = [models.Index(fields=['timestamp'])] # admin date navigation
+
     # string representation of this model
     def __str__(self):
         return f'Comment by {self.profile.username} on {self.post.caption}'
@@ -187,10 +239,222 @@ class Like(models.Model):
     profile = models.ForeignKey(Profile, on_delete=models.CASCADE)
     timestamp = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['post', 'profile'], name='unique_like')]
+        indexes = [models.Index(fields=['timestamp'])] # admin date navigation
+
     # string representation of this model
     def __str__(self):
         return f'{self.profile.username} liked the post: {self.post}'
     
+# ArchivedLike, a Like on an old Post moved out of the Like table by archive.py
+class ArchivedLike(models.Model):
+    '''Encapsulate a Like that is no longer counted row by row: Post.archived_like_count includes it'''
+
+    # attributes of an ArchivedLike
+    post = models.ForeignKey(Post, on_delete=models.CASCADE, db_index=False) # indexed by the constraint below
+    profile = models.ForeignKey(Profile, on_delete=models.CASCADE)
+    timestamp = models.DateTimeField() # of the Like
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['post', 'profile'], name='unique_archived_like')]
+        indexes = [models.Index(fields=['post', '-timestamp'])] # most recent liker of a Post without current Likes
+
+    # string representation of this model
+    def __str__(self):
+        '''return a string representation of this model instance'''
+        return f'profile {self.profile_id} liked post {self.post_id} (archived)'
+
+# ArchivedComment, a Comment on an old Post moved out of the Comment table by archive.py
+class ArchivedComment(models.Model):
+    '''Encapsulate a Comment that is read a page at a time (archive.archived_comments): Post.archived_comment_count includes it'''
+
+    # attributes of an ArchivedComment
+    post = models.ForeignKey(Post, on_delete=models.CASCADE, db_index=False) # indexed below
+    profile = models.ForeignKey(Profile, on_delete=models.CASCADE)
+    timestamp = models.DateTimeField() # of the Comment
+    text = models.TextField()
+
+    class Meta:
+        indexes = [models.Index(fields=['post', '-timestamp', '-id'])] # pages of a Post's archived comments, newest first
+
+    # string representation of this model
+    def __str__(self):
+        '''return a string representation of this model instance'''
+        return f'Comment by profile {self.profile_id} on post {self.post_id} (archived)'
+
+# Hashtag, a normalized #tag used in captions and comments
+class Hashtag(models.Model):
+    '''Encapsulate one hashtag, stored lowercase without the #'''
+
+    # attributes of a Hashtag
+    name = models.CharField(max_length=100, unique=True)
+
+    # string representation of this model
+    def __str__(self):
+        '''return a string representation of this model instance'''
+        return f'#{self.name}'
+
+    # method to display url
+    def get_absolute_url(self):
+        '''Return the URL of the page listing the Posts with this Hashtag'''
+        return reverse('show_tag', kwargs={'name': self.name})
+
+# PostHashtag, the inverted index from a Hashtag to the Posts whose caption or comments use it
+class PostHashtag(models.Model):
+    '''Encapsulate a Post tagged with a Hashtag, kept up to date by tags.py'''
+
+    # attributes of a PostHashtag
+    hashtag = models.ForeignKey(Hashtag, on_delete=models.CASCADE)
+    post = models.ForeignKey(Post, on_delete=models.CASCADE)
+    timestamp = models.DateTimeField() # copy of post.timestamp, so a tag page is read from one index
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['hashtag', 'post'], name='unique_post_hashtag')]
+        indexes = [models.Index(fields=['hashtag', '-timestamp'])]
+
+    # string representation of this model
+    def __str__(self):
+        '''return a string representation of this model instance'''
+        return f'#{self.hashtag_id} on post {self.post_id}'
+
+# Mention, a Profile named with @username in a caption or a comment
+class Mention(models.Model):
+    '''Encapsulate a mention of a Profile in a Post's caption (comment is empty) or in one of its Comments'''
+
+    # attributes of a Mention
+    profile = models.ForeignKey(Profile, on_delete=models.CASCADE, related_name="mentions") # the Profile mentioned
+    post = models.ForeignKey(Post, on_delete=models.CASCADE)
+    comment = models.ForeignKey(Comment, on_delete=models.CASCADE, null=True, blank=True)
+    timestamp = models.DateTimeField() # of the caption or comment
+
+    class Meta:
+        indexes = [models.Index(fields=['profile', '-timestamp'])]
+
+    # string representation of this model
+    def __str__(self):
+        '''return a string representation of this model instance'''
+        return f'@{self.profile_id} mentioned on post {self.post_id}'
+
+# Activity, an aggregated notification shown in a Profile's inbox
+class Activity(models.Model):
+    '''Encapsulate a group of similar events for one Profile, e.g. "@a and 12 others liked your post"'''
+
+    LIKE = 'like'
+    FOLLOW = 'follow'
+    COMMENT = 'comment'
+    VERB_CHOICES = [(LIKE, 'Like'), (FOLLOW, 'Follow'), (COMMENT, 'Comment')]
+
+    # attributes of an Activity
+    recipient = models.ForeignKey(Profile, on_delete=models.CASCADE, related_name="activities")
+    verb = models.CharField(max_length=10, choices=VERB_CHOICES)
+    post = models.ForeignKey(Post, on_delete=models.CASCADE, null=True, blank=True) # empty for follows
+    group_key = models.CharField(max_length=100) # verb, post and time bucket; events with the same key are merged
+    actor_count = models.PositiveIntegerField(default=0) # distinct actors, see ActivityActor
+    recent_actors = models.JSONField(default=list, blank=True) # newest first, [{"id": .., "username": ..}, ...]
+    is_read = models.BooleanField(default=False)
+    updated = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['recipient', 'group_key'], name='unique_activity_group')]
+        indexes = [models.Index(fields=['recipient', '-updated'])]
+
+    # string representation of this model
+    def __str__(self):
+        '''return a string representation of this model instance'''
+        return f'{self.get_summary()} (to profile {self.recipient_id})'
+
+    # "@a and 12 others liked your post"
+    def get_summary(self):
+        '''Return a one line description of this Activity'''
+        phrase = {
+            self.LIKE: 'liked your post',
+            self.FOLLOW: 'started following you',
+            self.COMMENT: 'commented on your post',
+        }[self.verb]
+        if not self.recent_actors:
+            return f'{self.actor_count} people {phrase}'
+        actor = f'@{self.recent_actors[0]["username"]}'
+        others = self.actor_count - 1
+        if others <= 0:
+            return f'{actor} {phrase}'
+        return f'{actor} and {others} other{"s" if others > 1 else ""} {phrase}'
+
+# ActivityActor, a Profile counted among the actors of an Activity
+class ActivityActor(models.Model):
+    '''Encapsulate that a Profile is one of the actors of an Activity, so it is counted once however often it acts'''
+
+    # attributes of an ActivityActor
+    activity = models.ForeignKey(Activity, on_delete=models.CASCADE, related_name="actors")
+    actor = models.ForeignKey(Profile, on_delete=models.CASCADE, related_name="+")
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['activity', 'actor'], name='unique_activity_actor')]
+
+    # string representation of this model
+    def __str__(self):
+        '''return a string representation of this model instance'''
+        return f'profile {self.actor_id} in activity {self.activity_id}'
+
+# Task, a unit of deferred work picked up by the run_workers management command
+class Task(models.Model):
+    '''Encapsulate a queued background job: a registered task name and its keyword arguments'''
+
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [(PENDING, 'Pending'), (RUNNING, 'Running'), (DONE, 'Done'), (FAILED, 'Failed')]
+
+    # attributes of a Task
+    name = models.CharField(max_length=100)
+    payload = models.JSONField(default=dict, blank=True)
+    idempotency_key = models.CharField(max_length=200, unique=True, null=True, blank=True) # at most one Task per key
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=5)
+    run_at = models.DateTimeField(default=timezone.now) # not picked up before this time (used for retry backoff)
+    locked_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['status', 'run_at'])]
+
+    # string representation of this model
+    def __str__(self):
+        '''return a string representation of this model instance'''
+        return f'{self.name} ({self.status}, attempt {self.attempts}/{self.max_attempts})'
+
+# Blob, a file in the content-addressed photo storage and how many Photos use it
+class Blob(models.Model):
+    '''Encapsulate the reference count of a stored file, deleted from storage when it drops to zero'''
+
+    # attributes of a Blob
+    name = models.CharField(max_length=255, unique=True) # storage name, blobs/ab/cd/<sha256>.<ext>
+    size = models.BigIntegerField(default=0) # bytes
+    refcount = models.IntegerField(default=0)
+    created = models.DateTimeField(auto_now_add=True)
+
+    # string representation of this model
+    def __str__(self):
+        '''return a string representation of this model instance'''
+        return f'{self.name} ({self.refcount} references)'
+
+# RateLimitBucket, the token bucket of one client (user or IP address) for one group of views
+class RateLimitBucket(models.Model):
+    '''Encapsulate the tokens left in a rate limit bucket, shared by every worker process'''
+
+    # attributes of a RateLimitBucket
+    key = models.CharField(max_length=200, unique=True) # scope and client, e.g. "search:user:12"
+    tokens = models.FloatField()
+    updated = models.FloatField() # unix time tokens was last computed at
+
+    # string representation of this model
+    def __str__(self):
+        '''return a string representation of this model instance'''
+        return f'{self.key}: {self.tokens:.1f} tokens'
+    
 # give User a .profile property 
 User.add_to_class('profile',
     lambda self: Profile.objects.get(user=self)
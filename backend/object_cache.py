@@ -0,0 +1,36 @@
+# File: mini_insta/object_cache.py
+# serialized Posts and Profiles kept in the cache, so batch reads only query the ids that are not cached
+# Author: Nguyen Le
+
+
+from django.conf import settings
+from django.core.cache import cache
+
+# how long a serialized object may be served; writes that change one invalidate it, so this only bounds staleness
+# for the changes that do not (e.g. Posts of a deleted Profile)
+CACHE_TIMEOUT = getattr(settings, 'MINI_INSTA_OBJECT_CACHE_TIMEOUT', 5 * 60)
+
+# kinds of cached objects
+POST = 'post' # the part of a serialized Post that is the same for every viewer and host: no Profile, likes or absolute URLs
+PROFILE = 'profile'
+
+
+def cache_key(kind, pk):
+    '''cache key of one serialized object'''
+    return f'mini_insta:object:{kind}:{pk}'
+
+
+def get_many(kind, pks):
+    '''Return {pk: serialized object} for the pks that are cached'''
+    keys = {cache_key(kind, pk): pk for pk in pks}
+    return {keys[key]: data for key, data in cache.get_many(list(keys)).items()}
+
+
+def set_many(kind, objects):
+    '''Cache {pk: serialized object}'''
+    cache.set_many({cache_key(kind, pk): data for pk, data in objects.items()}, CACHE_TIMEOUT)
+
+
+def invalidate(kind, pks):
+    '''Forget the cached copies of objects that changed'''
+    cache.delete_many([cache_key(kind, pk) for pk in pks])
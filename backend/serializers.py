@@ -1,7 +1,10 @@
 from django.contrib.auth.models import User
+from django.db.models import Count
 from rest_framework import serializers
 
-from .models import Photo, Post, Profile
+from .images import RENDITION_WIDTHS
+from .like_summary import get_like_summaries
+from .models import Activity, ArchivedComment, Follow, Photo, Post, Profile
 
 
 class UserSerializer(serializers.ModelSerializer):
@@ -10,6 +13,22 @@ class UserSerializer(serializers.ModelSerializer):
         fields = ["id", "username", "email", "first_name", "last_name"]
 
 
+def get_follow_counts(profiles):
+    """Return {profile pk: (followers, following)} for Profiles (or Profile pks), in two grouped queries."""
+    profile_ids = {getattr(profile, "pk", profile) for profile in profiles}
+    if not profile_ids:
+        return {}
+    followers = dict(
+        Follow.objects.filter(profile__in=profile_ids)
+        .values_list("profile").annotate(count=Count("pk")).order_by()
+    )
+    following = dict(
+        Follow.objects.filter(follower_profile__in=profile_ids)
+        .values_list("follower_profile").annotate(count=Count("pk")).order_by()
+    )
+    return {pk: (followers.get(pk, 0), following.get(pk, 0)) for pk in profile_ids}
+
+
 class ProfileSerializer(serializers.ModelSerializer):
     user = UserSerializer(read_only=True)
     num_followers = serializers.SerializerMethodField()
@@ -29,37 +48,114 @@ class ProfileSerializer(serializers.ModelSerializer):
             "num_following",
         ]
 
+    def _follow_counts(self, obj):
+        # list views pass every count in the context; otherwise compute (and remember) this one
+        counts = self.context.setdefault("follow_counts", {})
+        if obj.pk not in counts:
+            counts.update(get_follow_counts([obj]))
+        return counts[obj.pk]
+
     def get_num_followers(self, obj):
-        return obj.get_num_followers()
+        return self._follow_counts(obj)[0]
 
     def get_num_following(self, obj):
-        return obj.get_num_following()
+        return self._follow_counts(obj)[1]
+
+
+def absolute_url(request, url):
+    """Return url made absolute for the host of request (no request: unchanged)."""
+    if request is not None and url and url.startswith("/"):
+        return request.build_absolute_uri(url)
+    return url
+
+
+def absolute_photo(request, photo):
+    """Return a serialized photo (kept with relative URLs, see CachedPostSerializer) with absolute URLs."""
+    return {
+        **photo,
+        "image": absolute_url(request, photo["image"]),
+        "renditions": {width: absolute_url(request, url) for width, url in photo["renditions"].items()},
+    }
 
 
 class PhotoSerializer(serializers.ModelSerializer):
     image = serializers.SerializerMethodField()
+    renditions = serializers.SerializerMethodField()
 
     class Meta:
         model = Photo
-        fields = ["id", "image", "timestamp"]
+        fields = ["id", "image", "renditions", "timestamp"]
+
+    def _absolute(self, url):
+        return absolute_url(self.context.get("request"), url)
 
     def get_image(self, obj):
-        request = self.context.get("request")
-        image_url = obj.get_image_url()
-        if request is not None and image_url and image_url.startswith("/"):
-            return request.build_absolute_uri(image_url)
-        return image_url
+        return self._absolute(obj.get_image_url())
+
+    def get_renditions(self, obj):
+        # resized copies keyed by width, so clients can pick one for their screen
+        return {
+            str(width): self._absolute(obj.get_rendition_url(width))
+            for width in RENDITION_WIDTHS
+        }
 
 
 class PostSerializer(serializers.ModelSerializer):
     profile = ProfileSerializer(read_only=True)
     photos = PhotoSerializer(many=True, read_only=True, source="photo_set")
     num_likes = serializers.SerializerMethodField()
+    like_summary = serializers.SerializerMethodField()
 
     class Meta:
         model = Post
-        fields = ["id", "profile", "timestamp", "caption", "photos", "num_likes"]
+        fields = ["id", "profile", "timestamp", "caption", "photos", "num_likes", "like_summary"]
+
+    def _like_summary(self, obj):
+        # list views pass every summary in the context; otherwise compute (and remember) this one
+        summaries = self.context.setdefault("like_summaries", {})
+        if obj.pk not in summaries:
+            request = self.context.get("request")
+            viewer = None
+            if request is not None and request.user.is_authenticated:
+                viewer = Profile.objects.filter(user=request.user).first()
+            summaries.update(get_like_summaries([obj], viewer))
+        return summaries[obj.pk]
 
     def get_num_likes(self, obj):
-        return obj.get_num_likes()
+        return self._like_summary(obj).count
+
+    def get_like_summary(self, obj):
+        return self._like_summary(obj).as_dict()
+
 
+class CachedPostSerializer(PostSerializer):
+    """The part of a post kept in the object cache: the same for every viewer and host.
+
+    The profile is cached on its own and only referenced by id, likes are
+    added for each viewer, and photo URLs stay relative (serialize without a
+    request) until absolute_photo is applied.
+    """
+
+    profile = None
+    num_likes = None
+    like_summary = None
+    profile_id = serializers.IntegerField(read_only=True)
+
+    class Meta(PostSerializer.Meta):
+        fields = ["id", "profile_id", "timestamp", "caption", "photos"]
+
+
+class ActivitySerializer(serializers.ModelSerializer):
+    summary = serializers.CharField(source="get_summary", read_only=True)
+
+    class Meta:
+        model = Activity
+        fields = ["id", "verb", "post", "summary", "actor_count", "recent_actors", "is_read", "updated"]
+
+
+class ArchivedCommentSerializer(serializers.ModelSerializer):
+    username = serializers.CharField(source="profile.username", read_only=True)
+
+    class Meta:
+        model = ArchivedComment
+        fields = ["id", "post", "profile", "username", "timestamp", "text"]
@@ -0,0 +1,124 @@
+# File: mini_insta/storage.py
+# content-addressed storage for uploaded photos: identical uploads share one reference-counted file
+# Author: Nguyen Le
+#
+# This module is imported by models, so models are looked up lazily (apps.get_model).
+
+
+import hashlib
+import os
+import tempfile
+from collections import Counter
+
+from django.apps import apps
+from django.core.files.storage import FileSystemStorage
+from django.db import IntegrityError, transaction
+from django.db.models import F
+
+# every blob lives under this directory, sharded by the first bytes of its hash: blobs/ab/cd/abcd....jpg
+BLOB_DIR = 'blobs'
+TMP_DIR = os.path.join(BLOB_DIR, 'tmp')
+
+
+def blob_name(digest, ext):
+    '''return the storage name of the blob with this sha256 hex digest and file extension'''
+    return '/'.join([BLOB_DIR, digest[:2], digest[2:4], digest + ext])
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    '''FileSystemStorage that names every saved file after the sha256 of its content
+
+    The upload is hashed while it is streamed to a temporary file; if a blob
+    with that hash exists already, the copy is dropped and the existing blob is
+    reused. Each blob has a reference count in the Blob table (one per Photo
+    pointing at it), and release() deletes the file once nothing refers to it.
+    The reference is counted in the transaction saving the file, so it is
+    undone if the row pointing at the blob is never written (Photo.save runs
+    in one transaction for this).
+    Files saved before this storage was used keep their names and are deleted
+    as before.
+    '''
+
+    def get_available_name(self, name, max_length=None):
+        # the final name is decided by _save from the content, and is the same for identical files
+        return name
+
+    def _save(self, name, content):
+        ext = os.path.splitext(name)[1].lower()
+        os.makedirs(self.path(TMP_DIR), exist_ok=True)
+
+        # stream the upload to a temporary file in the same file system, hashing as we go
+        digest = hashlib.sha256()
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=self.path(TMP_DIR))
+        try:
+            with os.fdopen(fd, 'wb') as tmp:
+                for chunk in content.chunks():
+                    digest.update(chunk)
+                    tmp.write(chunk)
+                    size += len(chunk)
+
+            name = blob_name(digest.hexdigest(), ext)
+
+            # count the reference before looking for the file, so a concurrent release cannot delete it in between
+            self.retain(name, size=size)
+            path = self.path(name)
+            if os.path.exists(path):
+                os.unlink(tmp_path) # duplicate upload: keep the blob we already have
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(tmp_path, path) # atomic, a partially written blob is never visible
+                if self.file_permissions_mode is not None:
+                    os.chmod(path, self.file_permissions_mode)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        return name
+
+    def is_blob(self, name):
+        '''whether name is a content-addressed blob (rather than a file saved before, or default.png)'''
+        return name.startswith(BLOB_DIR + '/') and not name.startswith(TMP_DIR + '/')
+
+    def retain(self, name, count=1, size=None):
+        '''Add count references to blob name, e.g. for Photo rows created without uploading (imports)'''
+        Blob = apps.get_model('mini_insta', 'Blob')
+        with transaction.atomic():
+            if Blob.objects.filter(name=name).update(refcount=F('refcount') + count):
+                return
+            if size is None:
+                size = self.size(name) if self.exists(name) else 0
+            try:
+                with transaction.atomic():
+                    Blob.objects.create(name=name, size=size, refcount=count)
+            except IntegrityError:
+                # created by a concurrent upload of the same content
+                Blob.objects.filter(name=name).update(refcount=F('refcount') + count)
+
+    def retain_many(self, names):
+        '''add one reference per occurrence of each blob name in names'''
+        for name, count in Counter(name for name in names if self.is_blob(name)).items():
+            self.retain(name, count)
+
+    def release(self, name, count=1):
+        '''Drop count references to blob name and delete the file when none are left; return whether it was deleted'''
+        Blob = apps.get_model('mini_insta', 'Blob')
+        with transaction.atomic():
+            Blob.objects.filter(name=name).update(refcount=F('refcount') - count)
+            deleted, _ = Blob.objects.filter(name=name, refcount__lte=0).delete()
+            if deleted:
+                # inside the transaction: an upload of the same content waits for it, then writes the blob again
+                super().delete(name)
+        return bool(deleted)
+
+    def delete(self, name):
+        # a blob may be shared, so deleting it only drops one reference
+        if self.is_blob(name):
+            self.release(name)
+        else:
+            super().delete(name)
+
+
+def photo_storage():
+    '''storage of Photo.image_file (a callable, so migrations do not record its location)'''
+    return ContentAddressedStorage()
@@ -0,0 +1,196 @@
+# File: mini_insta/tags.py
+# parse #hashtags and @mentions out of captions and comments into an inverted index, and page through it
+# Author: Nguyen Le
+
+
+import re
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+
+from .models import ArchivedComment, Comment, Hashtag, Mention, Post, PostHashtag, Profile
+
+# Posts per page of a tag
+PAGE_SIZE = getattr(settings, 'MINI_INSTA_TAG_PAGE_SIZE', 20)
+
+# "#sunset", but not the "#1" in "abc#1" or a "##"; the name is stored lowercase
+HASHTAG_RE = re.compile(r'(?<![\w#&])#(\w{1,100})')
+
+# "@nguyen.le"; usernames may contain . + - _ but do not end a sentence with a dot
+MENTION_RE = re.compile(r'(?<![\w@])@(\w[\w.+-]{0,149})')
+
+
+def extract_hashtags(text):
+    '''Return the hashtags of text, lowercase and without #, in order of first use'''
+    return list(dict.fromkeys(name.lower() for name in HASHTAG_RE.findall(text or '')))
+
+
+def extract_mentions(text):
+    '''Return the usernames mentioned in text, in order of first use'''
+    return list(dict.fromkeys(name.rstrip('.') for name in MENTION_RE.findall(text or '')))
+
+
+def get_hashtags(names):
+    '''Return {name: Hashtag pk} for names, creating the missing Hashtags'''
+    names = set(names)
+    if not names:
+        return {}
+    Hashtag.objects.bulk_create([Hashtag(name=name) for name in names], ignore_conflicts=True)
+    return dict(Hashtag.objects.filter(name__in=names).values_list('name', 'pk'))
+
+
+def get_profile_ids(usernames):
+    '''Return {username: Profile pk} for the usernames that belong to a Profile'''
+    usernames = set(usernames)
+    if not usernames:
+        return {}
+    return dict(Profile.objects.filter(username__in=usernames).values_list('username', 'pk'))
+
+
+def index_posts(posts, created=False):
+    '''Rebuild the hashtags and mentions of Posts (caption and every Comment) in a few queries
+
+    Used when a caption changes and by the backfill; new Comments are added
+    with index_comment instead. Archived Comments are read too, and their
+    mentions point at the Post only. Posts just created have no Comments and no
+    index rows to replace, so with created=True only their captions are read
+    (and a caption without tags or mentions costs no query at all).
+    '''
+    posts = list(posts)
+    if not posts:
+        return 0
+    post_ids = [post.pk for post in posts]
+    comments = []
+    if not created:
+        comments = list(Comment.objects.filter(post__in=post_ids).values_list('pk', 'post_id', 'text', 'timestamp'))
+        comments += [(None, *row) for row in ArchivedComment.objects.filter(post__in=post_ids).values_list('post_id', 'text', 'timestamp')]
+
+    # (post, comment or None, text, timestamp) of every caption and comment
+    texts = [(post.pk, None, post.caption, post.timestamp) for post in posts]
+    texts += [(post_id, comment_id, text, timestamp) for comment_id, post_id, text, timestamp in comments]
+    hashtags = {(post_id, name) for post_id, _, text, _ in texts for name in extract_hashtags(text)}
+    mentions = [(post_id, comment_id, username, timestamp) for post_id, comment_id, text, timestamp in texts for username in extract_mentions(text)]
+
+    hashtag_ids = get_hashtags(name for _, name in hashtags)
+    profile_ids = get_profile_ids(username for _, _, username, _ in mentions)
+    timestamps = {post.pk: post.timestamp for post in posts}
+
+    if created and not hashtags and not mentions:
+        return len(posts)
+
+    with transaction.atomic():
+        if not created:
+            PostHashtag.objects.filter(post__in=post_ids).delete()
+            Mention.objects.filter(post__in=post_ids).delete()
+        PostHashtag.objects.bulk_create([
+            PostHashtag(hashtag_id=hashtag_ids[name], post_id=post_id, timestamp=timestamps[post_id])
+            for post_id, name in hashtags
+        ])
+        Mention.objects.bulk_create([
+            Mention(profile_id=profile_ids[username], post_id=post_id, comment_id=comment_id, timestamp=timestamp)
+            for post_id, comment_id, username, timestamp in mentions if username in profile_ids
+        ])
+    return len(posts)
+
+
+def index_post(post, created=False):
+    '''Rebuild the hashtags and mentions of one Post, after it is created or its caption changes'''
+    index_posts([post], created)
+
+
+def index_comment(comment):
+    '''Add the hashtags and mentions of a new Comment to the index of its Post'''
+    hashtag_ids = get_hashtags(extract_hashtags(comment.text))
+    profile_ids = get_profile_ids(extract_mentions(comment.text))
+    if hashtag_ids:
+        timestamp = Post.all_objects.filter(pk=comment.post_id).values_list('timestamp', flat=True).first()
+        PostHashtag.objects.bulk_create([
+            PostHashtag(hashtag_id=hashtag_id, post_id=comment.post_id, timestamp=timestamp)
+            for hashtag_id in hashtag_ids.values()
+        ], ignore_conflicts=True) # the Post may already have the tag
+    Mention.objects.bulk_create([
+        Mention(profile_id=profile_id, post_id=comment.post_id, comment=comment, timestamp=comment.timestamp)
+        for profile_id in profile_ids.values()
+    ])
+
+
+@receiver(post_save, sender=Post)
+def post_saved(sender, instance, created, raw=False, update_fields=None, **kwargs):
+    '''Index a Post whenever it is saved with its caption, whichever view, admin or serializer saved it'''
+    if raw or (update_fields is not None and 'caption' not in update_fields):
+        return
+    index_post(instance, created)
+
+
+@receiver(post_save, sender=Comment)
+def comment_saved(sender, instance, created, raw=False, **kwargs):
+    '''Index a new Comment, or rebuild its Post's index when a Comment is edited (e.g. in the admin)'''
+    if raw:
+        return
+    if created:
+        index_comment(instance)
+    else:
+        index_post_ids([instance.post_id])
+
+
+def index_post_ids(post_ids, batch_size=1000):
+    '''Rebuild the index of the Posts with post_ids, batch_size Posts at a time'''
+    post_ids = sorted(post_ids)
+    for i in range(0, len(post_ids), batch_size):
+        index_posts(Post.objects.filter(pk__in=post_ids[i:i + batch_size]).only('pk', 'caption', 'timestamp'))
+
+
+def backfill(batch_size=1000, after=0):
+    '''Index every Post with pk > after in batches of batch_size; yields (Posts indexed, last pk) per batch'''
+    while True:
+        posts = list(Post.objects.filter(pk__gt=after).order_by('pk').only('pk', 'caption', 'timestamp')[:batch_size])
+        if not posts:
+            return
+        after = posts[-1].pk
+        yield index_posts(posts), after
+
+
+'''
+pages of a tag, newest first, keyed by (timestamp, post) so a page costs one index range scan
+'''
+
+def encode_cursor(timestamp, post_id):
+    '''opaque cursor of the position after (timestamp, post_id)'''
+    delta = timestamp - datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+    return f'{delta // timedelta(microseconds=1)}.{post_id}'
+
+
+def decode_cursor(cursor):
+    '''Return (timestamp, post_id) of a cursor; raises ValueError for a malformed one'''
+    microseconds, post_id = cursor.split('.')
+    post_id = int(post_id)
+    try:
+        timestamp = datetime(1970, 1, 1, tzinfo=dt_timezone.utc) + timedelta(microseconds=int(microseconds))
+    except OverflowError:
+        raise ValueError(f'cursor out of range: {cursor}')
+    # beyond a 64-bit primary key the database itself overflows
+    if not 0 <= post_id < 2 ** 63:
+        raise ValueError(f'cursor out of range: {cursor}')
+    return timestamp, post_id
+
+
+def tagged_posts(name, cursor=None, limit=PAGE_SIZE):
+    '''Return (Posts tagged #name, cursor of the next page or None), newest first
+
+    The Posts have their profile selected and their photos prefetched.
+    Raises ValueError for a malformed cursor.
+    '''
+    rows = PostHashtag.objects.filter(hashtag__name=name.lower(), post__deleted_at__isnull=True)
+    if cursor:
+        timestamp, post_id = decode_cursor(cursor)
+        rows = rows.filter(Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, post_id__lt=post_id))
+    rows = list(
+        rows.order_by('-timestamp', '-post_id')
+        .select_related('post__profile__user').prefetch_related('post__photo_set')[:limit + 1]
+    )
+    next_cursor = encode_cursor(rows[limit - 1].timestamp, rows[limit - 1].post_id) if len(rows) > limit else None
+    return [row.post for row in rows[:limit]], next_cursor
@@ -0,0 +1,153 @@
+# File: mini_insta/taskqueue.py
+# a small database-backed task queue for work that should not block a request
+# Author: Nguyen Le
+
+
+import logging
+import random
+import traceback
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from .models import Task
+
+logger = logging.getLogger(__name__)
+
+# retry backoff: BACKOFF_BASE * 2**attempt seconds, capped, plus jitter
+BACKOFF_BASE = getattr(settings, 'MINI_INSTA_TASKS_BACKOFF_BASE', 2)
+BACKOFF_MAX = getattr(settings, 'MINI_INSTA_TASKS_BACKOFF_MAX', 15 * 60)
+
+# a RUNNING task whose worker has been silent this long is assumed dead and handed out again
+LOCK_TIMEOUT = getattr(settings, 'MINI_INSTA_TASKS_LOCK_TIMEOUT', 10 * 60)
+
+# registered task functions, by name
+registry = {}
+
+
+def task(name=None, max_attempts=5):
+    '''Decorator registering a function as a task that can be passed to enqueue()
+
+    The function is called with the keyword arguments given to enqueue(), so they
+    must be JSON serializable. Tasks may run more than once and should be idempotent.
+    '''
+    def decorator(func):
+        func.task_name = name or func.__name__
+        func.max_attempts = max_attempts
+        registry[func.task_name] = func
+        return func
+    return decorator
+
+
+def always_eager():
+    '''whether tasks run in-process as soon as the surrounding transaction commits, instead of queueing a row
+
+    Read on every enqueue, so tests can turn it on with override_settings.
+    '''
+    return getattr(settings, 'MINI_INSTA_TASKS_ALWAYS_EAGER', False)
+
+
+def enqueue(func, idempotency_key=None, countdown=0, using=None, **kwargs):
+    '''Schedule func(**kwargs) to run in a worker once the current transaction commits
+
+    With an idempotency_key, enqueueing the same key again is a no-op for as long
+    as the earlier Task row exists.
+    '''
+    eager = always_eager()
+
+    def create():
+        if eager:
+            func(**kwargs)
+            return
+        try:
+            with transaction.atomic(using=using):
+                Task.objects.using(using).create(
+                    name=func.task_name,
+                    payload=kwargs,
+                    idempotency_key=idempotency_key,
+                    max_attempts=func.max_attempts,
+                    run_at=timezone.now() + timedelta(seconds=countdown),
+                )
+        except IntegrityError:
+            # same idempotency_key already queued (or already done)
+            pass
+
+    transaction.on_commit(create, using=using)
+
+
+def backoff(attempts):
+    '''Return how long to wait before retrying a task that has failed attempts times'''
+    delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempts)
+    return timedelta(seconds=delay + random.uniform(0, delay / 4))
+
+
+def claim(limit=10):
+    '''Mark up to limit due tasks as RUNNING for this worker and return them
+
+    Each row is claimed with a conditional UPDATE, so concurrent workers never
+    run the same task at the same time, on any database backend.
+    '''
+    now = timezone.now()
+    stale = now - timedelta(seconds=LOCK_TIMEOUT)
+
+    candidates = list(
+        Task.objects.filter(status=Task.PENDING, run_at__lte=now).order_by('run_at').values_list('pk', flat=True)[:limit]
+    ) + list(
+        Task.objects.filter(status=Task.RUNNING, locked_at__lt=stale).values_list('pk', flat=True)[:limit]
+    )
+
+    claimed = []
+    for pk in candidates:
+        updated = Task.objects.filter(pk=pk, status__in=[Task.PENDING, Task.RUNNING], run_at__lte=now).exclude(
+            status=Task.RUNNING, locked_at__gte=stale
+        ).update(status=Task.RUNNING, locked_at=now)
+        if updated:
+            claimed.append(pk)
+    return list(Task.objects.filter(pk__in=claimed))
+
+
+def execute(task_row):
+    '''Run one claimed task and record the outcome, scheduling a retry on failure'''
+    func = registry.get(task_row.name)
+    task_row.attempts += 1
+    try:
+        if func is None:
+            raise LookupError(f'no task registered as {task_row.name!r}')
+        func(**task_row.payload)
+    except Exception:
+        task_row.last_error = traceback.format_exc()
+        if task_row.attempts >= task_row.max_attempts:
+            task_row.status = Task.FAILED
+            logger.error('task %s failed permanently after %s attempts', task_row.pk, task_row.attempts)
+        else:
+            task_row.status = Task.PENDING
+            task_row.run_at = timezone.now() + backoff(task_row.attempts)
+            logger.warning('task %s failed, retrying at %s', task_row.pk, task_row.run_at)
+    else:
+        task_row.status = Task.DONE
+        task_row.last_error = ''
+    task_row.locked_at = None
+    task_row.save(update_fields=['attempts', 'status', 'run_at', 'locked_at', 'last_error'])
+    return task_row.status
+
+
+def run_pending(limit=100):
+    '''Run due tasks in this process until none are left (or limit is reached) and return how many ran'''
+    ran = 0
+    while ran < limit:
+        batch = claim(min(10, limit - ran))
+        if not batch:
+            break
+        for task_row in batch:
+            execute(task_row)
+            ran += 1
+    return ran
+
+
+def purge_finished(older_than=timedelta(days=7)):
+    '''Delete DONE tasks older than older_than, which also frees their idempotency keys'''
+    cutoff = timezone.now() - older_than
+    deleted, _ = Task.objects.filter(status=Task.DONE, created__lt=cutoff).delete()
+    return deleted
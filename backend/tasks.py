@@ -0,0 +1,48 @@
+# File: mini_insta/tasks.py
+# background tasks run by the run_workers management command
+# Author: Nguyen Le
+
+
+from django.apps import apps
+
+from . import activity, deletion, images
+from .models import Photo, Post, Profile
+from .taskqueue import task
+
+
+@task()
+def render_photo_renditions(photo_ids, widths=None, fmt='webp'):
+    '''Pre-render resized copies of newly uploaded Photos, so the first viewer does not pay for the resize'''
+    for photo in Photo.objects.filter(pk__in=photo_ids):
+        for width in widths or images.RENDITION_WIDTHS:
+            images.get_rendition(photo, width, fmt)
+
+
+@task()
+def record_activity(events):
+    '''Merge like, follow and comment events into the recipients' activity inboxes'''
+    activity.record_events(events)
+
+
+@task()
+def purge_posts(post_ids):
+    '''Delete Posts hidden by deletion.delete_post, with all their photos, comments and likes, in batches'''
+    deletion.purge(Post.all_objects.filter(pk__in=post_ids))
+
+
+@task()
+def purge_profiles(profile_ids):
+    '''Delete Profiles and everything that hangs off them, in batches'''
+    deletion.purge(Profile.objects.filter(pk__in=profile_ids))
+
+
+@task()
+def purge_rows(model, pks):
+    '''Delete rows of a model (its label, e.g. "mini_insta.like") and their dependents, in batches'''
+    deletion.purge(apps.get_model(model)._base_manager.filter(pk__in=pks))
+
+
+@task()
+def delete_orphaned_files(names):
+    '''Remove image files of deleted Photos from storage'''
+    deletion.delete_orphaned_files(names)
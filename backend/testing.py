@@ -0,0 +1,191 @@
+# File: mini_insta/testing.py
+# helpers for tests
+# Author: Nguyen Le
+
+
+import os
+import re
+import traceback
+from collections import Counter
+from contextlib import contextmanager
+from functools import wraps
+
+from django.core.cache import cache
+from django.db import connections, transaction
+from django.template import Template
+from django.urls import URLPattern, get_resolver
+
+# frames from this app's code are the ones worth showing in a query report
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class TemplateQueryError(AssertionError):
+    '''raised when a template runs a database query while rendering'''
+
+
+@contextmanager
+def forbid_template_queries():
+    '''Fail the test if any template rendered inside this block hits the database
+
+    Views are expected to hand templates fully loaded objects (select_related,
+    prefetch_related, counts in the context); a query during rendering is an
+    N+1 waiting to happen.
+    '''
+    depth = 0
+    original_render = Template._render
+
+    def render(self, context):
+        nonlocal depth
+        depth += 1
+        try:
+            return original_render(self, context)
+        finally:
+            depth -= 1
+
+    def blocker(execute, sql, params, many, context):
+        if depth:
+            raise TemplateQueryError(f'query while rendering a template: {sql}')
+        return execute(sql, params, many, context)
+
+    Template._render = render
+    try:
+        with _wrap_all(blocker):
+            yield
+    finally:
+        Template._render = original_render
+
+
+@contextmanager
+def _wrap_all(wrapper):
+    '''install an execute wrapper on every database connection'''
+    wrapped = []
+    try:
+        for alias in connections:
+            connection = connections[alias]
+            connection.execute_wrappers.append(wrapper)
+            wrapped.append(connection)
+        yield
+    finally:
+        for connection in wrapped:
+            connection.execute_wrappers.remove(wrapper)
+
+
+class CapturedQuery:
+    '''one query run inside capture_queries, and the app code that ran it'''
+
+    def __init__(self, sql, stack):
+        self.sql = sql
+        self.stack = stack # traceback.FrameSummary list, innermost last
+
+    def normalized(self):
+        '''the SQL with IN lists collapsed, so the same query over different rows compares equal'''
+        return re.sub(r'%s(, %s)+', '%s, ...', self.sql)
+
+
+def app_stack(limit=6):
+    '''the innermost frames of the current stack that are in this app (tests and views), outside this module'''
+    here = os.path.abspath(__file__)
+    frames = [
+        frame for frame in traceback.extract_stack()
+        if frame.filename.startswith(APP_DIR) and os.path.abspath(frame.filename) != here
+    ]
+    return frames[-limit:]
+
+
+@contextmanager
+def capture_queries():
+    '''Record every query run inside this block, on any database; yields the list of CapturedQuery'''
+    queries = []
+
+    def recorder(execute, sql, params, many, context):
+        queries.append(CapturedQuery(sql, app_stack()))
+        return execute(sql, params, many, context)
+
+    with _wrap_all(recorder):
+        yield queries
+
+
+def format_queries(queries):
+    '''numbered SQL of each query, each followed by the app code that ran it'''
+    lines = []
+    for number, query in enumerate(queries, start=1):
+        lines.append(f'{number}. {query.sql}')
+        for frame in query.stack:
+            lines.append(f'     {os.path.relpath(frame.filename, APP_DIR)}:{frame.lineno} in {frame.name}: {frame.line}')
+    return '\n'.join(lines)
+
+
+def all_route_names(resolver=None, namespace=''):
+    '''return the names of every URL pattern under resolver (the root URLconf by default), with their namespaces'''
+    resolver = resolver or get_resolver()
+    names = set()
+    for pattern in resolver.url_patterns:
+        if isinstance(pattern, URLPattern):
+            if pattern.name:
+                names.add(namespace + pattern.name)
+        else:
+            names |= all_route_names(pattern, namespace + (f'{pattern.namespace}:' if pattern.namespace else ''))
+    return names
+
+
+def query_budget(route, budget, scales=(1, 4), anonymous=False):
+    '''Declare that the test of route runs at most budget queries, whatever the size of the data
+
+    Decorates a method of a QueryBudgetMixin TestCase that requests route. The method
+    runs once per scale n in scales, each time after self.seed(n) and with an
+    empty cache, and everything is rolled back afterwards. The test fails when
+    a run goes over budget, when the number of queries changes with n (a query
+    per row), or when a template runs a query. With anonymous=True the client is
+    logged out after seeding, outside of the count.
+    '''
+    def decorator(test):
+        @wraps(test)
+        def run(self):
+            runs = {}
+            for n in scales:
+                with transaction.atomic():
+                    self.seed(n)
+                    if anonymous:
+                        self.client.logout()
+                    cache.clear()
+                    with forbid_template_queries(), capture_queries() as queries:
+                        test(self)
+                    transaction.set_rollback(True)
+                runs[n] = queries
+            self.assertQueryBudget(route, budget, runs)
+
+        run.query_budget_route = route
+        return run
+    return decorator
+
+
+class QueryBudgetMixin:
+    '''Mixin for the TestCase holding query_budget tests
+
+    The TestCase defines seed(self, n), which creates data that grows with n
+    and is called by every query_budget test before each run. Being a mixin,
+    this is never collected as a test case itself.
+    '''
+
+    @classmethod
+    def budgeted_routes(cls):
+        '''names of the routes that have a query_budget test in this class'''
+        return {
+            getattr(member, 'query_budget_route') for member in vars(cls).values()
+            if hasattr(member, 'query_budget_route')
+        }
+
+    def assertQueryBudget(self, route, budget, runs):
+        '''check the queries captured per scale ({n: [CapturedQuery]}) against budget and against each other'''
+        scales = sorted(runs)
+        smallest, largest = runs[scales[0]], runs[scales[-1]]
+        if len(largest) != len(smallest):
+            grown = Counter(query.normalized() for query in largest) - Counter(query.normalized() for query in smallest)
+            examples = [next(query for query in largest if query.normalized() == sql) for sql in grown]
+            self.fail(
+                f'{route}: {len(smallest)} queries with n={scales[0]} but {len(largest)} with n={scales[-1]}; '
+                f'these run more often as the data grows:\n{format_queries(examples)}'
+            )
+        for n in scales:
+            if len(runs[n]) > budget:
+                self.fail(f'{route}: {len(runs[n])} queries with n={n}, over the budget of {budget}:\n{format_queries(runs[n])}')
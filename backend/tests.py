@@ -1,3 +1,1277 @@
-from django.test import TestCase
+import csv
+import gzip
+import json
+import os
+import shutil
+import tempfile
+from datetime import timedelta
+from io import BytesIO, StringIO
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.http import HttpResponse
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connection, router, transaction
+from django.test import RequestFactory, TestCase, TransactionTestCase, modify_settings, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import get_resolver, resolve, reverse
+from django.utils import timezone
+from PIL import Image
+
+from . import activity, admin, api_urls, api_views, archive, compression, db_router, deletion, fragments, images, tags, taskqueue, tasks, throttling, views, warmup, write_buffer
+from .fragments import attach_fragments
+from .like_summary import attach_like_summaries, get_like_summaries
+from .models import Activity, ArchivedComment, ArchivedLike, Blob, Comment, Follow, Like, Mention, Photo, Post, Profile, RateLimitBucket, Task
+from .testing import QueryBudgetMixin, all_route_names, query_budget
 
 # Create your tests here.
+
+
+def png_bytes(size=(64, 48)):
+    '''the content of a small PNG file'''
+    data = BytesIO()
+    Image.new('RGB', size, (200, 80, 40)).save(data, 'PNG')
+    return data.getvalue()
+
+
+def png_upload(name='photo.png'):
+    '''a small uploaded PNG file'''
+    return SimpleUploadedFile(name, png_bytes(), content_type='image/png')
+
+
+# urls downloaded by fetch_png
+fetched_urls = []
+
+
+def fetch_png(url):
+    '''local stand-in for images.fetch_url, so legacy image_url photos are never downloaded'''
+    fetched_urls.append(url)
+    return png_bytes((400, 300))
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class RouteQueryBudgetTests(QueryBudgetMixin, TestCase):
+    '''Every route has a query budget that holds whatever the number of posts, photos, comments, likes and follows'''
+
+    PASSWORD = 'budget-password'
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # uploads and renditions go to a throwaway directory
+        cls.media_root = tempfile.mkdtemp()
+        cls.media = override_settings(MEDIA_ROOT=cls.media_root)
+        cls.media.enable()
+        cls.renditions = mock.patch.object(images, 'rendition_cache', images.RenditionCache(f'{cls.media_root}/renditions', 10 * 1024 * 1024))
+        cls.renditions.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.renditions.stop()
+        cls.media.disable()
+        shutil.rmtree(cls.media_root, ignore_errors=True)
+        super().tearDownClass()
+
+    def setUp(self):
+        # write likes and follows right away instead of from a timer thread
+        patcher = mock.patch.object(write_buffer.write_buffer, 'window', 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def make_profiles(self, *usernames):
+        '''Profiles (and Users that can log in with PASSWORD) for usernames'''
+        users = User.objects.bulk_create([User(username=username) for username in usernames])
+        for user in users:
+            user.set_password(self.PASSWORD)
+            user.save(update_fields=['password'])
+        return Profile.objects.bulk_create([
+            Profile(user=user, username=user.username, display_name=user.username.title(), bio_text=f'bio of {user.username}')
+            for user in users
+        ])
+
+    def seed(self, n):
+        '''a viewer and an author, with n of everything that a page lists'''
+        self.viewer, self.author, self.newcomer, *others = self.make_profiles(
+            'viewer', 'author', 'newcomer', *(f'seed{i}' for i in range(n))
+        )
+
+        # the viewer follows the author and n others, the author has n + 1 followers
+        Follow.objects.bulk_create(
+            [Follow(profile=self.author, follower_profile=self.viewer)]
+            + [Follow(profile=other, follower_profile=self.viewer) for other in others]
+            + [Follow(profile=self.author, follower_profile=other) for other in others]
+        )
+
+        # n posts by the author and one by each other profile, each with two photos, n comments and n likes
+        posts = [Post.objects.create(profile=self.author, caption=f'seeded post {i} #sunset') for i in range(n)]
+        posts += [Post.objects.create(profile=other, caption=f'seeded post by {other.username} #Sunset #beach') for other in others]
+        self.own_post = Post.objects.create(profile=self.viewer, caption='seeded post of the viewer')
+        posts.append(self.own_post)
+        Photo.objects.bulk_create([Photo(post=post, image_file='default.png') for post in posts for _ in range(2)])
+        Comment.objects.bulk_create([Comment(post=post, profile=other, text='nice @viewer #sunset') for post in posts for other in others])
+        Like.objects.bulk_create([Like(post=post, profile=other) for post in posts for other in others])
+        tags.index_posts(posts)
+        self.posts = posts
+        self.post = posts[0]
+
+        # and n older comments on the first post, moved to the archive
+        ArchivedComment.objects.bulk_create([
+            ArchivedComment(post=self.post, profile=other, timestamp=timezone.now(), text='archived') for other in others
+        ])
+        Post.objects.filter(pk=self.post.pk).update(archived_comment_count=n)
+        self.photo = Photo.objects.create(post=self.post, image_file=png_upload())
+
+        Activity.objects.bulk_create([
+            Activity(recipient=self.viewer, verb=Activity.FOLLOW, group_key=f'follow:{i}', actor_count=1,
+                     recent_actors=[{'id': other.pk, 'username': other.username}])
+            for i, other in enumerate(others)
+        ])
+
+        self.client.force_login(self.viewer.user)
+
+    def get_ok(self, url, **extra):
+        response = self.client.get(url, **extra)
+        self.assertLess(response.status_code, 400, url)
+        response.getvalue() # a streaming response runs its queries as it is read
+        return response
+
+    def post_ok(self, url, data=None, **extra):
+        response = self.client.post(url, data or {}, **extra)
+        self.assertLess(response.status_code, 400, url)
+        return response
+
+    '''
+    views without authentication
+    '''
+
+    @query_budget('show_all_profiles', 3)
+    def test_show_all_profiles(self):
+        self.get_ok(reverse('show_all_profiles'))
+
+    @query_budget('show_profile', 9)
+    def test_show_profile(self):
+        self.get_ok(reverse('show_profile', args=[self.author.pk]))
+
+    @query_budget('show_post', 8)
+    def test_show_post(self):
+        self.get_ok(reverse('show_post', args=[self.post.pk]))
+
+    @query_budget('show_tag', 8)
+    def test_show_tag(self):
+        self.get_ok(reverse('show_tag', args=['sunset']))
+
+    @query_budget('archived_comments', 4)
+    def test_archived_comments(self):
+        self.get_ok(reverse('archived_comments', args=[self.post.pk]))
+
+    @query_budget('photo_rendition', 1)
+    def test_photo_rendition(self):
+        self.get_ok(reverse('photo_rendition', args=[self.photo.pk]) + '?w=160&fmt=png')
+
+    @query_budget('show_followers', 4)
+    def test_show_followers(self):
+        self.get_ok(reverse('show_followers', args=[self.author.pk]))
+
+    @query_budget('show_following', 4)
+    def test_show_following(self):
+        self.get_ok(reverse('show_following', args=[self.viewer.pk]))
+
+    @query_budget('create_profile', 0, anonymous=True)
+    def test_create_profile(self):
+        self.get_ok(reverse('create_profile'))
+
+    @query_budget('login', 9, anonymous=True)
+    def test_login(self):
+        self.post_ok(reverse('login'), {'username': 'viewer', 'password': self.PASSWORD})
+
+    @query_budget('logout_confirmation', 0, anonymous=True)
+    def test_logout_confirmation(self):
+        self.get_ok(reverse('logout_confirmation'))
+
+    '''
+    views with authentication
+    '''
+
+    @query_budget('create_post', 12)
+    def test_create_post(self):
+        self.post_ok(reverse('create_post'), {'caption': 'new post', 'files': [png_upload()]})
+
+    @query_budget('update_profile', 3)
+    def test_update_profile(self):
+        self.get_ok(reverse('update_profile'))
+
+    @query_budget('show_feed', 8)
+    def test_show_feed(self):
+        self.get_ok(reverse('show_feed'))
+
+    @query_budget('search', 23)
+    def test_search(self):
+        self.get_ok(reverse('search') + '?query=seed')
+
+    @query_budget('profile', 9)
+    def test_profile(self):
+        self.get_ok(reverse('profile'))
+
+    @query_budget('delete_post', 6)
+    def test_delete_post(self):
+        self.post_ok(reverse('delete_post', args=[self.own_post.pk]))
+
+    @query_budget('update_post', 4)
+    def test_update_post(self):
+        self.get_ok(reverse('update_post', args=[self.own_post.pk]))
+
+    @query_budget('add_comment', 6)
+    def test_add_comment(self):
+        self.post_ok(reverse('add_comment', args=[self.post.pk]), {'text': 'another comment'})
+
+    @query_budget('follow', 8)
+    def test_follow(self):
+        self.post_ok(reverse('follow', args=[self.newcomer.pk]))
+
+    @query_budget('unfollow', 8)
+    def test_unfollow(self):
+        self.post_ok(reverse('unfollow', args=[self.author.pk]))
+
+    @query_budget('like', 8)
+    def test_like(self):
+        self.post_ok(reverse('like', args=[self.post.pk]))
+
+    @query_budget('unlike', 8)
+    def test_unlike(self):
+        self.post_ok(reverse('unlike', args=[self.post.pk]))
+
+    @query_budget('logout', 4)
+    def test_logout(self):
+        self.post_ok(reverse('logout'))
+
+    '''
+    REST API
+    '''
+
+    @query_budget('api:profile_list', 5)
+    def test_api_profile_list(self):
+        self.get_ok(reverse('api:profile_list'))
+
+    @query_budget('api:profile_detail', 5)
+    def test_api_profile_detail(self):
+        self.get_ok(reverse('api:profile_detail', args=[self.author.pk]))
+
+    @query_budget('api:profile_posts', 10)
+    def test_api_profile_posts(self):
+        self.get_ok(reverse('api:profile_posts', args=[self.author.pk]))
+
+    @query_budget('api:profile_feed', 10)
+    def test_api_profile_feed(self):
+        self.get_ok(reverse('api:profile_feed', args=[self.viewer.pk]))
+
+    @query_budget('api:profile_activity', 5)
+    def test_api_profile_activity(self):
+        self.get_ok(reverse('api:profile_activity', args=[self.viewer.pk]))
+
+    @query_budget('api:tag_posts', 9)
+    def test_api_tag_posts(self):
+        self.get_ok(reverse('api:tag_posts', args=['sunset']))
+
+    @query_budget('api:archived_comments', 4)
+    def test_api_archived_comments(self):
+        self.get_ok(reverse('api:archived_comments', args=[self.post.pk]))
+
+    @query_budget('api:post_batch', 10)
+    def test_api_post_batch(self):
+        ids = [post.pk for post in self.posts] + [0]
+        self.get_ok(reverse('api:post_batch') + '?ids=' + ','.join(map(str, ids)))
+
+    @query_budget('api:profile_batch', 8)
+    def test_api_profile_batch(self):
+        ids = [post.profile_id for post in self.posts] + [0]
+        self.get_ok(reverse('api:profile_batch') + '?ids=' + ','.join(map(str, ids)))
+
+    @query_budget('api:create_post', 29)
+    def test_api_create_post(self):
+        self.post_ok(reverse('api:create_post'), {'caption': 'new post', 'photos': [png_upload()]})
+
+    @query_budget('api:login', 23, anonymous=True)
+    def test_api_login(self):
+        self.post_ok(reverse('api:login'), {'username': 'viewer', 'password': self.PASSWORD})
+
+    @query_budget('api:current_user', 6)
+    def test_api_current_user(self):
+        self.get_ok(reverse('api:current_user'))
+
+    def test_every_route_has_a_budget(self):
+        '''a new route in urls.py (or api_urls.py) needs a query_budget test here'''
+        routes = all_route_names(get_resolver(f'{__package__}.urls'))
+        routes -= {f'api_{name}' for name in api_urls.LEGACY_NAMES} # old names of routes tested under api:
+        self.assertEqual(set(), routes - self.budgeted_routes())
+
+
+# calls of the tasks below, by the test tasks
+task_calls = []
+
+
+@taskqueue.task(name='tests.remember')
+def remember(value):
+    '''test task: record its argument'''
+    task_calls.append(value)
+
+
+@taskqueue.task(name='tests.explode', max_attempts=2)
+def explode():
+    '''test task: always fails'''
+    raise RuntimeError('boom')
+
+
+class TaskQueueTests(TestCase):
+    '''Tasks are queued when the transaction commits, run by workers, and retried with backoff until they give up'''
+
+    def setUp(self):
+        task_calls.clear()
+
+    def test_enqueued_on_commit_and_run(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            taskqueue.enqueue(remember, value=1)
+            self.assertFalse(Task.objects.exists()) # nothing until the transaction commits
+        row = Task.objects.get()
+        self.assertEqual((row.name, row.payload, row.status), ('tests.remember', {'value': 1}, Task.PENDING))
+
+        self.assertEqual(taskqueue.run_pending(), 1)
+        self.assertEqual(task_calls, [1])
+        self.assertEqual(Task.objects.get().status, Task.DONE)
+        self.assertEqual(taskqueue.run_pending(), 0)
+
+    def test_rolled_back_and_duplicate_tasks_are_not_queued(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            try:
+                with transaction.atomic():
+                    taskqueue.enqueue(remember, value='rolled back')
+                    raise RuntimeError
+            except RuntimeError:
+                pass
+            taskqueue.enqueue(remember, idempotency_key='once', value=1)
+            taskqueue.enqueue(remember, idempotency_key='once', value=2)
+        self.assertEqual(list(Task.objects.values_list('payload', flat=True)), [{'value': 1}])
+
+    @override_settings(MINI_INSTA_TASKS_ALWAYS_EAGER=True)
+    def test_eager_mode_runs_in_process(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            taskqueue.enqueue(remember, value='now')
+            self.assertEqual(task_calls, [])
+        self.assertEqual(task_calls, ['now'])
+        self.assertFalse(Task.objects.exists())
+
+    def test_failing_task_is_retried_then_failed(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            taskqueue.enqueue(explode)
+        taskqueue.run_pending()
+        row = Task.objects.get()
+        self.assertEqual((row.status, row.attempts), (Task.PENDING, 1))
+        self.assertIn('boom', row.last_error)
+        self.assertGreater(row.run_at, timezone.now()) # backed off
+        self.assertEqual(taskqueue.run_pending(), 0)
+
+        Task.objects.update(run_at=timezone.now())
+        taskqueue.run_pending()
+        row.refresh_from_db()
+        self.assertEqual((row.status, row.attempts), (Task.FAILED, 2))
+
+
+class WriteBufferTests(TestCase):
+    '''Bursts of toggles are written as their net change, published for other processes, and kept when a write fails'''
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author, cls.fan = Profile.objects.bulk_create([
+            Profile(user=User.objects.create(username=name), username=name, display_name=name.title()) for name in ['author', 'fan']
+        ])
+        cls.post = Post.objects.create(profile=cls.author, caption='post')
+
+    def make_buffer(self):
+        '''a buffer that only writes when flushed'''
+        buffer = write_buffer.WriteBuffer(window=60)
+        self.addCleanup(lambda: buffer._timer and buffer._timer.cancel())
+        return buffer
+
+    def test_bursts_are_coalesced(self):
+        buffer = self.make_buffer()
+        for state in [True, False, True]:
+            buffer.set(write_buffer.LIKE, self.fan.pk, self.post.pk, state)
+        buffer.set(write_buffer.FOLLOW, self.fan.pk, self.author.pk, True)
+        buffer.set(write_buffer.FOLLOW, self.fan.pk, self.author.pk, False)
+        self.assertFalse(Like.objects.exists())
+
+        buffer.flush()
+        self.assertEqual(Like.objects.filter(post=self.post, profile=self.fan).count(), 1)
+        self.assertFalse(Follow.objects.exists())
+
+        buffer.set(write_buffer.LIKE, self.fan.pk, self.post.pk, True)
+        buffer.flush() # liked already: no second row
+        self.assertEqual(Like.objects.count(), 1)
+
+    def test_pending_toggles_are_seen_by_other_processes(self):
+        buffer = self.make_buffer()
+        buffer.set(write_buffer.LIKE, self.fan.pk, self.post.pk, True)
+        other_process = write_buffer.WriteBuffer()
+        self.assertTrue(other_process.pending_state(write_buffer.LIKE, self.fan.pk, self.post.pk))
+        self.assertEqual(other_process.pending_states(write_buffer.LIKE, self.fan.pk, [self.post.pk, 0]), {self.post.pk: True})
+        with self.captureOnCommitCallbacks(execute=True):
+            buffer.flush()
+        self.assertIsNone(other_process.pending_state(write_buffer.LIKE, self.fan.pk, self.post.pk)) # written
+
+    def test_rejected_toggles_are_not_shown(self):
+        buffer = self.make_buffer()
+        buffer.set(write_buffer.LIKE, self.author.pk, self.post.pk, True) # own post
+        buffer.set(write_buffer.FOLLOW, self.fan.pk, 0, True) # no such profile
+        with self.captureOnCommitCallbacks(execute=True):
+            buffer.flush()
+        self.assertFalse(Like.objects.exists())
+        self.assertIsNone(buffer.pending_state(write_buffer.LIKE, self.author.pk, self.post.pk))
+        self.assertIsNone(buffer.pending_state(write_buffer.FOLLOW, self.fan.pk, 0))
+
+    def test_failed_flush_keeps_the_toggles(self):
+        buffer = self.make_buffer()
+        buffer.set(write_buffer.LIKE, self.fan.pk, self.post.pk, True)
+        with mock.patch.object(Like.objects, 'bulk_create', side_effect=DatabaseError('database is down')):
+            with self.assertRaises(DatabaseError):
+                buffer.flush()
+        self.assertFalse(Like.objects.exists())
+        self.assertIsNotNone(buffer._timer) # retried by the next timer
+
+        buffer.flush()
+        self.assertTrue(Like.objects.filter(post=self.post, profile=self.fan).exists())
+
+
+class ActivityTests(TestCase):
+    '''Events are merged into one Activity per bucket, counting each actor once'''
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author, *cls.fans = Profile.objects.bulk_create([
+            Profile(user=User.objects.create(username=name), username=name, display_name=name.title())
+            for name in ['author', 'fan0', 'fan1', 'fan2', 'fan3']
+        ])
+        cls.post = Post.objects.create(profile=cls.author, caption='post')
+
+    def like(self, fan, when=None):
+        activity.record_events([activity.make_event(Activity.LIKE, fan.pk, self.author.pk, self.post.pk, when)])
+
+    def test_actor_acting_again_is_counted_once(self):
+        for fan in self.fans:
+            self.like(fan)
+        # the first fan is no longer among the recent actors, but likes again
+        self.like(self.fans[0])
+        row = Activity.objects.get()
+        self.assertEqual(row.actor_count, 4)
+        self.assertEqual([actor['id'] for actor in row.recent_actors], [self.fans[0].pk, self.fans[3].pk, self.fans[2].pk])
+        self.assertEqual(row.get_summary(), '@fan0 and 3 others liked your post')
+
+    def test_merged_buckets_count_each_actor_once(self):
+        for fan in self.fans:
+            self.like(fan)
+        # a later bucket with one new and one returning actor
+        self.like(self.fans[0], timezone.now() + timedelta(seconds=activity.BUCKET_SECONDS))
+        self.assertEqual(Activity.objects.count(), 2)
+
+        merged, _ = activity.compact(merge_after=timedelta(days=-2)) # both buckets count as old
+        self.assertEqual(merged, 1)
+        self.assertEqual(Activity.objects.get().actor_count, 4)
+
+        # a group another compaction merged meanwhile is left alone
+        group = {'recipient_id': self.author.pk, 'verb': Activity.LIKE, 'post_id': self.post.pk}
+        self.assertEqual(activity.merge_group(group, timezone.now() + timedelta(days=2)), 0)
+
+    def test_delayed_events_keep_their_time(self):
+        happened = timezone.now() - timedelta(seconds=activity.BUCKET_SECONDS * 2)
+        self.like(self.fans[0], happened) # processed late, e.g. after retries
+        self.like(self.fans[1])
+        old, new = Activity.objects.order_by('updated')
+        self.assertEqual(old.updated, happened)
+        self.assertEqual([actor['id'] for actor in old.recent_actors], [self.fans[0].pk])
+        self.assertEqual(new.actor_count, 1)
+
+
+@override_settings(
+    DATABASE_ROUTERS=['mini_insta.db_router.PrimaryReplicaRouter'],
+    MINI_INSTA_DATABASE_REPLICAS=['replica'], # only named, the router never connects to it
+    MINI_INSTA_PRIMARY_PIN_SECONDS=5,
+)
+class ReplicaRoutingTests(TransactionTestCase):
+    '''Safe reads go to a replica, except in transactions, after a write, and for clients that wrote recently
+
+    A TransactionTestCase, so the test itself does not run inside a transaction.
+    '''
+
+    def test_router(self):
+        self.assertEqual(router.db_for_read(Post), DEFAULT_DB_ALIAS) # outside a request that allows replicas
+        with db_router.replica_reads():
+            self.assertEqual(router.db_for_read(Post), 'replica')
+            with transaction.atomic():
+                self.assertEqual(router.db_for_read(Post), DEFAULT_DB_ALIAS)
+            self.assertEqual(router.db_for_write(Post), DEFAULT_DB_ALIAS)
+            self.assertEqual(router.db_for_read(Post), DEFAULT_DB_ALIAS) # read your own write
+        with db_router.replica_reads(), db_router.primary_reads():
+            self.assertEqual(router.db_for_read(Post), DEFAULT_DB_ALIAS)
+
+    def request(self, method='get', cookies=None, write=False):
+        '''run a request through the middleware; return (database read from at the end, response)'''
+        read_from = []
+
+        def view(request):
+            if write:
+                router.db_for_write(Post)
+            read_from.append(router.db_for_read(Post))
+            return HttpResponse()
+
+        request = getattr(RequestFactory(), method)('/')
+        request.COOKIES.update(cookies or {})
+        response = db_router.ReplicaRoutingMiddleware(view)(request)
+        return read_from[0], response
+
+    def test_middleware(self):
+        database, response = self.request()
+        self.assertEqual(database, 'replica')
+        self.assertNotIn(db_router.PIN_COOKIE, response.cookies)
+
+        # a POST, or a GET that writes, pins the client to the primary
+        database, response = self.request('post')
+        self.assertEqual(database, DEFAULT_DB_ALIAS)
+        pin = response.cookies[db_router.PIN_COOKIE]
+        self.assertEqual(pin['max-age'], 5)
+        database, response = self.request(write=True)
+        self.assertEqual(database, DEFAULT_DB_ALIAS)
+        self.assertIn(db_router.PIN_COOKIE, response.cookies)
+
+        # until the pin expires
+        database, _ = self.request(cookies={db_router.PIN_COOKIE: pin.value})
+        self.assertEqual(database, DEFAULT_DB_ALIAS)
+        database, _ = self.request(cookies={db_router.PIN_COOKIE: '1'})
+        self.assertEqual(database, 'replica')
+        # and after the request, reads are back to the primary
+        self.assertEqual(router.db_for_read(Post), DEFAULT_DB_ALIAS)
+
+    @modify_settings(MIDDLEWARE={'append': 'mini_insta.db_router.ReplicaRoutingMiddleware'})
+    def test_streamed_post_lists(self):
+        '''the chunks of a streamed post list are read after the middleware returns, and still go to the replica'''
+        profile = Profile.objects.create(user=User.objects.create(username='author'), username='author', display_name='Author')
+        Post.objects.bulk_create(Post(profile=profile, caption=f'post {i}') for i in range(3))
+        route = db_router.PrimaryReplicaRouter.db_for_read
+        routed = []
+
+        def db_for_read(self, model, **hints):
+            # record where the read would go, but run it on the primary: the replica is only named
+            routed.append((model, route(self, model, **hints)))
+            return DEFAULT_DB_ALIAS
+
+        for name in ('api:profile_posts', 'api:profile_feed'):
+            with self.subTest(name), mock.patch.object(db_router.PrimaryReplicaRouter, 'db_for_read', db_for_read):
+                response = self.client.get(reverse(name, args=[profile.pk]))
+                routed.clear()
+                body = b''.join(response.streaming_content)
+            self.assertEqual(len(json.loads(body)), 3 if name == 'api:profile_posts' else 0)
+            self.assertIn(Post, [model for model, _ in routed])
+            self.assertEqual({database for _, database in routed}, {'replica'})
+        self.assertEqual(router.db_for_read(Post), DEFAULT_DB_ALIAS)
+
+
+class LikeSummaryTests(TestCase):
+    '''Cached likes lines follow every way a Like can disappear'''
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author, cls.fan, cls.critic = Profile.objects.bulk_create([
+            Profile(user=User.objects.create(username=name), username=name, display_name=name.title())
+            for name in ['author', 'fan', 'critic']
+        ])
+        cls.post = Post.objects.create(profile=cls.author, caption='post')
+        Like.objects.bulk_create([Like(post=cls.post, profile=cls.fan), Like(post=cls.post, profile=cls.critic)])
+
+    def setUp(self):
+        cache.clear() # pks are reused between tests
+
+    def summary(self):
+        return get_like_summaries([self.post])[self.post.pk]
+
+    def test_purged_liker(self):
+        self.assertEqual(self.summary().count, 2) # now cached
+        with self.captureOnCommitCallbacks(execute=True):
+            deletion.purge(Profile.objects.filter(pk=self.critic.pk))
+        self.assertEqual(self.summary().count, 1)
+        self.assertEqual(self.summary().recent_username, 'fan')
+
+    def test_like_deleted_in_the_admin(self):
+        self.assertEqual(self.summary().count, 2)
+        like = Like.objects.get(profile=self.fan)
+        with self.captureOnCommitCallbacks(execute=True):
+            tasks.purge_rows(model='mini_insta.like', pks=[like.pk])
+        self.assertEqual(self.summary().count, 1)
+
+
+class DeletionTests(TestCase):
+    '''Deleted Posts are hidden at once and purged later, with their dependents, in bounded batches'''
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author, cls.fan = Profile.objects.bulk_create([
+            Profile(user=User.objects.create(username=name), username=name, display_name=name.title())
+            for name in ['author', 'fan']
+        ])
+        cls.post = Post.objects.create(profile=cls.author, caption='doomed')
+        cls.kept = Post.objects.create(profile=cls.author, caption='kept')
+        Comment.objects.bulk_create([Comment(post=cls.post, profile=cls.fan, text=f'comment {i}') for i in range(5)])
+        Like.objects.create(post=cls.post, profile=cls.fan)
+        Photo.objects.create(post=cls.post, image_url='https://example.com/a.jpg')
+
+    def test_deleted_post_is_hidden(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            deletion.delete_post(self.post)
+        self.assertEqual(list(Post.objects.filter(profile=self.author)), [self.kept])
+        self.assertIsNotNone(Post.all_objects.get(pk=self.post.pk).deleted_at)
+        self.assertEqual(self.client.get(reverse('show_post', args=[self.post.pk])).status_code, 404)
+        # the row and its dependents stay until the queued purge runs
+        self.assertEqual(Comment.objects.filter(post=self.post).count(), 5)
+        self.assertEqual(Task.objects.get().name, 'purge_posts')
+
+    def test_purge_deletes_in_batches(self):
+        Post.all_objects.filter(pk=self.post.pk).update(deleted_at=timezone.now())
+        with CaptureQueriesContext(connection) as queries:
+            deleted = deletion.delete_in_batches(Post.all_objects.filter(pk=self.post.pk), batch_size=2)
+        self.assertEqual(deleted, 8) # 5 comments, 1 like, 1 photo and the post
+        comment_deletes = [q for q in queries if q['sql'].startswith('DELETE FROM "mini_insta_comment"')]
+        self.assertEqual(len(comment_deletes), 3) # 2 + 2 + 1
+        self.assertFalse(Post.all_objects.filter(pk=self.post.pk).exists())
+        self.assertFalse(Comment.objects.filter(post_id=self.post.pk).exists())
+        self.assertTrue(Post.objects.filter(pk=self.kept.pk).exists())
+
+
+class FragmentTests(TestCase):
+    '''Cached post fragments are re-rendered when a profile they show or a comment they list changes'''
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author, cls.fan = Profile.objects.bulk_create([
+            Profile(user=User.objects.create(username=name), username=name, display_name=name.title())
+            for name in ['author', 'fan']
+        ])
+        cls.post = Post.objects.create(profile=cls.author, caption='post')
+        cls.comment = Comment.objects.create(post=cls.post, profile=cls.fan, text='nice')
+
+    def setUp(self):
+        cache.clear() # pks are reused between tests
+
+    def render(self):
+        post = Post.objects.select_related('profile').get(pk=self.post.pk)
+        return attach_fragments(attach_like_summaries([post]))[0]
+
+    def test_edited_profile(self):
+        self.render() # now cached
+        for profile in [self.author, self.fan]:
+            Profile.objects.filter(pk=profile.pk).update(username=f'{profile.username}_renamed')
+        self.assertNotIn('author_renamed', self.render().card_html) # still cached
+        for profile in [self.author, self.fan]:
+            fragments.bump_profile_version(profile.pk)
+        post = self.render()
+        self.assertIn('@author_renamed', post.card_html)
+        self.assertIn('fan_renamed', post.comments_html)
+
+    def test_purged_comment(self):
+        self.assertIn('nice', self.render().comments_html)
+        with self.captureOnCommitCallbacks(execute=True):
+            tasks.purge_rows(model='mini_insta.comment', pks=[self.comment.pk])
+        self.assertNotIn('nice', self.render().comments_html)
+
+
+class ThrottlingTests(TestCase):
+    '''Token buckets refill at their rate, refuse with Retry-After, and slow servers shed low priority views'''
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='searcher')
+        Profile.objects.create(user=cls.user, username='searcher', display_name='Searcher')
+
+    def test_bucket_refills(self):
+        self.assertEqual(throttling.take(['k'], 2, 1.0, now=100), 0)
+        self.assertEqual(throttling.take(['k'], 2, 1.0, now=100), 0)
+        self.assertEqual(throttling.take(['k'], 2, 1.0, now=100), 1.0) # empty: one token a second
+        self.assertEqual(throttling.take(['k'], 2, 1.0, now=100.5), 0.5)
+        self.assertEqual(throttling.take(['k'], 2, 1.0, now=101), 0)
+
+    def test_refused_request_charges_no_bucket(self):
+        throttling.take(['user'], 1, 1.0, now=100)
+        self.assertEqual(throttling.take(['ip', 'user'], 1, 1.0, now=100), 1.0)
+        self.assertEqual(RateLimitBucket.objects.get(key='ip').tokens, 1) # still full
+        self.assertEqual(throttling.take(['ip'], 1, 1.0, now=100), 0)
+
+    @override_settings(MINI_INSTA_RATE_LIMITS={'search': '1/m'})
+    def test_429_with_retry_after(self):
+        self.client.force_login(self.user)
+        url = reverse('search') + '?query=seed'
+        self.assertEqual(self.client.get(url).status_code, 200)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '60')
+
+    def test_low_priority_views_are_shed_while_slow(self):
+        middleware = throttling.LoadSheddingMiddleware(lambda request: HttpResponse())
+        request = RequestFactory().get('/')
+        search, feed = views.SearchView.as_view(), views.PostFeedListView.as_view()
+        self.assertIsNone(middleware.process_view(request, search, (), {}))
+
+        middleware.monitor.record(middleware.threshold + 1)
+        response = middleware.process_view(request, search, (), {})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], str(middleware.retry_after))
+        self.assertIsNone(middleware.process_view(request, feed, (), {})) # normal priority is never shed
+        api_login = resolve(reverse('api:login')).func # a lazily imported API view
+        self.assertEqual(middleware.process_view(request, api_login, (), {}).status_code, 503)
+
+
+class APIRouteTests(TestCase):
+    '''API routes keep their old names and work like the views they load on first use'''
+
+    def test_old_names_reverse_to_the_same_urls(self):
+        for name in api_urls.LEGACY_NAMES:
+            args = [1] if '<' in str(next(p.pattern for p in api_urls.urlpatterns if p.name == name)) else []
+            self.assertEqual(reverse(f'api_{name}', args=args), reverse(f'api:{name}', args=args))
+
+    def test_api_views_need_no_csrf_token(self):
+        client = self.client_class(enforce_csrf_checks=True)
+        response = client.post(reverse('api_login'), {'username': 'nobody', 'password': 'wrong'}, content_type='application/json')
+        self.assertEqual(response.status_code, 401)
+
+
+class BlobStorageTests(TestCase):
+    '''Identical uploads share one reference-counted blob, counted in the transaction that saves the Photo'''
+
+    @classmethod
+    def setUpTestData(cls):
+        user = User.objects.create(username='author')
+        profile = Profile.objects.create(user=user, username='author', display_name='Author')
+        cls.post = Post.objects.create(profile=profile, caption='photos')
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        media = override_settings(MEDIA_ROOT=media_root)
+        media.enable()
+        self.addCleanup(media.disable)
+        self.storage = Photo._meta.get_field('image_file').storage
+
+    def refcount(self, name):
+        return Blob.objects.get(name=name).refcount
+
+    def test_identical_uploads_share_a_blob(self):
+        first = Photo.objects.create(post=self.post, image_file=png_upload('a.png'))
+        second = Photo.objects.create(post=self.post, image_file=png_upload('b.png'))
+        name = first.image_file.name
+        self.assertEqual(second.image_file.name, name)
+        self.assertTrue(self.storage.is_blob(name))
+        self.assertEqual(self.refcount(name), 2)
+
+        self.assertFalse(self.storage.release(name))
+        self.assertEqual(self.refcount(name), 1)
+        self.assertTrue(self.storage.exists(name))
+        self.assertTrue(self.storage.release(name))
+        self.assertFalse(Blob.objects.filter(name=name).exists())
+        self.assertFalse(self.storage.exists(name))
+
+    def test_failed_insert_undoes_the_reference(self):
+        name = Photo.objects.create(post=self.post, image_file=png_upload()).image_file.name
+        with mock.patch.object(Photo, '_do_insert', side_effect=DatabaseError('insert failed')):
+            with self.assertRaises(DatabaseError):
+                Photo.objects.create(post=self.post, image_file=png_upload())
+        self.assertEqual(self.refcount(name), 1)
+
+
+class TagTests(TestCase):
+    '''#hashtags and @mentions are parsed and indexed on save, and tag pages follow cursors'''
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author, cls.fan = Profile.objects.bulk_create([
+            Profile(user=User.objects.create(username=name), username=name, display_name=name.title())
+            for name in ['author', 'fan']
+        ])
+
+    def test_parser(self):
+        self.assertEqual(tags.extract_hashtags('#Sunset at the #beach, #sunset again'), ['sunset', 'beach'])
+        self.assertEqual(tags.extract_hashtags('abc#1 ##double &#39; #'), [])
+        self.assertEqual(tags.extract_mentions('thanks @nguyen.le and @fan. cc @fan, mail a@b.c'), ['nguyen.le', 'fan'])
+        self.assertEqual(tags.extract_mentions(None), [])
+
+    def test_cursor_round_trip(self):
+        timestamp = timezone.now()
+        self.assertEqual(tags.decode_cursor(tags.encode_cursor(timestamp, 42)), (timestamp, 42))
+        for cursor in ['garbage', '1.2.3', 'x.1', '99999999999999999999.1', '1.99999999999999999999']:
+            self.assertRaises(ValueError, tags.decode_cursor, cursor)
+        response = self.client.get(reverse('show_tag', args=['sunset']) + '?cursor=99999999999999999999.1')
+        self.assertEqual(response.status_code, 400)
+
+    def test_indexed_on_save(self):
+        post = Post.objects.create(profile=self.author, caption='#Sunset with @fan')
+        self.assertEqual(tags.tagged_posts('sunset')[0], [post])
+        comment = Comment.objects.create(post=post, profile=self.fan, text='#beach @author')
+        self.assertEqual(tags.tagged_posts('beach')[0], [post])
+        self.assertTrue(Mention.objects.filter(profile=self.author, comment=comment).exists())
+
+        post.caption = 'just #clouds'
+        post.save()
+        self.assertEqual(tags.tagged_posts('sunset')[0], [])
+        self.assertEqual(tags.tagged_posts('clouds')[0], [post])
+        self.assertFalse(Mention.objects.filter(profile=self.fan).exists())
+
+    def test_pages(self):
+        posts = [Post.objects.create(profile=self.author, caption=f'#sunset {i}') for i in range(5)]
+        seen, cursor = [], None
+        while True:
+            page, cursor = tags.tagged_posts('sunset', cursor, limit=2)
+            seen += page
+            if not cursor:
+                break
+        self.assertEqual(seen, sorted(posts, key=lambda post: (post.timestamp, post.pk), reverse=True))
+
+
+class BatchAPITests(TestCase):
+    '''Batch reads answer in request order, list missing ids, and never serve a deleted object from the cache'''
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author, cls.fan = Profile.objects.bulk_create([
+            Profile(user=User.objects.create(username=name), username=name, display_name=name.title())
+            for name in ['author', 'fan']
+        ])
+        cls.posts = [Post.objects.create(profile=cls.author, caption=f'post {i}') for i in range(3)]
+
+    def setUp(self):
+        cache.clear() # pks are reused between tests
+
+    def get(self, route, ids):
+        return self.client.get(reverse(route) + '?ids=' + ','.join(str(pk) for pk in ids))
+
+    def test_results_in_request_order(self):
+        first, second, third = [post.pk for post in self.posts]
+        missing = third + 100
+        data = self.get('api:post_batch', [third, missing, first, third]).json()
+        self.assertEqual([post and post['id'] for post in data['results']], [third, None, first, third])
+        self.assertEqual(data['not_found'], [missing])
+        self.assertEqual(data['results'][0]['profile']['username'], 'author')
+
+        data = self.get('api:profile_batch', [self.fan.pk, self.author.pk]).json()
+        self.assertEqual([profile['username'] for profile in data['results']], ['fan', 'author'])
+        self.assertEqual(data['not_found'], [])
+
+    def test_bad_and_too_many_ids(self):
+        with mock.patch.object(api_views, 'BATCH_MAX_IDS', 2):
+            self.assertEqual(self.get('api:post_batch', [post.pk for post in self.posts[:2]]).status_code, 200)
+            response = self.get('api:post_batch', [post.pk for post in self.posts])
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('at most 2 ids', response.json()['error'])
+        self.assertEqual(self.client.get(reverse('api:post_batch') + '?ids=1,x').status_code, 400)
+        self.assertEqual(self.client.get(reverse('api:post_batch')).status_code, 400)
+
+    def test_deleted_profile_posts_leave_the_cache(self):
+        ids = [post.pk for post in self.posts]
+        self.assertEqual(self.get('api:post_batch', ids).json()['not_found'], []) # now cached
+        deletion.delete_profile(self.author)
+        self.assertEqual(self.get('api:post_batch', ids).json()['not_found'], ids)
+
+
+class BulkDataTests(TestCase):
+    '''Exported tables import into new rows with their references remapped and their timestamps kept'''
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice, cls.bob = Profile.objects.bulk_create([
+            Profile(user=User.objects.create(username=name), username=name, display_name=name.title())
+            for name in ['alice', 'bob']
+        ])
+        cls.post = Post.objects.create(profile=cls.alice, caption='hello #sun')
+        Comment.objects.create(post=cls.post, profile=cls.bob, text='hi @alice')
+        Like.objects.create(post=cls.post, profile=cls.bob)
+        Follow.objects.create(profile=cls.alice, follower_profile=cls.bob)
+        cls.posted = timezone.now() - timedelta(days=30)
+        Post.objects.update(timestamp=cls.posted)
+        Comment.objects.update(timestamp=cls.posted)
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+
+    def append_row(self, fmt, table, row):
+        '''add a row to an exported file, as another export might have written it'''
+        path = os.path.join(self.directory, f'{table}.{fmt}')
+        with open(path, 'a', newline='', encoding='utf-8') as f:
+            if fmt == 'csv':
+                with open(path, encoding='utf-8') as header:
+                    columns = header.readline().strip().split(',')
+                csv.writer(f).writerow([row.get(column, '') for column in columns])
+            else:
+                f.write(json.dumps(row) + '\n')
+
+    def round_trip(self, fmt):
+        call_command('export_data', self.directory, format=fmt, stdout=StringIO())
+        old_post_pk = self.post.pk
+        # a like on a post that is not in the export
+        self.append_row(fmt, 'like', {'id': 999, 'post_id': 999, 'profile_id': self.bob.pk, 'timestamp': self.posted.isoformat()})
+        Profile.objects.all().delete() # the Users stay, so the profiles are attached to them again
+
+        out = StringIO()
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('import_data', self.directory, format=fmt, stdout=out)
+        self.assertIn('like: 1 rows', out.getvalue())
+        self.assertIn('1 skipped (unresolved references)', out.getvalue())
+
+        alice = Profile.objects.get(username='alice')
+        self.assertEqual(alice.user.username, 'alice')
+        post = Post.objects.get(profile=alice)
+        self.assertNotEqual(post.pk, old_post_pk) # new ids, references remapped
+        self.assertEqual(post.timestamp, self.posted)
+        comment = Comment.objects.get(post=post)
+        self.assertEqual((comment.profile.username, comment.text, comment.timestamp), ('bob', 'hi @alice', self.posted))
+        self.assertEqual(list(Like.objects.values_list('post', 'profile__username')), [(post.pk, 'bob')])
+        self.assertTrue(Follow.objects.filter(profile=alice, follower_profile__username='bob').exists())
+        self.assertEqual(tags.tagged_posts('sun')[0], [post]) # indexed at the end
+
+        # importing again finds the profiles present and adds nothing
+        out = StringIO()
+        call_command('import_data', self.directory, format=fmt, stdout=out)
+        self.assertIn('2 skipped (their User has a Profile already)', out.getvalue())
+        self.assertEqual((Profile.objects.count(), Post.objects.count(), Like.objects.count()), (2, 1, 1))
+        self.assertEqual(Profile.objects.get(user__username='alice'), alice)
+
+    def test_ndjson_round_trip(self):
+        self.round_trip('ndjson')
+
+    def test_csv_round_trip(self):
+        self.round_trip('csv')
+
+
+class WarmupTests(TestCase):
+    '''The most active profiles are warmed in id-range shards, so their next feed is served from the cache'''
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.profiles = Profile.objects.bulk_create([
+            Profile(user=User.objects.create(username=name), username=name, display_name=name.title())
+            for name in ['poster', 'once', 'login', 'earlier', 'idle']
+        ])
+        poster, once, login, earlier, idle = cls.profiles
+        for profile, n in [(poster, 2), (once, 1)]:
+            for i in range(n):
+                Post.objects.create(profile=profile, caption=f'post {i}')
+        # old and deleted posts do not count
+        Post.objects.filter(pk=Post.objects.create(profile=idle, caption='old').pk).update(timestamp=timezone.now() - timedelta(days=30))
+        Post.objects.filter(pk=Post.objects.create(profile=idle, caption='gone').pk).update(deleted_at=timezone.now())
+        User.objects.filter(pk=login.user_id).update(last_login=timezone.now())
+        User.objects.filter(pk=earlier.user_id).update(last_login=timezone.now() - timedelta(days=3))
+        Follow.objects.create(profile=poster, follower_profile=login)
+        Like.objects.create(post=Post.objects.filter(profile=poster).first(), profile=once)
+
+    def setUp(self):
+        cache.clear() # pks are reused between tests
+
+    def test_active_profiles_ranking(self):
+        since = timezone.now() - timedelta(days=7)
+        self.assertEqual(warmup.active_profiles(10, since), [profile.pk for profile in self.profiles])
+        self.assertEqual(warmup.active_profiles(2, since), [profile.pk for profile in self.profiles[:2]])
+
+    def test_id_range_shards(self):
+        self.assertEqual(warmup.id_range_shards([5, 1, 3, 2, 4], 2), [[1, 2], [3, 4], [5]])
+        self.assertEqual(warmup.id_range_shards([], 2), [])
+
+    def test_warmed_feed_is_served_from_the_cache(self):
+        out = StringIO()
+        call_command('warm_caches', processes=0, profiles=10, shard_size=2, stdout=out, stderr=StringIO())
+        self.assertIn('warmed 5 profiles', out.getvalue())
+
+        self.client.force_login(self.profiles[2].user)
+        with mock.patch('mini_insta.fragments.render_to_string') as render, CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('show_feed'))
+        self.assertEqual(response.status_code, 200)
+        render.assert_not_called() # cards and comments came from the cache
+        self.assertFalse([q['sql'] for q in queries if '"num_likes"' in q['sql']]) # so did the like counts
+        self.assertContains(response, 'post 1')
+
+
+class AdminTests(TestCase):
+    '''Changelists of big tables run a fixed number of queries, and deletes are queued instead of run inline'''
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin_user = User.objects.create_superuser('admin', 'admin@example.com', 'x')
+        cls.author = Profile.objects.create(user=User.objects.create(username='author'), username='author', display_name='Author')
+        cls.post = Post.objects.create(profile=cls.author, caption='post')
+
+    def setUp(self):
+        self.client.force_login(self.admin_user)
+
+    def add_rows(self, n):
+        '''n more profiles, each liking and commenting on the post'''
+        start = Profile.objects.count()
+        fans = Profile.objects.bulk_create([
+            Profile(user=User.objects.create(username=f'fan{i}'), username=f'fan{i}', display_name='Fan')
+            for i in range(start, start + n)
+        ])
+        Like.objects.bulk_create([Like(post=self.post, profile=fan) for fan in fans])
+        Comment.objects.bulk_create([Comment(post=self.post, profile=fan, text='nice') for fan in fans])
+
+    def count_queries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.client.get(url).status_code, 200)
+        return len(queries)
+
+    def test_changelists_run_a_fixed_number_of_queries(self):
+        for model in ['like', 'comment']:
+            url = reverse(f'admin:mini_insta_{model}_changelist')
+            self.add_rows(2)
+            few = self.count_queries(url)
+            self.add_rows(10)
+            self.assertEqual(self.count_queries(url), few, model)
+
+    def test_estimated_count(self):
+        queryset = Like.objects.order_by('pk')
+        with mock.patch.object(admin, 'estimated_count', return_value=admin.ESTIMATE_THRESHOLD * 10):
+            self.assertEqual(admin.EstimatedCountPaginator(queryset, 50, estimate=True).count, admin.ESTIMATE_THRESHOLD * 10)
+            self.assertEqual(admin.EstimatedCountPaginator(queryset, 50).count, 0) # filtered lists count
+        with mock.patch.object(admin, 'estimated_count', return_value=5):
+            self.assertEqual(admin.EstimatedCountPaginator(queryset, 50, estimate=True).count, 0) # small: exact
+
+    def delete_action(self, model, pks, confirm=True):
+        data = {'action': 'delete_selected', '_selected_action': pks}
+        if confirm:
+            data['post'] = 'yes'
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(reverse(f'admin:mini_insta_{model}_changelist'), data, follow=True)
+
+    def test_bulk_delete_is_queued(self):
+        self.add_rows(3)
+        pks = list(Like.objects.values_list('pk', flat=True))
+        with mock.patch.object(admin, 'CONFIRMATION_LIMIT', 2):
+            confirmation = self.delete_action('like', pks, confirm=False)
+        self.assertContains(confirmation, '... and 1 more')
+
+        response = self.delete_action('like', pks)
+        self.assertContains(response, 'Deleting 3 likes in the background')
+        self.assertEqual(Like.objects.count(), 3) # still there until the task runs
+        task = Task.objects.get()
+        self.assertEqual((task.name, sorted(task.payload['pks'])), ('purge_rows', sorted(pks)))
+
+        taskqueue.run_pending()
+        self.assertFalse(Like.objects.exists())
+
+    def test_deleted_profiles_are_hidden_or_explained(self):
+        response = self.delete_action('profile', [self.author.pk])
+        self.assertContains(response, 'the profiles stay listed here until the purge has run')
+        self.assertFalse(Post.objects.filter(pk=self.post.pk).exists())
+        self.assertEqual(Task.objects.get().name, 'purge_profiles')
+
+    def test_delete_model_is_queued(self):
+        self.add_rows(1)
+        comment = Comment.objects.get()
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('admin:mini_insta_comment_delete', args=[comment.pk]), {'post': 'yes'}, follow=True)
+        self.assertContains(response, 'It is deleted in the background')
+        self.assertTrue(Comment.objects.filter(pk=comment.pk).exists())
+        self.assertEqual(Task.objects.get().payload, {'model': 'mini_insta.comment', 'pks': [comment.pk]})
+
+
+class PhotoRenditionTests(TestCase):
+    '''Renditions are rendered once per width and format, served from the disk cache afterwards'''
+
+    @classmethod
+    def setUpTestData(cls):
+        user = User.objects.create(username='author')
+        profile = Profile.objects.create(user=user, username='author', display_name='Author')
+        post = Post.objects.create(profile=profile, caption='legacy photo')
+        cls.photo = Photo.objects.create(post=post, image_url='https://images.example.com/legacy.png')
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        media = override_settings(MEDIA_ROOT=media_root)
+        media.enable()
+        self.addCleanup(media.disable)
+        for patcher in [
+            mock.patch.object(images, 'LEGACY_IMAGE_FETCHER', f'{__package__}.tests.fetch_png'),
+            mock.patch.object(images, 'rendition_cache', images.RenditionCache(f'{media_root}/renditions', 10 * 1024 * 1024)),
+        ]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        fetched_urls.clear()
+
+    def get(self, query='?w=160&fmt=png', **extra):
+        return self.client.get(reverse('photo_rendition', args=[self.photo.pk]) + query, **extra)
+
+    def test_miss_then_hit(self):
+        with mock.patch.object(images, 'render_image', wraps=images.render_image) as render:
+            first = self.get()
+            second = self.get()
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(first['Content-Type'], 'image/png')
+        body = first.getvalue()
+        with Image.open(BytesIO(body)) as image:
+            self.assertEqual(image.size, (160, 120))
+        self.assertEqual(second.getvalue(), body)
+        self.assertEqual(render.call_count, 1)
+        self.assertEqual(fetched_urls, [self.photo.image_url]) # downloaded once, then kept in storage
+
+        not_modified = self.get(HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(not_modified.status_code, 304)
+
+    def test_if_none_match_list(self):
+        etag = self.get()['ETag']
+        for header in [f'"other", W/{etag}', '*', f' "x" ,{etag}']:
+            self.assertEqual(self.get(HTTP_IF_NONE_MATCH=header).status_code, 304, header)
+        # any other tag is not a match
+        self.assertEqual(self.get(HTTP_IF_NONE_MATCH=f'"x{etag[1:]}').status_code, 200)
+
+    def test_photos_of_deleted_posts_are_not_served(self):
+        deletion.delete_post(self.photo.post)
+        self.assertEqual(self.get().status_code, 404)
+
+    def test_bad_width_and_format(self):
+        self.assertEqual(self.get('?w=wide').status_code, 400)
+        self.assertEqual(self.get('?w=160&fmt=gif').status_code, 400)
+        # widths are snapped to an allowed one, so odd values share a rendition
+        self.assertEqual(self.get('?w=150&fmt=png')['ETag'], self.get('?w=160&fmt=png')['ETag'])
+
+    def test_evicted_before_open_is_rendered_again(self):
+        self.get()
+        path, _ = images.get_rendition(self.photo, 160, 'png')
+        os.remove(path)
+        # the cache still reported the file, as it does when another process evicts it in between
+        with mock.patch.object(images.rendition_cache, 'get', side_effect=[path, None]):
+            response = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.getvalue())
+
+    def test_unloadable_image_is_not_found(self):
+        with mock.patch.object(images, 'render_image', side_effect=Image.DecompressionBombError('too many pixels')):
+            self.assertEqual(self.get().status_code, 404)
+
+
+class ArchiveTests(TestCase):
+    '''Likes and comments of old posts move to the archive without changing any count'''
+
+    @classmethod
+    def setUpTestData(cls):
+        profiles = Profile.objects.bulk_create([
+            Profile(user=User.objects.create(username=name), username=name, display_name=name.title())
+            for name in ['author', 'fan', 'critic']
+        ])
+        cls.author, cls.fan, cls.critic = profiles
+        cls.old_post = Post.objects.create(profile=cls.author, caption='old post')
+        cls.new_post = Post.objects.create(profile=cls.author, caption='new post')
+        Post.objects.filter(pk=cls.old_post.pk).update(timestamp=timezone.now() - timedelta(days=400))
+        for post in [cls.old_post, cls.new_post]:
+            Like.objects.bulk_create([Like(post=post, profile=cls.fan), Like(post=post, profile=cls.critic)])
+            Comment.objects.bulk_create([Comment(post=post, profile=cls.critic, text=f'comment {i} @fan') for i in range(3)])
+        tags.index_posts([cls.old_post, cls.new_post])
+
+    def setUp(self):
+        patcher = mock.patch.object(write_buffer.write_buffer, 'window', 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def run_archive(self):
+        return list(archive.archive(days=365, batch_size=2))
+
+    def test_counts_survive_archival(self):
+        batches = self.run_archive()
+        self.assertEqual([(kind, moved) for kind, moved, _ in batches], [('likes', 2), ('comments', 2), ('comments', 1)])
+
+        old_post = Post.objects.get(pk=self.old_post.pk)
+        self.assertFalse(Like.objects.filter(post=old_post).exists())
+        self.assertFalse(Comment.objects.filter(post=old_post).exists())
+        self.assertEqual(old_post.get_num_likes(), 2)
+        self.assertEqual(old_post.get_num_comments(), 3)
+        summary = get_like_summaries([old_post], self.fan)[old_post.pk]
+        self.assertEqual(summary.count, 2)
+        self.assertTrue(summary.liked)
+        self.assertTrue(summary.recent_username)
+
+        # recent posts keep their rows, and mentions in archived comments stay indexed
+        self.assertEqual(Like.objects.filter(post=self.new_post).count(), 2)
+        self.assertEqual(Mention.objects.filter(post=old_post, profile=self.fan, comment=None).count(), 3)
+        self.assertEqual(self.run_archive(), [])
+
+    def test_purged_profiles_leave_the_counts(self):
+        self.run_archive()
+        with self.captureOnCommitCallbacks(execute=True):
+            deletion.purge(Profile.objects.filter(pk=self.fan.pk))
+        old_post = Post.objects.get(pk=self.old_post.pk)
+        self.assertEqual((old_post.archived_like_count, old_post.archived_comment_count), (1, 3))
+        self.assertEqual(old_post.get_num_likes(), 1)
+        self.assertEqual(get_like_summaries([old_post])[old_post.pk].count, 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            deletion.purge(Profile.objects.filter(pk=self.critic.pk))
+        old_post = Post.objects.get(pk=self.old_post.pk)
+        self.assertEqual((old_post.archived_like_count, old_post.archived_comment_count), (0, 0))
+        self.assertEqual((old_post.get_num_likes(), old_post.get_num_comments()), (0, 0))
+
+    def test_repeated_likes_are_archived_once(self):
+        like = Like.objects.filter(post=self.old_post, profile=self.fan).values('pk', 'post_id', 'profile_id', 'timestamp').get()
+        moved = archive.move_likes([like, dict(like, pk=like['pk'] + 1000)]) # e.g. imported twice
+        self.assertEqual(moved, {self.old_post.pk: 1})
+        self.assertEqual(ArchivedLike.objects.filter(post=self.old_post, profile=self.fan).count(), 1)
+
+    def test_archived_comments_are_paged(self):
+        self.run_archive()
+        comments, cursor = archive.archived_comments(self.old_post.pk, limit=2)
+        rest, end = archive.archived_comments(self.old_post.pk, cursor, limit=2)
+        self.assertIsNone(end)
+        self.assertEqual(sorted(c.text for c in comments + rest), ['comment 0 @fan', 'comment 1 @fan', 'comment 2 @fan'])
+        self.assertRaises(ValueError, archive.archived_comments, self.old_post.pk, 'garbage')
+
+    def test_like_and_unlike_after_archival(self):
+        self.run_archive()
+        write_buffer.like(self.fan.pk, self.old_post.pk) # archived already: not created twice
+        self.assertEqual(Post.objects.get(pk=self.old_post.pk).get_num_likes(), 2)
+        write_buffer.unlike(self.fan.pk, self.old_post.pk)
+        self.assertFalse(ArchivedLike.objects.filter(post=self.old_post, profile=self.fan).exists())
+        self.assertEqual(Post.objects.get(pk=self.old_post.pk).get_num_likes(), 1)
+        self.assertFalse(write_buffer.is_liked(self.fan.pk, self.old_post.pk))
+
+
+@modify_settings(MIDDLEWARE={'prepend': 'mini_insta.compression.CompressionMiddleware'})
+class CompressionTests(TestCase):
+    '''Streamed API lists are compressed chunk by chunk, small and unaccepted ones are not'''
+
+    @classmethod
+    def setUpTestData(cls):
+        user = User.objects.create(username='author')
+        cls.profile = Profile.objects.create(user=user, username='author', display_name='Author')
+        Post.objects.bulk_create([Post(profile=cls.profile, caption=f'post number {i} ' * 20) for i in range(30)])
+
+    def get(self, url, encoding):
+        return self.client.get(url, HTTP_ACCEPT_ENCODING=encoding)
+
+    def test_streamed_list_is_gzipped_chunk_by_chunk(self):
+        url = reverse('api:profile_posts', args=[self.profile.pk])
+        with mock.patch.object(api_views, 'STREAM_CHUNK_SIZE', 7):
+            plain = self.get(url, 'identity')
+            compressed = self.get(url, 'br;q=0, gzip;q=0.5')
+            chunks = list(compressed.streaming_content)
+
+        self.assertFalse(plain.has_header('Content-Encoding'))
+        self.assertEqual(compressed['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', compressed['Vary'])
+        body = gzip.decompress(b''.join(chunks))
+        self.assertEqual(body, plain.getvalue())
+        self.assertEqual(len(json.loads(body)), 30)
+        # every chunk ends on a flush, so a client can decode the posts sent so far
+        self.assertGreater(len(chunks), 2)
+        self.assertTrue(json.loads(body)[0]['caption'])
+
+    def test_small_response_is_not_compressed(self):
+        Post.objects.filter(profile=self.profile).delete()
+        response = self.get(reverse('api:profile_posts', args=[self.profile.pk]), 'gzip')
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual(response.getvalue(), b'[]')
+
+    def test_negotiation(self):
+        self.assertEqual(compression.negotiate('gzip, deflate'), 'gzip')
+        self.assertEqual(compression.negotiate('*'), next(iter(compression.CODECS)))
+        self.assertIsNone(compression.negotiate('gzip;q=0, identity'))
+        self.assertIsNone(compression.negotiate(''))
@@ -0,0 +1,214 @@
+# File: mini_insta/throttling.py
+# token bucket rate limits per user and per IP address, and shedding of low priority requests under load
+# Author: Nguyen Le
+#
+# Buckets live in the RateLimitBucket table, so every worker process shares them.
+# Load shedding needs the middleware (see README):
+#
+#     MIDDLEWARE += ['mini_insta.throttling.LoadSheddingMiddleware']
+
+
+import math
+import threading
+import time
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.http import HttpResponse
+
+from .models import RateLimitBucket
+
+# priority of a view, read from its `priority` attribute
+LOW = 'low' # expensive and not needed to browse: shed first when the server is slow
+NORMAL = 'normal' # feeds and pages, never shed
+
+# rate of each scope, "<requests>/<s|m|h|d>"; override with MINI_INSTA_RATE_LIMITS = {'search': '60/m'} (None turns a scope off)
+DEFAULT_RATES = {
+    'search': '30/m',
+    'login': '10/m',
+    'create_post': '30/h',
+}
+
+PERIODS = {'s': 1, 'm': 60, 'h': 60 * 60, 'd': 24 * 60 * 60}
+
+
+def parse_rate(rate):
+    '''return (bucket capacity, tokens refilled per second) for a rate like "30/m", or None for no limit'''
+    if rate is None:
+        return None
+    count, period = rate.split('/')
+    count = int(count)
+    return count, count / PERIODS[period[0]]
+
+
+def get_rate(scope):
+    '''return the parsed rate of a scope, or None if it is not limited'''
+    rates = getattr(settings, 'MINI_INSTA_RATE_LIMITS', {})
+    return parse_rate(rates.get(scope, DEFAULT_RATES.get(scope)))
+
+
+def take(keys, capacity, refill_rate, now=None):
+    '''Take one token from each bucket of keys; return 0 if all had one, or the seconds until they will
+
+    A bucket starts full and gains refill_rate tokens per second up to capacity,
+    so clients can burst up to capacity requests and then keep to the rate.
+    Every bucket is checked before any is charged, so a request refused by one
+    bucket costs nothing from the others.
+    '''
+    now = time.time() if now is None else now
+
+    # the alias is explicit so the router does not count this as a write and pin the client to the primary
+    buckets = RateLimitBucket.objects.using(DEFAULT_DB_ALIAS)
+    with transaction.atomic(using=DEFAULT_DB_ALIAS):
+        tokens = {}
+        # locked in key order, so two requests sharing buckets cannot deadlock
+        for key in sorted(set(keys)):
+            bucket, _ = buckets.select_for_update().get_or_create(key=key, defaults={'tokens': capacity, 'updated': now})
+            tokens[bucket.pk] = min(capacity, bucket.tokens + max(0.0, now - bucket.updated) * refill_rate)
+        wait = max([(1 - left) / refill_rate for left in tokens.values() if left < 1], default=0)
+        if wait:
+            return wait
+        for pk, left in tokens.items():
+            buckets.filter(pk=pk).update(tokens=left - 1, updated=now)
+    return 0
+
+
+def client_ip(request):
+    '''return the client's address: REMOTE_ADDR, or the first X-Forwarded-For address behind a trusted proxy'''
+    if getattr(settings, 'MINI_INSTA_TRUST_X_FORWARDED_FOR', False):
+        forwarded = request.META.get('HTTP_X_FORWARDED_FOR', '')
+        if forwarded:
+            return forwarded.split(',')[0].strip()
+    return request.META.get('REMOTE_ADDR', '')
+
+
+def check_rate(scope, request, extra_keys=()):
+    '''Take a token from each bucket of this request (its IP address, its user, extra_keys)
+
+    Returns 0 when the request may go ahead, or the seconds the client should
+    wait before retrying.
+    '''
+    rate = get_rate(scope)
+    if scope is None or rate is None:
+        return 0
+    capacity, refill_rate = rate
+
+    keys = [f'{scope}:ip:{client_ip(request)}']
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_authenticated:
+        keys.append(f'{scope}:user:{user.pk}')
+    keys += [f'{scope}:{key}' for key in extra_keys]
+    return take(keys, capacity, refill_rate)
+
+
+def purge_idle_buckets(idle_seconds=24 * 60 * 60):
+    '''Delete buckets not used for idle_seconds; a missing bucket is a full one, so nothing is lost once they have refilled'''
+    deleted, _ = RateLimitBucket.objects.filter(updated__lt=time.time() - idle_seconds).delete()
+    return deleted
+
+
+def retry_response(status, wait, message):
+    '''plain text response telling the client to retry in wait seconds'''
+    response = HttpResponse(message, status=status, content_type='text/plain')
+    response['Retry-After'] = str(max(1, math.ceil(wait)))
+    return response
+
+
+class RateLimitMixin:
+    '''Rate limit a class-based view with the buckets of its throttle_scope'''
+
+    throttle_scope = None
+    priority = LOW
+
+    def dispatch(self, request, *args, **kwargs):
+        wait = check_rate(self.throttle_scope, request)
+        if wait:
+            return retry_response(429, wait, 'Too many requests, please try again later.')
+        return super().dispatch(request, *args, **kwargs)
+
+
+class TokenBucketThrottle:
+    '''DRF throttle using the same buckets, for API views with a throttle_scope
+
+    DRF answers 429 with a Retry-After header when a bucket is empty. It only
+    calls allow_request() and wait(), so this does not subclass BaseThrottle and
+    the HTML views can import this module without loading DRF.
+    '''
+
+    def allow_request(self, request, view):
+        self.wait_seconds = check_rate(getattr(view, 'throttle_scope', None), request, self.get_extra_keys(request))
+        return not self.wait_seconds
+
+    def get_extra_keys(self, request):
+        return ()
+
+    def wait(self):
+        return self.wait_seconds
+
+
+class LoginThrottle(TokenBucketThrottle):
+    '''also limit login attempts per username, whichever address they come from'''
+
+    def get_extra_keys(self, request):
+        username = request.data.get('username')
+        return [f'username:{username}'] if username else []
+
+
+class LatencyMonitor:
+    '''Exponentially weighted average of this process's response times
+
+    The average is forgotten after stale seconds without a sample, so shedding
+    stops by itself once nothing but shed requests arrive.
+    '''
+
+    def __init__(self, alpha=0.2, stale=5):
+        self.alpha = alpha
+        self.stale = stale
+        self.average = 0.0
+        self.last = 0.0
+        self.lock = threading.Lock()
+
+    def record(self, seconds):
+        with self.lock:
+            now = time.monotonic()
+            if now - self.last > self.stale:
+                self.average = seconds
+            else:
+                self.average = self.alpha * seconds + (1 - self.alpha) * self.average
+            self.last = now
+
+    def current(self):
+        with self.lock:
+            if time.monotonic() - self.last > self.stale:
+                return 0.0
+            return self.average
+
+
+class LoadSheddingMiddleware:
+    '''Answer 503 to low priority views while responses are slow, so feed reads stay responsive
+
+    Views declare priority = LOW (see RateLimitMixin); they are refused with
+    Retry-After while the average latency is above MINI_INSTA_SHED_LATENCY seconds.
+    '''
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.threshold = getattr(settings, 'MINI_INSTA_SHED_LATENCY', 1.0)
+        self.retry_after = getattr(settings, 'MINI_INSTA_SHED_RETRY_AFTER', 5)
+        self.monitor = LatencyMonitor(stale=self.retry_after)
+
+    def __call__(self, request):
+        start = time.monotonic()
+        response = self.get_response(request)
+        if not getattr(request, '_mini_insta_shed', False):
+            self.monitor.record(time.monotonic() - start)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        # class-based views have it on their class, the lazily imported API views on the view function
+        if getattr(getattr(view_func, 'view_class', view_func), 'priority', NORMAL) != LOW:
+            return None
+        if self.monitor.current() <= self.threshold:
+            return None
+        request._mini_insta_shed = True
+        return retry_response(503, self.retry_after, 'The server is busy, please try again shortly.')
@@ -3,14 +3,18 @@
 # Author: Nguyen Le
 
 
-from django.urls import path
+from django.urls import include, path
+from . import api_urls
 from .views import * 
 from django.contrib.auth import views as auth_views
 
+
 urlpatterns = [
     path('', ProfileListView.as_view(), name="show_all_profiles"), # display all profiles on the app
     path('profile/<int:pk>', ProfileDetailView.as_view(), name="show_profile"), # display specific profile
     path('post/<int:pk>', PostDetailView.as_view(), name="show_post"), # display specific post
+    path('img/<int:pk>', PhotoRenditionView.as_view(), name="photo_rendition"), # resized photo, e.g. img/1?w=320&fmt=webp
+    path('tag/<str:name>', TagView.as_view(), name="show_tag"), # posts with a #hashtag, newest first
 
     # authenticated user specific - no pk
     path('profile/create_post', CreatePostView.as_view(), name="create_post"), # create a post 
@@ -23,6 +27,7 @@ urlpatterns = [
     path('post/<int:pk>/delete', DeletePostView.as_view(), name="delete_post"), # delete a post 
     path('post/<int:pk>/update', UpdatePostView.as_view(), name="update_post"), # update a post 
     path('post/<int:pk>/comment', CreateCommentView.as_view(), name='add_comment'), # add comment to post
+    path('post/<int:pk>/comments/archived', ArchivedCommentsView.as_view(), name='archived_comments'), # older comments of a post, a page at a time
 
     # action specific
     path('profile/<int:pk>/follow', FollowView.as_view(), name='follow'), # follow profile
@@ -39,14 +44,9 @@ urlpatterns = [
     path('logout_confirmation/', LogoutConfirmationView.as_view(), name="logout_confirmation"), # logout confirmation 
     path('logout/', auth_views.LogoutView.as_view(next_page='logout_confirmation'), name="logout"), # logout function
     path('create_profile/', CreateProfileView.as_view(), name='create_profile'), # creating new User Profile function
-    
-    
-    # REST API endpoints for React Native client
-    path('api/profiles/', ProfileListAPIView.as_view(), name='api_profile_list'), # api endpoint for list of profiles
-    path('api/profiles/<int:pk>/', ProfileDetailAPIView.as_view(), name='api_profile_detail'), # api endpoint for viewing specific profile
-    path('api/profiles/<int:profile_id>/posts/', ProfilePostsAPIView.as_view(), name='api_profile_posts'), # api endpoint for viewing specific profile's posts
-    path('api/profiles/<int:profile_id>/feed/', ProfileFeedAPIView.as_view(), name='api_profile_feed'), # api endpoint for viewing specific profile's feed
-    path('api/posts/create/', CreatePostAPIView.as_view(), name='api_create_post'), # api endpoint to create post
-    path('api/auth/login/', LoginAPIView.as_view(), name='api_login'), # api endpoint to log in an authenticated user
-    path('api/auth/user/', CurrentUserAPIView.as_view(), name='api_current_user'), # api end point to authenticate a user
-]
\ No newline at end of file
+
+    # REST API endpoints for React Native client, in api_urls.py; their views are imported on first use, so
+    # processes serving only HTML never load DRF (the names are in the "api" namespace, e.g. "api:login")
+    path('api/', include(api_urls)),
+    path('api/', include(api_urls.legacy_urlpatterns)), # the old names, e.g. "api_login"
+]
@@ -4,11 +4,21 @@
 
 
 
-from django.shortcuts import render, redirect
+from django.shortcuts import render, redirect, get_object_or_404
+from django.http import FileResponse, Http404, HttpResponseBadRequest, HttpResponseNotModified
+from django.views import View
 from django.views.generic import ListView, DetailView, CreateView, UpdateView, DeleteView, TemplateView
 from django.urls import reverse
+from django.utils.cache import parse_etags
+from django.db import transaction
+from . import activity, archive, deletion, fragments, images, object_cache, tags, write_buffer
+from .fragments import attach_fragments
+from .like_summary import attach_like_summaries
+from .taskqueue import enqueue
+from .throttling import RateLimitMixin
+from .tasks import record_activity, render_photo_renditions
 from .forms import CreatePostForm, UpdateProfileForm, UpdatePostForm, CreateProfileForm, CreateCommentForm
-from .models import Profile, Post, Photo, Follow, Like, Comment
+from .models import Profile, Post, Photo, Comment, Activity
 
 from django.contrib.auth.mixins import LoginRequiredMixin
 
@@ -38,17 +48,42 @@ class MyLoginRequiredMixin(LoginRequiredMixin):
         return Profile.objects.get(user=user)
 
 
+class LoadUserMixin:
+    '''Load the logged in User before rendering, for views that do not use it themselves
+
+    base.html reads request.user, which would otherwise run the session and User
+    queries from inside the template.
+    '''
+
+    def get_context_data(self, **kwargs):
+        self.request.user.is_authenticated # evaluates the lazy request.user
+        return super().get_context_data(**kwargs)
+
+
+def get_viewer_profile(request):
+    '''return the Profile of the logged in user, or None for anonymous users and users without a Profile'''
+    if not request.user.is_authenticated:
+        return None
+    return Profile.objects.filter(user=request.user).first()
+
+
 '''
 views without authentication
 '''
 
 # inherits ListView, which display many models
-class ProfileListView(ListView):
+class ProfileListView(LoadUserMixin, ListView):
     '''Define a view class to show all Profiles'''
     model = Profile
     template_name = "mini_insta/show_all_profiles.html"
     context_object_name = "profiles" # plural
 
+    def get_context_data(self, **kwargs):
+        '''evaluate the Profiles here, so the template runs no queries'''
+        context = super().get_context_data(**kwargs)
+        context['profiles'] = list(context['profiles'])
+        return context
+
 # inherits DetailView, which displays one model
 class ProfileDetailView(DetailView):
     '''Define a view class to show a single profile'''
@@ -56,26 +91,141 @@ class ProfileDetailView(DetailView):
     template_name = "mini_insta/show_profile.html"
     content_object_name = "profile" # singular
 
+    def get_context_data(self, **kwargs):
+        '''add the Profile's posts and counts, and whether the logged in user follows this Profile
+        (including follows not yet written to the database), so the template runs no queries'''
+        context = super().get_context_data(**kwargs)
+        profile = self.object
+        viewer = get_viewer_profile(self.request)
+        context['following'] = viewer is not None and write_buffer.is_following(viewer.pk, profile.pk)
+        context['posts'] = list(Post.objects.filter(profile=profile).prefetch_related('photo_set'))
+        context['num_followers'] = profile.get_num_followers()
+        context['num_following'] = profile.get_num_following()
+        return context
+
 class PostDetailView(DetailView):
     '''Define a view class to show a single post'''
-    model = Post
+    queryset = Post.objects.select_related('profile').prefetch_related('photo_set')
     template_name = "mini_insta/show_post.html"
     context_object_name = "post" # singular
 
-class ShowFollowersDetailView(DetailView):
+    def get_context_data(self, **kwargs):
+        '''add the likes line of this Post (including the viewer's likes not yet written to the database)
+        and its cached comments'''
+        context = super().get_context_data(**kwargs)
+        attach_like_summaries([self.object], get_viewer_profile(self.request))
+        attach_fragments([self.object], parts=[fragments.COMMENTS])
+        return context
+
+class ShowFollowersDetailView(LoadUserMixin, DetailView):
     '''View class to display all followers of a Profile'''
 
     model = Profile
     template_name = "mini_insta/show_followers.html"
     context_object_name = "profile"
 
-class ShowFollowingDetailView(DetailView):
+    def get_context_data(self, **kwargs):
+        '''add the followers, so the template runs no queries'''
+        context = super().get_context_data(**kwargs)
+        context['followers'] = self.object.get_followers()
+        return context
+
+class ShowFollowingDetailView(LoadUserMixin, DetailView):
     '''View class to display all Profiles that this Profile is following'''
 
     model = Profile
     template_name = "mini_insta/show_following.html"
     context_object_name = "profile"
 
+    def get_context_data(self, **kwargs):
+        '''add the followed Profiles, so the template runs no queries'''
+        context = super().get_context_data(**kwargs)
+        context['following'] = self.object.get_following()
+        return context
+
+class TagView(LoadUserMixin, TemplateView):
+    '''View class to show the Posts with a #hashtag, newest first, a page at a time'''
+
+    template_name = "mini_insta/show_tag.html"
+
+    def get(self, request, *args, **kwargs):
+        '''read one page of the tag's index, starting after ?cursor='''
+        try:
+            self.posts, self.next_cursor = tags.tagged_posts(kwargs['name'], request.GET.get('cursor'))
+        except ValueError:
+            return HttpResponseBadRequest('invalid cursor')
+        return super().get(request, *args, **kwargs)
+
+    def get_context_data(self, **kwargs):
+        '''add the page of Posts, with their likes lines and cached cards, and the cursor of the next page'''
+        context = super().get_context_data(**kwargs)
+        context['tag'] = kwargs['name'].lower()
+        context['posts'] = attach_fragments(attach_like_summaries(self.posts, get_viewer_profile(self.request)))
+        context['next_cursor'] = self.next_cursor
+        return context
+
+class ArchivedCommentsView(LoadUserMixin, TemplateView):
+    '''View class to show the archived Comments of a Post, newest first, a page at a time'''
+
+    template_name = "mini_insta/show_archived_comments.html"
+
+    def get(self, request, *args, **kwargs):
+        '''read one page of the Post's archived comments, starting after ?cursor='''
+        self.post = get_object_or_404(Post.objects.select_related('profile'), pk=kwargs['pk'])
+        try:
+            self.comments, self.next_cursor = archive.archived_comments(self.post.pk, request.GET.get('cursor'))
+        except ValueError:
+            return HttpResponseBadRequest('invalid cursor')
+        return super().get(request, *args, **kwargs)
+
+    def get_context_data(self, **kwargs):
+        '''add the Post, the page of Comments and the cursor of the next page'''
+        context = super().get_context_data(**kwargs)
+        context['post'] = self.post
+        context['comments'] = self.comments
+        context['next_cursor'] = self.next_cursor
+        return context
+
+class PhotoRenditionView(View):
+    '''Serve a resized copy of a Photo, e.g. /img/<pk>?w=320&fmt=webp, rendered on demand and cached on disk'''
+
+    def get(self, request, pk):
+        '''resize (or reuse) the requested rendition and stream it from disk'''
+        photo = get_object_or_404(Photo, pk=pk, post__deleted_at__isnull=True) # not the photos of deleted Posts
+
+        # requested width, snapped to one of the allowed rendition widths
+        try:
+            width = int(request.GET.get('w', images.RENDITION_WIDTHS[-1]))
+        except ValueError:
+            return HttpResponseBadRequest('w must be an integer')
+
+        # explicit format, otherwise webp for clients that accept it
+        fmt = request.GET.get('fmt')
+        if fmt is None:
+            fmt = 'webp' if 'image/webp' in request.headers.get('Accept', '') else 'jpeg'
+        fmt = 'jpeg' if fmt == 'jpg' else fmt
+        if fmt not in images.RENDITION_FORMATS:
+            return HttpResponseBadRequest(f'fmt must be one of {", ".join(images.RENDITION_FORMATS)}')
+
+        # renditions never change for a given key, so clients may keep them forever
+        etag = images.rendition_etag(photo, width, fmt)
+        # If-None-Match is a list of (possibly weak) ETags or *, compared weakly
+        client_etags = parse_etags(request.headers.get('If-None-Match', ''))
+        if '*' in client_etags or etag in {tag.removeprefix('W/') for tag in client_etags}:
+            response = HttpResponseNotModified()
+        else:
+            try:
+                file, etag = images.open_rendition(photo, width, fmt)
+            except images.RENDITION_ERRORS:
+                raise Http404('image could not be loaded')
+            # FileResponse hands the open file to the server's wsgi.file_wrapper (sendfile where available)
+            response = FileResponse(file, content_type=images.RENDITION_FORMATS[fmt])
+        response['ETag'] = etag
+        response['Cache-Control'] = 'public, max-age=31536000, immutable'
+        if 'fmt' not in request.GET:
+            response['Vary'] = 'Accept'
+        return response
+
 class CreateProfileView(CreateView):
     '''View class to handle the creation of a new Profile/User'''
 
@@ -184,12 +334,17 @@ class CreatePostView(MyLoginRequiredMixin, CreateView):
 
         # if there is image file
         if files:
-            for file in files:
-                Photo.objects.create(post=self.object, image_file = file)
+            photos = [Photo.objects.create(post=self.object, image_file = file) for file in files]
+
+            # resize the uploads in the background once the post is committed
+            enqueue(render_photo_renditions, photo_ids=[photo.pk for photo in photos])
         # otherwise just save "no image found" file
         else:
             Photo.objects.create(post=self.object, image_file="default.png")
 
+        # a card rendered before the photos were saved must not be reused
+        fragments.bump_versions([self.object.pk])
+
         return response
     
 class UpdateProfileView(MyLoginRequiredMixin, UpdateView):
@@ -203,6 +358,13 @@ class UpdateProfileView(MyLoginRequiredMixin, UpdateView):
         '''return the Profile corresponding to the logged in user'''
         return self.get_logged_in_profile()
 
+    def form_valid(self, form):
+        '''save the Profile and drop its cached API copy and the fragments showing it'''
+        response = super().form_valid(form)
+        object_cache.invalidate(object_cache.PROFILE, [self.object.pk])
+        fragments.bump_profile_version(self.object.pk)
+        return response
+
 
 class DeletePostView(MyLoginRequiredMixin, DeleteView):
     '''View class to delete a Post on a Profile'''
@@ -216,41 +378,31 @@ class DeletePostView(MyLoginRequiredMixin, DeleteView):
         # calling the superclass method
         context = super().get_context_data(**kwargs)
 
-        # find the pk for this Post
-        pk = self.kwargs['pk']
-
-        # find the Post object
-        post = Post.objects.get(pk=pk)
-
-        # find the PK of the Profile to which this Post is associated
-        profile = post.profile
-
-        # add these into context dictionary
-        context['post'] = post
-        context['profile'] = profile
+        # the Post was already loaded by get_object, add it and its Profile to the context dictionary
+        context['post'] = self.object
+        context['profile'] = self.object.profile
 
         return context
 
+    # override form_valid, which would run the CASCADE collector over every photo, comment and like
+    def form_valid(self, form):
+        '''hide the Post now and purge it with its dependents in the background'''
+        success_url = self.get_success_url()
+        deletion.delete_post(self.object)
+        return redirect(success_url)
+
     # override get_success_url
     def get_success_url(self):
         '''return the URL to redirect to after a successful delete'''
 
-        # find the pk for this Post
-        pk = self.kwargs['pk']
-
-        # find the Post object
-        post = Post.objects.get(pk=pk)
-
-        # find the PK of the Profile to which this Post is associated
-        profile = post.profile
-
-        return reverse('show_profile', kwargs={'pk': profile.pk})
+        # the Profile to which this Post is associated
+        return reverse('show_profile', kwargs={'pk': self.object.profile_id})
     
 
 class UpdatePostView(MyLoginRequiredMixin, UpdateView):
     '''View class to update a Post'''
 
-    model = Post
+    queryset = Post.objects.select_related('profile')
     form_class = UpdatePostForm
     template_name = "mini_insta/update_post_form.html"
 
@@ -266,6 +418,12 @@ class UpdatePostView(MyLoginRequiredMixin, UpdateView):
         # return the URL to redirect to, which is the URL of the post
         return reverse('show_post', kwargs={'pk': post.pk})
 
+    def form_valid(self, form):
+        '''save the new caption (saving re-indexes its #hashtags and @mentions) and drop its cached API copy'''
+        response = super().form_valid(form)
+        object_cache.invalidate(object_cache.POST, [self.object.pk])
+        return response
+
 class CreateCommentView(MyLoginRequiredMixin, CreateView):
     '''View class to create a Comment'''
     model = Comment
@@ -289,18 +447,24 @@ class CreateCommentView(MyLoginRequiredMixin, CreateView):
         form.instance.post = post
         form.instance.profile = self.get_logged_in_profile()
         
-        return super().form_valid(form)
+        response = super().form_valid(form)
+
+        # re-render the cached comments of this Post
+        transaction.on_commit(lambda: fragments.bump_versions([post.pk]))
+
+        # notify the owner of the Post once the Comment is committed
+        enqueue(record_activity, events=[
+            activity.make_event(Activity.COMMENT, form.instance.profile.pk, post.profile_id, post.pk),
+        ])
+        return response
 
     def get_success_url(self):
         '''url to redirect to after successfully submitting a Comment'''
         return reverse('show_post', kwargs={'pk': self.kwargs['pk']})
 
 # inherits DetailView, which displays one model
-class LoggedInProfileDetailView(MyLoginRequiredMixin, DetailView):
+class LoggedInProfileDetailView(MyLoginRequiredMixin, ProfileDetailView):
     '''View class to show the profile of the logged in user specifically'''
-    model = Profile
-    template_name = "mini_insta/show_profile.html"
-    content_object_name = "profile" # singular
 
     def get_object(self):
         '''return the logged-in user's profile'''
@@ -321,10 +485,10 @@ class PostFeedListView(MyLoginRequiredMixin, ListView):
         # # find the Profile object
         # profile = Profile.objects.get(pk=pk)
 
-        profile = self.get_logged_in_profile()
+        self.profile = self.get_logged_in_profile()
 
         # return the Post feed related to this Profile
-        return profile.get_post_feed()
+        return self.profile.get_post_feed().select_related('profile')
 
     def get_context_data(self, **kwargs):
         '''return the dictionary of context variables for use in the template'''
@@ -337,14 +501,21 @@ class PostFeedListView(MyLoginRequiredMixin, ListView):
         # add the Profile to the context for template usage.
         # context['profile'] = Profile.objects.get(pk=pk)
 
-        context['profile'] = self.get_logged_in_profile()
+        context['profile'] = self.profile
+
+        # "Liked by @x and N others" for every post on the page, in one or two queries
+        posts = attach_like_summaries(context['posts'], self.profile)
+
+        # post cards come from the cache, only changed posts are queried and rendered
+        context['posts'] = attach_fragments(posts)
 
         return context
 
-class SearchView(MyLoginRequiredMixin, ListView):
+class SearchView(MyLoginRequiredMixin, RateLimitMixin, ListView):
     '''View class to display the search of a Profile or a Post'''
 
     template_name = "mini_insta/search_results.html"
+    throttle_scope = "search" # rate limited per user and per IP, shed first under load
     context_object_name = "posts"
 
     def dispatch(self, request, *args, **kwargs):
@@ -368,7 +539,7 @@ class SearchView(MyLoginRequiredMixin, ListView):
     
     def get_queryset(self):
         '''Return QuerySet of Posts that match the search query'''
-        return Post.objects.filter(caption__contains=self.query).order_by('-timestamp') # most recent first
+        return Post.objects.filter(caption__contains=self.query).select_related('profile').order_by('-timestamp') # most recent first
     
     def get_context_data(self, **kwargs):
         '''Return the context dictionary for template rendering'''
@@ -381,11 +552,11 @@ class SearchView(MyLoginRequiredMixin, ListView):
         # add the Query to the context
         context['query'] = self.query
 
-        # add the Posts that match the query to context
-        context['posts'] = self.get_queryset()
+        # add the Posts that match the query to context, with their likes lines and cached cards
+        context['posts'] = attach_fragments(attach_like_summaries(context['object_list'], self.profile))
 
         # matching profiles with username, name, or text that match the query
-        context['profiles'] = (
+        context['profiles'] = list(
             Profile.objects.filter(username__contains=self.query) | Profile.objects.filter(display_name__contains=self.query) | Profile.objects.filter(bio_text__contains=self.query)
         )
 
@@ -403,16 +574,11 @@ class FollowView(MyLoginRequiredMixin, TemplateView):
     '''View class to handle the action of Following an account'''
     def dispatch(self, request, *args, **kwargs):
         '''dispatch (handle) the request to follow an account'''
-        # retrieve the Profile requesting to follow and the Profile to be followed
-        profile_to_follow = Profile.objects.get(pk=kwargs['pk'])
+        # the Profile requesting to follow; the write buffer skips self-follows and missing Profiles
         follower = self.get_logged_in_profile()
 
-        # if they are not the same profiles, allow the action
-        if profile_to_follow != follower:
-            Follow.objects.get_or_create(
-                profile=profile_to_follow,
-                follower_profile=follower
-            )
+        # repeated follow/unfollow taps are coalesced and written in a batch
+        write_buffer.follow(follower.pk, kwargs['pk'])
         return redirect('show_profile', pk=kwargs['pk'])
 
 
@@ -420,14 +586,10 @@ class UnfollowView(MyLoginRequiredMixin, TemplateView):
     '''View class to handle the action of Unollowing an account'''
     def dispatch(self, request, *args, **kwargs):
         '''dispatch (handle) the request to unfollow an account'''
-        profile_to_unfollow = Profile.objects.get(pk=kwargs['pk'])
         follower = self.get_logged_in_profile()
 
-        # filter through Profiles and when they are found in the Follow relationship, delete that
-        Follow.objects.filter(
-            profile=profile_to_unfollow,
-            follower_profile=follower
-        ).delete()
+        # the Follow relationship is deleted when the write buffer is flushed
+        write_buffer.unfollow(follower.pk, kwargs['pk'])
         return redirect('show_profile', pk=kwargs['pk'])
 
 
@@ -435,12 +597,10 @@ class LikeView(MyLoginRequiredMixin, TemplateView):
     '''View class to handle the action of Liking a Post'''
     def dispatch(self, request, *args, **kwargs):
         '''dispatch (handle) the request to like a Post'''
-        post = Post.objects.get(pk=kwargs['pk'])
         liker = self.get_logged_in_profile()
 
-        # make sure the Profile is not liking their own Post
-        if post.profile != liker:
-            Like.objects.get_or_create(post=post, profile=liker)
+        # the write buffer makes sure the Profile is not liking their own Post
+        write_buffer.like(liker.pk, kwargs['pk'])
         return redirect('show_post', pk=kwargs['pk'])
 
 
@@ -448,128 +608,8 @@ class UnlikeView(MyLoginRequiredMixin, TemplateView):
     '''View class to handle the action of Unliking a Post'''
     def dispatch(self, request, *args, **kwargs):
         '''dispatch (handle) the request to unlike a Post'''
-        post = Post.objects.get(pk=kwargs['pk'])
         liker = self.get_logged_in_profile()
 
-        # Delete the Like relationship if the profile matches the liker of the Post
-        Like.objects.filter(post=post, profile=liker).delete()
+        # Delete the Like relationship (when the write buffer is flushed)
+        write_buffer.unlike(liker.pk, kwargs['pk'])
         return redirect('show_post', pk=kwargs['pk'])
-    
-
-'''
-DJANGO REST API VIEWS
-'''
-from django.contrib.auth import authenticate
-from django.shortcuts import get_object_or_404
-from rest_framework import generics, status
-from rest_framework.authtoken.models import Token
-from rest_framework.parsers import FormParser, MultiPartParser
-from rest_framework.permissions import AllowAny, IsAuthenticated
-from rest_framework.response import Response
-from rest_framework.views import APIView
-
-from .models import Photo, Post, Profile
-from .serializers import PostSerializer, ProfileSerializer, UserSerializer
-
-
-class ProfileListAPIView(generics.ListAPIView):
-    queryset = Profile.objects.all().order_by("username")
-    serializer_class = ProfileSerializer
-
-
-class ProfileDetailAPIView(generics.RetrieveAPIView):
-    queryset = Profile.objects.all()
-    serializer_class = ProfileSerializer
-
-
-class ProfilePostsAPIView(APIView):
-    permission_classes = [AllowAny]
-
-    def get(self, request, profile_id):
-        profile = get_object_or_404(Profile, pk=profile_id)
-        posts = Post.objects.filter(profile=profile).order_by("-timestamp")
-        serializer = PostSerializer(posts, many=True, context={"request": request})
-        return Response(serializer.data)
-
-
-class ProfileFeedAPIView(APIView):
-    permission_classes = [AllowAny]
-
-    def get(self, request, profile_id):
-        profile = get_object_or_404(Profile, pk=profile_id)
-        posts = profile.get_post_feed()
-        serializer = PostSerializer(posts, many=True, context={"request": request})
-        return Response(serializer.data)
-
-
-class CreatePostAPIView(APIView):
-    permission_classes = [IsAuthenticated]
-    parser_classes = [MultiPartParser, FormParser]
-
-    def post(self, request):
-        profile = get_object_or_404(Profile, user=request.user)
-        caption = request.data.get("caption", "").strip()
-
-        if not caption:
-            return Response(
-                {"error": "caption is required"},
-                status=status.HTTP_400_BAD_REQUEST,
-            )
-
-        post = Post.objects.create(profile=profile, caption=caption)
-
-        files = request.FILES.getlist("photos")
-        if files:
-            for image_file in files:
-                Photo.objects.create(post=post, image_file=image_file)
-        else:
-            # Keep behavior consistent with the web view fallback.
-            Photo.objects.create(post=post, image_file="default.png")
-
-        serializer = PostSerializer(post, context={"request": request})
-        return Response(serializer.data, status=status.HTTP_201_CREATED)
-
-
-class LoginAPIView(APIView):
-    permission_classes = [AllowAny]
-
-    def post(self, request):
-        username = request.data.get("username")
-        password = request.data.get("password")
-
-        if not username or not password:
-            return Response(
-                {"error": "username and password required"},
-                status=status.HTTP_400_BAD_REQUEST,
-            )
-
-        user = authenticate(username=username, password=password)
-        if not user:
-            return Response(
-                {"error": "invalid credentials"},
-                status=status.HTTP_401_UNAUTHORIZED,
-            )
-
-        token, _ = Token.objects.get_or_create(user=user)
-
-        profile = get_object_or_404(Profile, user=user)
-        return Response(
-            {
-                "token": token.key,
-                "user": UserSerializer(user).data,
-                "profile": ProfileSerializer(profile).data,
-            }
-        )
-
-
-class CurrentUserAPIView(APIView):
-    permission_classes = [IsAuthenticated]
-
-    def get(self, request):
-        profile = get_object_or_404(Profile, user=request.user)
-        return Response(
-            {
-                "user": UserSerializer(request.user).data,
-                "profile": ProfileSerializer(profile).data,
-            }
-        )
\ No newline at end of file
@@ -0,0 +1,69 @@
+# File: mini_insta/warmup.py
+# precompute the cached parts of the feeds of the most active profiles, e.g. after a deploy or a cache flush
+# Author: Nguyen Le
+
+
+import time
+
+import django
+from django.db.models import Count, F, Q
+
+from . import activity
+from .fragments import attach_fragments
+from .like_summary import attach_like_summaries
+from .models import Profile
+
+
+def active_profiles(limit, since):
+    '''Return the pks of the limit most active Profiles: most Posts since `since` first, then most recent login'''
+    recent_posts = Count('post', filter=Q(post__timestamp__gte=since, post__deleted_at__isnull=True))
+    return list(
+        Profile.objects.annotate(recent_posts=recent_posts)
+        .order_by('-recent_posts', F('user__last_login').desc(nulls_last=True), 'pk')
+        .values_list('pk', flat=True)[:limit]
+    )
+
+
+def id_range_shards(profile_ids, size):
+    '''split pks into lists of up to size consecutive pks, so each shard covers one id range'''
+    profile_ids = sorted(profile_ids)
+    return [profile_ids[i:i + size] for i in range(0, len(profile_ids), size)]
+
+
+def warm_profile(profile, feed_size=50, warmed_posts=None):
+    '''Fill the caches the feed page of profile reads, and return the number of Posts warmed
+
+    That is the like summary and rendered card and comments of its newest
+    feed_size Posts, and its unread activity count. Posts in warmed_posts (a
+    set, updated here) are skipped, since their cache entries are shared by
+    every follower.
+    '''
+    warmed_posts = set() if warmed_posts is None else warmed_posts
+    posts = [
+        post for post in profile.get_post_feed().select_related('profile')[:feed_size]
+        if post.pk not in warmed_posts
+    ]
+    attach_fragments(attach_like_summaries(posts))
+    warmed_posts.update(post.pk for post in posts)
+    activity.get_unread_count(profile.pk)
+    return len(posts)
+
+
+def init_worker():
+    '''set Django up in a pool process (needed with the spawn start method, a no-op once set up)'''
+    django.setup()
+
+
+def warm_shard(profile_ids, feed_size=50, per_second=None):
+    '''Warm one shard of profiles, no faster than per_second profiles a second; return (profiles, posts) warmed'''
+    start = time.monotonic()
+    warmed_posts = set()
+    posts = 0
+    for done, profile in enumerate(Profile.objects.filter(pk__in=profile_ids).order_by('pk'), start=1):
+        posts += warm_profile(profile, feed_size, warmed_posts)
+        if per_second:
+            # ahead of the throughput target: wait, so the warmup does not crowd out live traffic
+            ahead = done / per_second - (time.monotonic() - start)
+            if ahead > 0:
+                time.sleep(ahead)
+    return len(profile_ids), posts
@@ -0,0 +1,277 @@
+# File: mini_insta/write_buffer.py
+# coalesce bursts of like/unlike and follow/unfollow toggles into batched writes
+# Author: Nguyen Le
+
+
+import atexit
+import logging
+import threading
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from . import activity, like_summary, object_cache, tasks
+from .models import Activity, ArchivedLike, Follow, Like, Post, Profile
+from .taskqueue import enqueue
+
+logger = logging.getLogger(__name__)
+
+# how long toggles are held before being written; 0 (the default) writes every toggle immediately.
+# Buffered toggles live in this process until they are flushed, so a worker killed without a clean
+# exit (SIGKILL, out of memory) loses the ones of its last window: only turn it on where that is acceptable
+WINDOW = getattr(settings, 'MINI_INSTA_WRITE_BUFFER_WINDOW', 0)
+
+# flush early once this many (actor, target) pairs are pending
+MAX_PENDING = getattr(settings, 'MINI_INSTA_WRITE_BUFFER_MAX_PENDING', 1000)
+
+# kinds of toggles, the actor is always the logged in Profile
+LIKE = 'like' # target is a Post
+FOLLOW = 'follow' # target is the Profile being followed
+
+
+def overlay_key(kind, actor_id, target_id):
+    '''cache key holding the not-yet-written state of one toggle, for read-your-writes'''
+    return f'mini_insta:pending:{kind}:{actor_id}:{target_id}'
+
+
+class WriteBuffer:
+    '''Hold the latest desired state of each (kind, actor, target) toggle and write the net changes in batches
+
+    Liking, unliking and liking again within one window costs a single insert
+    (or nothing at all, when the toggles cancel out). The pending state is also
+    written to the cache, so the acting user sees their own toggle from any
+    process before it reaches the database; that needs a cache shared by every
+    process (checks.py warns about a process-local one).
+    '''
+
+    def __init__(self, window=WINDOW, max_pending=MAX_PENDING):
+        self.window = window
+        self.max_pending = max_pending
+        self._lock = threading.Lock()
+        self._pending = {} # (kind, actor_id, target_id) -> True (create) / False (delete)
+        self._timer = None
+
+    def set(self, kind, actor_id, target_id, state):
+        '''Record that actor wants the toggle on target to end up as state (True = liked/following)'''
+        if self.window > 0:
+            # removed again once the toggle is written (see _write)
+            cache.set(overlay_key(kind, actor_id, target_id), state, timeout=max(5, self.window * 4))
+
+        with self._lock:
+            self._pending[(kind, actor_id, target_id)] = state
+            flush_now = self.window <= 0 or len(self._pending) >= self.max_pending
+            if not flush_now:
+                self._schedule()
+
+        if flush_now:
+            self.flush()
+
+    def _schedule(self):
+        '''start the timer of the next flush, unless one is running (called with the lock held)'''
+        if self._timer is None:
+            self._timer = threading.Timer(self.window, self._flush_from_timer)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def pending_state(self, kind, actor_id, target_id):
+        '''Return the buffered state of a toggle, or None when nothing is pending for it'''
+        with self._lock:
+            state = self._pending.get((kind, actor_id, target_id))
+        if state is None:
+            state = cache.get(overlay_key(kind, actor_id, target_id))
+        return state
+
+    def pending_states(self, kind, actor_id, target_ids):
+        '''Return {target_id: state} for the toggles of actor on target_ids that are still pending'''
+        with self._lock:
+            states = {t: self._pending[(kind, actor_id, t)] for t in target_ids if (kind, actor_id, t) in self._pending}
+        rest = [t for t in target_ids if t not in states]
+        if rest:
+            overlay = cache.get_many([overlay_key(kind, actor_id, t) for t in rest])
+            states.update({t: overlay[overlay_key(kind, actor_id, t)] for t in rest if overlay_key(kind, actor_id, t) in overlay})
+        return states
+
+    def _flush_from_timer(self):
+        '''timer callback: flush on a fresh connection and release it afterwards'''
+        try:
+            self.flush()
+        except Exception:
+            logger.exception('write buffer flush failed')
+        finally:
+            connection.close()
+
+    def flush(self):
+        '''Write every pending toggle to the database with one bulk insert and one delete per kind and target
+
+        When the write fails, the toggles are put back (under any made since)
+        to be retried by the next flush, and the error is raised.
+        '''
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        if not pending:
+            return
+
+        try:
+            self._write(pending)
+        except Exception:
+            with self._lock:
+                self._pending = {**pending, **self._pending}
+                if self.window > 0:
+                    self._schedule()
+            raise
+
+    def _write(self, pending):
+        '''write a batch of toggles {(kind, actor_id, target_id): state} in one transaction'''
+        changes = defaultdict(lambda: {True: set(), False: set()})
+        for (kind, actor_id, target_id), state in pending.items():
+            changes[kind][state].add((actor_id, target_id))
+
+        events = []
+        when = timezone.now() # within a window of the toggles, and before any wait in the task queue
+        with transaction.atomic():
+            if LIKE in changes:
+                created = self._apply(changes[LIKE], Like, 'profile_id', 'post_id', self._likeable, self._unlike_archived)
+                touched = {post for _, post in created} | {post for _, post in changes[LIKE][False]}
+                transaction.on_commit(lambda: like_summary.invalidate(touched))
+                events += [
+                    activity.make_event(Activity.LIKE, actor, owner, post, when)
+                    for (actor, post), owner in created.items()
+                ]
+            if FOLLOW in changes:
+                created = self._apply(changes[FOLLOW], Follow, 'follower_profile_id', 'profile_id', self._followable)
+                # both sides' follow counts changed
+                counted = {profile for pair in changes[FOLLOW][True] | changes[FOLLOW][False] for profile in pair}
+                transaction.on_commit(lambda: object_cache.invalidate(object_cache.PROFILE, counted))
+                events += [
+                    activity.make_event(Activity.FOLLOW, actor, target, when=when)
+                    for (actor, target) in created
+                ]
+
+            # notify the owners of the new likes and follows once this batch is committed
+            if events:
+                enqueue(tasks.record_activity, events=events)
+
+            # the database has the final state now, including toggles that were rejected
+            transaction.on_commit(lambda: self._forget_overlay(pending))
+
+    def _forget_overlay(self, written):
+        '''delete the cached states of written toggles, except those toggled again since'''
+        with self._lock:
+            keys = [overlay_key(*toggle) for toggle in written if toggle not in self._pending]
+        cache.delete_many(keys)
+
+    def _likeable(self, pairs):
+        '''drop likes on missing Posts, on the liker's own Posts and archived ones, mapping each like to the Post owner'''
+        posts = list(Post.objects.filter(pk__in={post_id for _, post_id in pairs}).values_list('pk', 'profile_id', 'archived_like_count'))
+        owners = {pk: owner for pk, owner, _ in posts}
+        allowed = {(actor, post): owners[post] for actor, post in pairs if post in owners and owners[post] != actor}
+
+        # a like moved to the archive (see archive.py) still counts, so it is not created again
+        archived_posts = {pk for pk, _, archived in posts if archived}
+        if archived_posts & {post for _, post in allowed}:
+            archived = set(ArchivedLike.objects.filter(
+                post_id__in=archived_posts, profile_id__in={actor for actor, _ in allowed},
+            ).values_list('profile_id', 'post_id'))
+            allowed = {pair: owner for pair, owner in allowed.items() if pair not in archived}
+        return allowed
+
+    def _unlike_archived(self, post_id, profile_ids):
+        '''delete the archived likes of a Post that were not found among its Likes, and take them off its count'''
+        removed, _ = ArchivedLike.objects.filter(post_id=post_id, profile_id__in=profile_ids).delete()
+        if removed:
+            Post.all_objects.filter(pk=post_id).update(archived_like_count=F('archived_like_count') - removed)
+
+    def _followable(self, pairs):
+        '''drop follows of missing Profiles and of oneself, mapping each follow to the followed Profile'''
+        existing = set(Profile.objects.filter(pk__in={target for _, target in pairs}).values_list('pk', flat=True))
+        return {(actor, target): target for actor, target in pairs if target in existing and target != actor}
+
+    def _apply(self, change, model, actor_field, target_field, allowed, not_deleted=None):
+        '''bulk create the wanted rows that do not exist yet and delete the unwanted ones
+
+        not_deleted(target, actors) is called when fewer rows were deleted for
+        a target than asked for. Returns the newly created pairs, mapped to
+        the Profile that should be notified.
+        '''
+        to_create, to_delete = change[True], change[False]
+        created = {}
+
+        if to_create:
+            recipients = allowed(to_create)
+            existing = set(model.objects.filter(
+                **{f'{actor_field}__in': {a for a, _ in recipients}, f'{target_field}__in': {t for _, t in recipients}}
+            ).values_list(actor_field, target_field))
+            created = {pair: recipient for pair, recipient in recipients.items() if pair not in existing}
+            # a row inserted meanwhile by another process is left as it is (see the unique constraints)
+            model.objects.bulk_create(
+                [model(**{actor_field: a, target_field: t}) for a, t in created],
+                batch_size=500, ignore_conflicts=True,
+            )
+
+        # one DELETE per target: the common burst is many actors on one viral post
+        by_target = defaultdict(set)
+        for actor, target in to_delete:
+            by_target[target].add(actor)
+        for target, actors in by_target.items():
+            deleted, _ = model.objects.filter(**{target_field: target, f'{actor_field}__in': actors}).delete()
+            if deleted < len(actors) and not_deleted is not None:
+                not_deleted(target, actors)
+
+        return created
+
+
+write_buffer = WriteBuffer()
+
+# don't lose toggles still in the buffer when the process exits cleanly
+atexit.register(write_buffer.flush)
+
+
+def like(profile_id, post_id):
+    '''buffer a like of post by profile'''
+    write_buffer.set(LIKE, profile_id, post_id, True)
+
+
+def unlike(profile_id, post_id):
+    '''buffer removing the like of post by profile'''
+    write_buffer.set(LIKE, profile_id, post_id, False)
+
+
+def follow(follower_id, profile_id):
+    '''buffer follower starting to follow profile'''
+    write_buffer.set(FOLLOW, follower_id, profile_id, True)
+
+
+def unfollow(follower_id, profile_id):
+    '''buffer follower no longer following profile'''
+    write_buffer.set(FOLLOW, follower_id, profile_id, False)
+
+
+def pending_likes(profile_id, post_ids):
+    '''Return {post_id: liked} for likes/unlikes by profile on post_ids that have not been written yet'''
+    return write_buffer.pending_states(LIKE, profile_id, post_ids)
+
+
+def is_liked(profile_id, post_id):
+    '''Return whether profile likes post, including toggles that have not been written yet'''
+    state = write_buffer.pending_state(LIKE, profile_id, post_id)
+    if state is None:
+        state = (
+            Like.objects.filter(profile_id=profile_id, post_id=post_id).exists()
+            or ArchivedLike.objects.filter(profile_id=profile_id, post_id=post_id).exists()
+        )
+    return state
+
+
+def is_following(follower_id, profile_id):
+    '''Return whether follower follows profile, including toggles that have not been written yet'''
+    state = write_buffer.pending_state(FOLLOW, follower_id, profile_id)
+    if state is None:
+        state = Follow.objects.filter(follower_profile_id=follower_id, profile_id=profile_id).exists()
+    return state